@@ -13,7 +13,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 import os
 import sys
 
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -182,3 +182,33 @@ EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 
 NODEODM_SERVER_URL = config('NODEODM_SERVER_URL', cast=str)
 NODEODM_SERVER_TOKEN = config('NODEODM_SERVER_TOKEN', default="dummy", cast=str)
+# Uploaded images are forwarded to NodeODM on requests of up to this many images
+NODEODM_UPLOAD_BATCH_SIZE = config('NODEODM_UPLOAD_BATCH_SIZE', default=50, cast=int)
+# Files or folders of the NodeODM all.zip that are extracted as soon as a Flight is complete
+ODM_REQUIRED_OUTPUTS = config('ODM_REQUIRED_OUTPUTS', cast=Csv(),
+                              default="images.json,odm_orthophoto/odm_orthophoto.tif,odm_dem/dsm.tif,odm_dem/dtm.tif")
+# Files or folders of all.zip that are only extracted the first time somebody downloads them
+ODM_OPTIONAL_OUTPUTS = config('ODM_OPTIONAL_OUTPUTS', cast=Csv(),
+                              default="odm_meshing/odm_mesh.ply,odm_texturing,odm_filterpoints/point_cloud.ply")
+
+# Background job queue (see core/jobs.py). Jobs are executed by `python3 manage.py runworker`
+JOB_WORKER_PROCESSES = config('JOB_WORKER_PROCESSES', default=2, cast=int)
+JOB_POLL_INTERVAL = config('JOB_POLL_INTERVAL', default=5, cast=float)  # seconds
+JOB_MAX_ATTEMPTS = config('JOB_MAX_ATTEMPTS', default=3, cast=int)
+JOB_RETRY_DELAY = config('JOB_RETRY_DELAY', default=60, cast=int)  # seconds
+# Jobs that are still running after this long are assumed to belong to a dead worker, and are queued again
+JOB_TIMEOUT = config('JOB_TIMEOUT', default=6 * 60 * 60, cast=int)  # seconds
+# Independent post-processing stages of a Flight run in parallel, on up to this many processes
+POSTPROCESSING_PROCESSES = config('POSTPROCESSING_PROCESSES', default=4, cast=int)
+# Also keep the colour relief and hillshade of the DSM (dsm_colored.tif, dsm_hillshade.tif), for debugging
+KEEP_DSM_INTERMEDIATES = config('KEEP_DSM_INTERMEDIATES', default=False, cast=bool)
+# Compression of the Cloud-Optimized GeoTIFFs that are published on GeoServer: COG_RGB_COMPRESSION for the 8-bit RGB
+# orthophotos, COG_COMPRESSION for everything else (DEFLATE, ZSTD, LZW, ...)
+COG_COMPRESSION = config('COG_COMPRESSION', default="DEFLATE")
+COG_RGB_COMPRESSION = config('COG_RGB_COMPRESSION', default="JPEG")
+COG_JPEG_QUALITY = config('COG_JPEG_QUALITY', default=90, cast=int)
+# Heights (in pixels) of extra orthophoto previews, saved as odm_orthophoto/odm_orthophoto_<height>.png. The thumbnail
+# (512) and the small orthophoto (1080) are always created
+PREVIEW_SIZES = config('PREVIEW_SIZES', cast=Csv(int), default="")
+# Biggest render of the orthophoto served by /api/preview/<uuid>/<size>.jpg (or .webp), in pixels
+RENDER_MAX_SIZE = config('RENDER_MAX_SIZE', default=2048, cast=int)
@@ -1,3 +1,6 @@
 from .settings import *
 
 PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# Run post-processing stages on the test process, so monkeypatching and pyfakefs apply to them
+POSTPROCESSING_PROCESSES = 1
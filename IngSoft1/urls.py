@@ -44,8 +44,11 @@ urlpatterns = [
     path('api/uploads/<uuid:uuid>/vectorfile', upload_vectorfile, name="upload_vector"),
     path('api/uploads/<uuid:uuid>/geotiff', upload_geotiff, name="upload_geotiff"),
     path('api/preview/<uuid:uuid>', preview_flight_url, name="preview_flight_url"),
+    path('api/preview/<uuid:uuid>/<int:size>.<extension>', render_flight_preview, name="render_flight_preview"),
     path('api/rastercalcs/check', check_formula, name="check_formula"),
     path('api/rastercalcs/<uuid:uuid>', create_raster_index, name="create_raster_index"),
+    path('api/rastercalcs/<uuid:uuid>/batch', create_raster_indices, name="create_raster_indices"),
+    path('api/jobs/<int:pk>', job_status, name="job_status"),
     path('mapper/<uuid:uuid>', mapper, name="mapper"),
     path('mapper/<uuid:uuid>/bbox', mapper_bbox, name="mapper_bbox"),
     # path('mapper/<uuid:uuid>/shapefiles', mapper_shapefiles),
@@ -0,0 +1,59 @@
+"""
+Measures the throughput of formula validation (what the check_formula endpoint does on every keystroke)
+
+Compares building a parser for every request, as FormulaParser used to do, with the shared LALR parser and its cache
+of parsed formulas.
+
+Usage (from the repository root):
+    python -m benchmarks.check_formula [--requests 200]
+"""
+import argparse
+import random
+import time
+
+from lark import Lark, LarkError
+
+from core.parser import GRAMMAR, FormulaParser
+
+FORMULAS = ("(nir-red)/(nir+red)", "((nir-rdedge)/(nir+rdedge)+1)*127", "2.5*(nir-red)/(nir+6*red-7.5*blue+1)",
+            "green/red", "nir**2-red", "blue+", "(nir-red", "-red*(green+blue)/2")
+
+
+def per_request_parser(formula):
+    try:
+        Lark(GRAMMAR).parse(formula)
+        return True
+    except LarkError:
+        return False
+
+
+def shared_parser(formula):
+    return FormulaParser().is_valid(formula)
+
+
+def throughput(check, formulas):
+    """
+    Returns: Validated formulas per second
+    """
+    start = time.perf_counter()
+    for formula in formulas:
+        check(formula)
+    return len(formulas) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Formulas validated by every method")
+    args = parser.parse_args()
+
+    # Users edit formulas, so some of them repeat and some don't
+    rng = random.Random(0)
+    formulas = [rng.choice(FORMULAS) + " " * rng.randint(0, 20) for _ in range(args.requests)]
+    before = throughput(per_request_parser, formulas)
+    after = throughput(shared_parser, formulas)
+    print(f"New parser per request: {before:10.1f} formulas/s")
+    print(f"Shared LALR parser:     {after:10.1f} formulas/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Measures update_disk_space on a synthetic flight folder: a full walk against the DirectoryUsage cache, before and
+after one directory changes
+
+Uses a throwaway test database, so it runs with the same environment variables as manage.py.
+
+Usage (from the repository root):
+    python -m benchmarks.disk_usage [--files 50000] [--directories 500]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import django
+
+
+def create_tree(root, files, directories):
+    """
+    Creates `files` small files, spread over `directories` directories of two levels (like odm_texturing/...)
+    """
+    per_directory = max(files // directories, 1)
+    for d in range(directories):
+        folder = os.path.join(root, f"stage_{d % 10}", f"folder_{d}")
+        os.makedirs(folder)
+        for i in range(per_directory):
+            with open(os.path.join(folder, f"file_{i}.bin"), "wb") as f:
+                f.write(b"x" * (i % 4096))
+    # As if the flight was processed a while ago, otherwise the directories are too recent to be cached
+    for folder, _, _ in os.walk(root):
+        os.utime(folder, ns=(0, 0))
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=50000)
+    parser.add_argument("--directories", type=int, default=500)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "IngSoft1.settings")
+    django.setup()
+    from django.db import connection
+    from core.utils.disk_space_tracking import DiskSpaceTrackerMixin, cached_size_of_dir
+
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            create_tree(root, args.files, args.directories)
+            full, full_time = timed(DiskSpaceTrackerMixin._size_of_dir, root)
+            cold, cold_time = timed(cached_size_of_dir, root)
+            warm, warm_time = timed(cached_size_of_dir, root)
+            with open(os.path.join(root, "stage_0", "folder_0", "new.bin"), "wb") as f:
+                f.write(b"x" * 1024)
+            changed, changed_time = timed(cached_size_of_dir, root)
+            assert full == cold == warm == changed - 1024
+
+            print(f"{args.files} files on {args.directories} directories, {full} bytes")
+            print(f"Full walk:                    {full_time * 1000:10.1f} ms")
+            print(f"Cached walk, empty cache:     {cold_time * 1000:10.1f} ms")
+            print(f"Cached walk, nothing changed: {warm_time * 1000:10.1f} ms")
+            print(f"Cached walk, one new file:    {changed_time * 1000:10.1f} ms")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
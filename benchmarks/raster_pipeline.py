@@ -0,0 +1,77 @@
+"""
+Compares the post-processing raster operations running as gdal_* subprocesses against core.utils.raster
+
+Usage (from the repository root, on a machine with GDAL):
+    python -m benchmarks.raster_pipeline path/to/odm_orthophoto.tif path/to/dsm.tif [--repeat 3]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from core.utils import raster
+
+COLOR_FILE = "./core/utils/color_relief.txt"
+
+
+def subprocess_pipeline(ortho, dsm, out):
+    subprocess.run(["gdal_translate", "-b", "1", "-b", "2", "-b", "3", "-b", "mask", "-scale", "0", "255", "-ot",
+                    "Byte", "-co", "TILED=YES", ortho, f"{out}/rgb.tif"], check=True, capture_output=True)
+    subprocess.run(["gdal_translate", "-of", "PNG", f"{out}/rgb.tif", f"{out}/rgb.png"], check=True,
+                   capture_output=True)
+    subprocess.run(["gdal_translate", "-outsize", "0", "512", f"{out}/rgb.tif", f"{out}/thumbnail.png"], check=True,
+                   capture_output=True)
+    subprocess.run(["gdal_translate", "-outsize", "0", "1080", f"{out}/rgb.tif", f"{out}/small.tif"], check=True,
+                   capture_output=True)
+    subprocess.run(["gdalinfo", "-proj4", f"{out}/small.tif"], check=True, capture_output=True)
+    subprocess.run(["gdaldem", "color-relief", dsm, COLOR_FILE, f"{out}/dsm_colored.tif", "-alpha", "-co",
+                    "ALPHA=YES"], check=True, capture_output=True)
+    subprocess.run(["gdaldem", "hillshade", dsm, f"{out}/dsm_hillshade.tif", "-z", "1.0", "-s", "1.0", "-az", "315.0",
+                    "-alt", "45.0"], check=True, capture_output=True)
+    subprocess.run(["gdalinfo", "-mm", dsm], check=True, capture_output=True)
+
+
+def in_process_pipeline(ortho, dsm, out):
+    raster.extract_bands(ortho, f"{out}/rgb.tif", (1, 2, 3), 255)
+    raster.to_png(f"{out}/rgb.tif", f"{out}/rgb.png")
+    raster.resize(f"{out}/rgb.tif", f"{out}/thumbnail.png", 512)
+    raster.resize(f"{out}/rgb.tif", f"{out}/small.tif", 1080)
+    raster.info(f"{out}/small.tif")
+    raster.color_relief(dsm, f"{out}/dsm_colored.tif", COLOR_FILE)
+    raster.hillshade(dsm, f"{out}/dsm_hillshade.tif")
+    raster.min_max(dsm)
+
+
+def measure(pipeline, ortho, dsm, repeat):
+    timings = []
+    for _ in range(repeat):
+        out = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            pipeline(ortho, dsm, out)
+            timings.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(out)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("ortho", help="An RGB orthophoto (odm_orthophoto.tif)")
+    parser.add_argument("dsm", help="A DSM (odm_dem/dsm.tif)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per pipeline, the fastest one is reported")
+    args = parser.parse_args()
+    for path in (args.ortho, args.dsm):
+        if not os.path.isfile(path):
+            parser.error(f"{path} doesn't exist")
+
+    subprocess_time = measure(subprocess_pipeline, args.ortho, args.dsm, args.repeat)
+    in_process_time = measure(in_process_pipeline, args.ortho, args.dsm, args.repeat)
+    print(f"subprocesses: {subprocess_time:.2f} s")
+    print(f"in-process:   {in_process_time:.2f} s ({subprocess_time / in_process_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
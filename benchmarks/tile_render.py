@@ -0,0 +1,69 @@
+"""
+Compares the latency of rendering 256x256 map tiles from a plain tiled GeoTIFF and from its Cloud-Optimized version
+
+Every tile is read the way GeoServer does for a WMS request: a window of the raster, downsampled to 256x256. Without
+overviews, zoomed-out tiles have to read (and decompress) every full-resolution pixel of the window.
+
+Usage (from the repository root, on a machine with GDAL):
+    python -m benchmarks.tile_render path/to/odm_orthophoto.tif [--compression JPEG] [--tiles 50]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from osgeo import gdal
+
+from core.utils import raster
+
+TILE_SIZE = 256
+
+
+def render_tiles(path, zoom_levels, tiles_per_level, seed=0):
+    """
+    Returns: {zoom level: mean milliseconds per tile}. Level 0 is the whole raster in one tile
+    """
+    rng = random.Random(seed)
+    latencies = {}
+    for level in range(zoom_levels):
+        # Reopen the file for every level, so that the GDAL block cache doesn't help
+        gdal.SetCacheMax(0)
+        dataset = gdal.Open(path)
+        window_width = max(TILE_SIZE, dataset.RasterXSize >> level)
+        window_height = max(TILE_SIZE, dataset.RasterYSize >> level)
+        start = time.perf_counter()
+        for _ in range(tiles_per_level):
+            x = rng.randint(0, max(dataset.RasterXSize - window_width, 0))
+            y = rng.randint(0, max(dataset.RasterYSize - window_height, 0))
+            dataset.ReadRaster(x, y, min(window_width, dataset.RasterXSize), min(window_height, dataset.RasterYSize),
+                               TILE_SIZE, TILE_SIZE)
+        latencies[level] = (time.perf_counter() - start) * 1000 / tiles_per_level
+        dataset = None
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("raster", help="A GeoTIFF, e.g. odm_orthophoto.tif")
+    parser.add_argument("--compression", default="DEFLATE", help="COG compression (JPEG only for 8-bit RGB)")
+    parser.add_argument("--levels", type=int, default=6, help="Zoom levels to sample")
+    parser.add_argument("--tiles", type=int, default=50, help="Tiles per zoom level")
+    args = parser.parse_args()
+    if not os.path.isfile(args.raster):
+        parser.error(f"{args.raster} doesn't exist")
+
+    with tempfile.TemporaryDirectory() as folder:
+        plain = raster.translate(args.raster, f"{folder}/plain.tif", creationOptions=["TILED=YES"])
+        cog = raster.to_cog(args.raster, f"{folder}/cog.tif", compression=args.compression)
+        before = render_tiles(plain, args.levels, args.tiles)
+        after = render_tiles(cog, args.levels, args.tiles)
+        print(f"plain: {os.path.getsize(plain) / 1024 ** 2:.1f} MB, COG: {os.path.getsize(cog) / 1024 ** 2:.1f} MB")
+
+    print("zoom  plain (ms/tile)  COG (ms/tile)")
+    for level in range(args.levels):
+        print(f"{level:4}  {before[level]:15.1f}  {after[level]:13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
+from .jobs import enqueue_disk_recompute, retry
 from .models import *
 
 
@@ -16,8 +17,15 @@ def _format_size(size):
 
 
 def recompute_disk_space(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.update_disk_space()
+    # Walking hundreds of directories takes too long for a request, so it is done by the worker. The progress is shown
+    # on the Jobs page
+    if queryset.model is Flight:
+        job = enqueue_disk_recompute(flights=queryset)
+    elif queryset.model is UserProject:
+        job = enqueue_disk_recompute(projects=queryset)
+    else:
+        job = enqueue_disk_recompute(users=queryset)
+    modeladmin.message_user(request, f"Disk space will be recomputed by job {job.pk}")
 
 
 recompute_disk_space.short_description = "Recompute disk space used by the selected object(s)"
@@ -77,7 +85,35 @@ class CustomUserAdmin(UserAdmin):
     actions = (recompute_disk_space, "refresh_available_images")
 
 
+class JobStageInline(admin.TabularInline):
+    model = JobStage
+    fields = ("name", "state", "attempts", "started", "duration", "error")
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class JobAdmin(admin.ModelAdmin):
+    def retry_jobs(self, request, queryset):
+        for job in queryset.filter(state=JobState.ERROR.name):
+            retry(job)
+
+    retry_jobs.short_description = "Retry the selected failed job(s)"
+
+    def pretty_progress(self, obj: Job):
+        return f"{obj.progress():.0%}"
+
+    pretty_progress.short_description = "Progress"
+
+    list_display = ("pk", "type", "flight", "project", "state", "pretty_progress", "attempts", "created", "finished")
+    list_filter = ("type", "state")
+    inlines = (JobStageInline,)
+
+    actions = ("retry_jobs",)
+
+
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Flight, FlightAdmin)
 admin.site.register(Artifact)
 admin.site.register(UserProject, UserProjectAdmin)
+admin.site.register(Job, JobAdmin)
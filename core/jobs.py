@@ -0,0 +1,387 @@
+import json
+import logging
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from core.models import ArtifactType, Flight, Job, JobStage, JobState, JobType, User, UserProject
+from core.parser import BUILTIN_FORMULAS
+from core.utils.dag import Stage, run_dag, topological_order
+from core.utils.disk_space_tracking import recompute_disk_space
+
+logger = logging.getLogger(__name__)
+
+# Stages are Flight methods. The names are stored on JobStage, so renaming or removing a method requires a data
+# migration for the jobs that are still pending (new stages are added to them by run_job). Inputs and outputs are only
+# used to find out which stages can run in parallel
+FLIGHT_POSTPROCESSING_STAGES = (
+    Stage("download_and_decompress_results", outputs=("odm_outputs",)),
+    Stage("create_rgb_tiff", inputs=("odm_outputs",), outputs=("rgb.tif",)),
+    Stage("create_previews", inputs=("rgb.tif",), outputs=("thumbnail", "odm_orthophoto_small")),
+    Stage("create_camera_positions", inputs=("odm_outputs", "odm_orthophoto_small"),
+          outputs=("camera_positions.json",)),
+    Stage("try_create_annotated_png_ortho", inputs=("odm_orthophoto_small", "camera_positions.json"),
+          outputs=("odm_orthophoto_annotated.png",)),
+    Stage("create_colored_dsm", inputs=("odm_outputs",), outputs=("dsm_colored_hillshade.tif",)),
+    Stage("try_create_png_dsm", inputs=("dsm_colored_hillshade.tif",), outputs=("dsm_colored_hillshade.png",)),
+    Stage("try_create_dsm_colorbar", inputs=("odm_outputs",), outputs=("colorbar.png",)),
+    # create_previews must have been invoked before this one!
+    Stage("create_geoserver_workspace_and_upload_geotiff", inputs=("rgb.tif", "thumbnail"), outputs=("ortho_layer",)),
+)
+
+
+def _run_flight_stage(flight_uuid: str, stage_name: str):
+    getattr(Flight.objects.get(uuid=flight_uuid), stage_name)()
+
+
+def _finish_flight_postprocessing(job: Job):
+    job.flight.update_disk_space()
+    job.flight.user.update_disk_space()
+
+
+def _flight_outputs_stages(job: Job):
+    # One stage per output, the stage name has the output
+    return tuple(Stage(f"extract_output:{output}") for output in job.get_parameters()["outputs"])
+
+
+def _run_flight_outputs_stage(flight_uuid: str, stage_name: str):
+    Flight.objects.get(uuid=flight_uuid).extract_output(stage_name.split(":", 1)[1])
+
+
+def _project_indices_stages(job: Job):
+    # One stage per Flight, so that the Flights are processed in parallel. The stage name has the Flight UUID
+    return tuple(Stage(f"create_index_rasters:{flight.uuid}") for flight in job.project.flights.all())
+
+
+def _run_project_indices_stage(indices: dict, stage_name: str):
+    flight = Flight.objects.get(uuid=stage_name.split(":", 1)[1])
+    flight.create_index_rasters(indices)
+    flight.update_disk_space()
+
+
+def _finish_project_indices(job: Job):
+    project = job.project
+    for index, formula in job.get_parameters()["indices"].items():
+        project._create_index_datastore(index)
+        # A retried Job may have created some of them already
+        project.artifacts.update_or_create(name=index, type=ArtifactType.INDEX.name,
+                                           defaults={"title": index.upper(), "formula": formula})
+    project.update_disk_space()
+    project.user.update_disk_space()
+
+
+def _finish_project_sync(job: Job):
+    project = job.project
+    project.sync_layers()
+    project.update_disk_space()
+    project.user.update_disk_space()
+
+
+# Objects per stage of a DISK_RECOMPUTE Job. Stages are the unit of progress and of retries
+DISK_RECOMPUTE_BATCH_SIZE = 50
+
+
+def _disk_recompute_batches(parameters: dict):
+    objects = [("flight", uuid) for uuid in parameters["flights"]] + \
+              [("project", uuid) for uuid in parameters["projects"]]
+    return [objects[i:i + DISK_RECOMPUTE_BATCH_SIZE] for i in range(0, len(objects), DISK_RECOMPUTE_BATCH_SIZE)]
+
+
+def _disk_recompute_stages(job: Job):
+    # The stage name has the number of the batch, the batches are fixed when the Job is created
+    return tuple(Stage(f"recompute_disk_space:{i}") for i in range(len(_disk_recompute_batches(job.get_parameters()))))
+
+
+def _run_disk_recompute_stage(parameters: dict, stage_name: str):
+    batch = _disk_recompute_batches(parameters)[int(stage_name.split(":", 1)[1])]
+    recompute_disk_space(
+        list(Flight.objects.filter(uuid__in=[uuid for kind, uuid in batch if kind == "flight"])) +
+        list(UserProject.objects.filter(uuid__in=[uuid for kind, uuid in batch if kind == "project"])))
+
+
+def _finish_disk_recompute(job: Job):
+    # Once per User, after all of their Flights and UserProjects are up to date
+    for user in User.objects.filter(pk__in=job.get_parameters()["users"]):
+        user.update_disk_space()
+
+
+# For every JobType: (function that receives a Job and returns its stages,
+#                     function that receives a Job and returns the run_stage callable for run_dag. Stages run on
+#                     worker processes, so it must be a module-level function with picklable arguments (a partial),
+#                     function called after all stages are done)
+_JOB_DEFINITIONS = {
+    JobType.FLIGHT_POSTPROCESSING.name: (lambda job: FLIGHT_POSTPROCESSING_STAGES,
+                                         lambda job: partial(_run_flight_stage, str(job.flight_id)),
+                                         _finish_flight_postprocessing),
+    JobType.PROJECT_INDICES.name: (_project_indices_stages,
+                                   lambda job: partial(_run_project_indices_stage, job.get_parameters()["indices"]),
+                                   _finish_project_indices),
+    # Creates the indices of the project on its Flights (only linked from the cache if they already exist), then
+    # updates the granules
+    JobType.PROJECT_SYNC.name: (_project_indices_stages,
+                                lambda job: partial(_run_project_indices_stage, job.get_parameters()["indices"]),
+                                _finish_project_sync),
+    JobType.DISK_RECOMPUTE.name: (_disk_recompute_stages,
+                                  lambda job: partial(_run_disk_recompute_stage, job.get_parameters()),
+                                  _finish_disk_recompute),
+    JobType.FLIGHT_OUTPUTS.name: (_flight_outputs_stages,
+                                  lambda job: partial(_run_flight_outputs_stage, str(job.flight_id)),
+                                  _finish_flight_postprocessing),
+    JobType.PNG_ORTHO.name: (lambda job: (Stage("create_png_ortho"),),
+                             lambda job: partial(_run_flight_stage, str(job.flight_id)),
+                             _finish_flight_postprocessing),
+}
+
+
+def enqueue(job_type: JobType, **kwargs) -> Job:
+    """
+    Creates a Job and all of its stages, ready to be picked up by a worker
+    Args:
+        job_type: The type of the Job to be created
+        **kwargs: Extra fields for the Job (e.g. flight=some_flight)
+
+    Returns: The queued Job
+    """
+    with transaction.atomic():
+        job = Job.objects.create(type=job_type.name, **kwargs)
+        stages = topological_order(_JOB_DEFINITIONS[job_type.name][0](job))
+        JobStage.objects.bulk_create([JobStage(job=job, name=stage.name, order=i) for i, stage in enumerate(stages)])
+    return job
+
+
+def enqueue_flight_postprocessing(flight: Flight) -> Job:
+    return enqueue(JobType.FLIGHT_POSTPROCESSING, flight=flight)
+
+
+def enqueue_flight_outputs(flight: Flight, outputs) -> Job:
+    """
+    Queues the extraction of optional NodeODM outputs of a Flight (see Flight.fetch_output), unless a Job that
+    extracts the same outputs is already pending
+    Args:
+        flight: The Flight
+        outputs: Iterable of the files or folders of all.zip to be extracted
+
+    Raises:
+        RemoteFileMissing: If the NodeODM task no longer exists, so the outputs can't be extracted
+
+    Returns: The new or pending Job
+    """
+    parameters = {"outputs": sorted(outputs)}
+    job = _pending_flight_job(JobType.FLIGHT_OUTPUTS, flight, parameters)
+    if job is not None:
+        return job
+    flight.check_results_available()
+    return _enqueue_once(JobType.FLIGHT_OUTPUTS, flight, parameters)
+
+
+def enqueue_png_ortho(flight: Flight) -> Job:
+    """
+    Queues the creation of the full resolution PNG orthophoto of a Flight (see Flight.fetch_png_ortho), unless it's
+    already pending
+
+    Returns: The new or pending Job
+    """
+    return _pending_flight_job(JobType.PNG_ORTHO, flight, {}) or _enqueue_once(JobType.PNG_ORTHO, flight, {})
+
+
+def _pending_flight_job(job_type: JobType, flight: Flight, parameters: dict):
+    for job in Job.objects.filter(type=job_type.name, flight=flight,
+                                  state__in=[JobState.QUEUED.name, JobState.RUNNING.name]):
+        if job.get_parameters() == parameters:
+            return job
+    return None
+
+
+def _enqueue_once(job_type: JobType, flight: Flight, parameters: dict) -> Job:
+    with transaction.atomic():
+        # Concurrent requests for the same Job wait here, and then find the Job of the first one
+        Flight.objects.select_for_update().get(pk=flight.pk)
+        return _pending_flight_job(job_type, flight, parameters) or \
+            enqueue(job_type, flight=flight, parameters=json.dumps(parameters) if parameters else "")
+
+
+def enqueue_project_indices(project, indices: dict) -> Job:
+    """
+    Queues the creation of index rasters on every Flight of a Project, and then of their ImageMosaic datastores
+    Args:
+        project: The UserProject
+        indices: Dict from index name to formula (see Flight.create_index_rasters)
+    """
+    return enqueue(JobType.PROJECT_INDICES, project=project, parameters=json.dumps({"indices": indices}))
+
+
+def enqueue_project_sync(project) -> Job:
+    """
+    Queues an update of the layers of a Project after its Flights changed (see UserProject.sync_layers)
+    """
+    # Indices created before their formula was stored can't be created for new Flights
+    indices = {artifact.name: artifact.formula
+               for artifact in project.artifacts.filter(type=ArtifactType.INDEX.name)
+               if artifact.formula or artifact.name in BUILTIN_FORMULAS}
+    return enqueue(JobType.PROJECT_SYNC, project=project, parameters=json.dumps({"indices": indices}))
+
+
+def enqueue_disk_recompute(flights=(), projects=(), users=()) -> Job:
+    """
+    Queues a full rescan of the disk space used by some Flights and UserProjects (see recompute_disk_space), followed
+    by an update of the totals of their Users
+    Args:
+        flights: Iterable of Flights
+        projects: Iterable of UserProjects
+        users: Iterable of extra Users whose totals must be updated
+    """
+    flights, projects = list(flights), list(projects)
+    user_pks = {user.pk for user in users} | {obj.user_id for obj in flights + projects if obj.user_id is not None}
+    return enqueue(JobType.DISK_RECOMPUTE, parameters=json.dumps({"flights": [str(f.uuid) for f in flights],
+                                                                  "projects": [str(p.uuid) for p in projects],
+                                                                  "users": sorted(user_pks)}))
+
+
+def requeue_stale_jobs():
+    """
+    Queues again the Jobs that have been RUNNING for more than JOB_TIMEOUT seconds, since their worker probably died
+    (e.g. it was killed or restarted) without updating them. Jobs that were already attempted JOB_MAX_ATTEMPTS times
+    are marked as failed instead
+
+    Returns: The number of Jobs that were updated
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(state=JobState.RUNNING.name, started__lt=now - timedelta(seconds=settings.JOB_TIMEOUT))
+    failed = stale.filter(attempts__gte=settings.JOB_MAX_ATTEMPTS).update(state=JobState.ERROR.name, finished=now)
+    queued = stale.update(state=JobState.QUEUED.name, run_after=now)
+    if failed or queued:
+        logger.warning("Found %d stale jobs: %d queued again, %d failed", failed + queued, queued, failed)
+    return failed + queued
+
+
+def claim_next_job():
+    """
+    Marks the oldest runnable Job as RUNNING and returns it
+
+    The claim is a conditional UPDATE, so two workers can never get the same Job, even on databases without
+    SELECT ... FOR UPDATE SKIP LOCKED (like SQLite). Stale Jobs are queued again first (see requeue_stale_jobs)
+
+    Returns: The claimed Job, or None if there is nothing to do
+    """
+    requeue_stale_jobs()
+    candidates = Job.objects.filter(state=JobState.QUEUED.name, run_after__lte=timezone.now())
+    for pk in candidates.values_list("pk", flat=True)[:10]:
+        claimed = Job.objects.filter(pk=pk, state=JobState.QUEUED.name).update(state=JobState.RUNNING.name,
+                                                                               started=timezone.now())
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run_job(job: Job) -> bool:
+    """
+    Executes all pending stages of a claimed Job
+
+    Independent stages run in parallel, on up to POSTPROCESSING_PROCESSES processes. Stages that already succeeded on
+    a previous attempt are skipped. If a stage fails, the Job is queued again (after JOB_RETRY_DELAY seconds) until it
+    has been attempted JOB_MAX_ATTEMPTS times. Any other error (e.g. when the Job is completed) is handled the same
+    way, so the Job never stays RUNNING.
+    Args:
+        job: A Job in the RUNNING state
+
+    Returns: True if the Job completed, False otherwise
+    """
+    try:
+        return _run_job(job)
+    except Exception:
+        # Not a failure of a stage (those are handled by run_dag), but of on_complete or of the bookkeeping. The Job
+        # must not stay RUNNING
+        logger.exception("Job %d failed", job.pk)
+        _fail_attempt(job)
+        return False
+
+
+def _run_job(job: Job) -> bool:
+    job.attempts += 1
+    job.save(update_fields=["attempts"])
+    get_stages, make_runner, on_complete = _JOB_DEFINITIONS[job.type]
+    stages = get_stages(job)
+    job_stages = {stage.name: stage for stage in job.stages.all()}
+    # Jobs enqueued before a new stage was added to the pipeline
+    for i, stage in enumerate(topological_order(stages)):
+        if stage.name not in job_stages:
+            job_stages[stage.name] = JobStage.objects.create(job=job, name=stage.name, order=i)
+
+    def on_start(name):
+        stage = job_stages[name]
+        stage.state = JobState.RUNNING.name
+        stage.started = timezone.now()
+        stage.attempts += 1
+        stage.save(update_fields=["state", "started", "attempts"])
+
+    def on_finish(name, duration, error):
+        stage = job_stages[name]
+        stage.state = JobState.ERROR.name if error else JobState.COMPLETE.name
+        stage.duration = duration
+        stage.error = error or ""
+        stage.save(update_fields=["state", "duration", "error"])
+
+    failed = run_dag(stages, make_runner(job), max_workers=settings.POSTPROCESSING_PROCESSES,
+                     completed=[name for name, stage in job_stages.items() if stage.state == JobState.COMPLETE.name],
+                     on_start=on_start, on_finish=on_finish, initializer=_forget_inherited_connections)
+
+    if failed:
+        _fail_attempt(job)
+        return False
+
+    on_complete(job)
+    job.state = JobState.COMPLETE.name
+    job.finished = timezone.now()
+    job.save(update_fields=["state", "finished"])
+    return True
+
+
+# The DB connections of this process, as inherited by the stage processes (see _forget_inherited_connections)
+_inherited_connections = []
+
+
+def _forget_inherited_connections():
+    # Runs on every stage process, which is forked from the worker while it has its DB connections open (on_start
+    # saves the stages). They share the sockets of the worker, so the stage process must neither use nor close them
+    # (closing would end the worker's session too). They are kept referenced, so they are never finalized either
+    # (multiprocessing ends its processes with os._exit), and new connections are opened on demand
+    for alias in connections:
+        _inherited_connections.append(connections[alias])
+        del connections[alias]
+
+
+def _fail_attempt(job: Job):
+    # Queues the Job again after JOB_RETRY_DELAY seconds, unless it was already attempted JOB_MAX_ATTEMPTS times
+    if job.attempts < settings.JOB_MAX_ATTEMPTS:
+        job.state = JobState.QUEUED.name
+        job.run_after = timezone.now() + timedelta(seconds=settings.JOB_RETRY_DELAY)
+    else:
+        job.state = JobState.ERROR.name
+        job.finished = timezone.now()
+    job.save(update_fields=["state", "run_after", "finished"])
+
+
+def run_next_job():
+    """
+    Claims and runs a single Job
+
+    Returns: The Job that was executed, or None if the queue was empty
+    """
+    job = claim_next_job()
+    if job is not None:
+        run_job(job)
+    return job
+
+
+def retry(job: Job):
+    """
+    Queues a failed Job again, keeping the results of the stages that succeeded
+    """
+    job.state = JobState.QUEUED.name
+    job.attempts = 0
+    job.run_after = timezone.now()
+    job.finished = None
+    job.save(update_fields=["state", "attempts", "run_after", "finished"])
@@ -0,0 +1,53 @@
+import logging
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core.jobs import run_next_job
+
+logger = logging.getLogger(__name__)
+
+
+def _work(poll_interval, once):
+    while True:
+        try:
+            job = run_next_job()
+        except Exception:
+            # e.g. the database is unreachable. The worker must survive, and start over with new connections
+            logger.exception("The worker failed to run a job")
+            connections.close_all()
+            time.sleep(poll_interval)
+            continue
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = "Runs the background jobs (e.g. Flight post-processing) that are queued on the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=settings.JOB_WORKER_PROCESSES,
+                            help="Number of worker processes")
+        parser.add_argument("--poll-interval", type=float, default=settings.JOB_POLL_INTERVAL,
+                            help="Seconds to wait before checking an empty queue again")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit when the queue is empty, instead of waiting for new jobs")
+
+    def handle(self, *args, **options):
+        if options["processes"] <= 1:
+            _work(options["poll_interval"], options["once"])
+            return
+
+        # Every worker must open its own DB connection, a forked connection can't be shared
+        connections.close_all()
+        workers = [multiprocessing.Process(target=_work, args=(options["poll_interval"], options["once"]))
+                   for _ in range(options["processes"])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def rename_thumbnail_stage(apps, schema_editor):
+    # try_create_thumbnail was replaced by create_previews, which also creates the small orthophoto. Unfinished jobs
+    # must run it again, even if the thumbnail was already created
+    JobStage = apps.get_model("core", "JobStage")
+    JobStage.objects.filter(name="try_create_thumbnail").exclude(job__state="COMPLETE") \
+        .update(name="create_previews", state="QUEUED")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_job_jobstage'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_thumbnail_stage, migrations.RunPython.noop),
+    ]
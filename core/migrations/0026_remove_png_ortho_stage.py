@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def remove_png_ortho_stage(apps, schema_editor):
+    # The full resolution PNG orthophoto is no longer created by post-processing, but on demand
+    JobStage = apps.get_model("core", "JobStage")
+    JobStage.objects.filter(name="try_create_png_ortho").exclude(job__state="COMPLETE").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0025_rename_thumbnail_stage'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_png_ortho_stage, migrations.RunPython.noop),
+    ]
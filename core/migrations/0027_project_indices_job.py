@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_remove_png_ortho_stage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='parameters',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='project',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='core.UserProject'),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='type',
+            field=models.CharField(choices=[('FLIGHT_POSTPROCESSING', 'Flight post-processing'), ('PROJECT_INDICES', 'Project indices')], max_length=30),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_project_indices_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artifact',
+            name='formula',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='type',
+            field=models.CharField(choices=[('FLIGHT_POSTPROCESSING', 'Flight post-processing'), ('PROJECT_INDICES', 'Project indices'), ('PROJECT_SYNC', 'Project layer sync')], max_length=30),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_artifact_formula'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('mtime', models.BigIntegerField()),
+                ('size', models.BigIntegerField()),
+                ('subdirectories', models.TextField()),
+                ('links', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_directoryusage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='type',
+            field=models.CharField(choices=[('FLIGHT_POSTPROCESSING', 'Flight post-processing'), ('PROJECT_INDICES', 'Project indices'), ('PROJECT_SYNC', 'Project layer sync'), ('DISK_RECOMPUTE', 'Disk space recompute')], max_length=30),
+        ),
+    ]
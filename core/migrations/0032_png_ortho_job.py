@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_flight_outputs_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='type',
+            field=models.CharField(choices=[('FLIGHT_POSTPROCESSING', 'Flight post-processing'), ('PROJECT_INDICES', 'Project indices'), ('PROJECT_SYNC', 'Project layer sync'), ('DISK_RECOMPUTE', 'Disk space recompute'), ('FLIGHT_OUTPUTS', 'Flight outputs extraction'), ('PNG_ORTHO', 'Full resolution PNG orthophoto')], max_length=30),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_png_ortho_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jobstage',
+            name='name',
+            field=models.CharField(max_length=255),
+        ),
+    ]
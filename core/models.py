@@ -1,22 +1,19 @@
+import glob
 import json
 import os
 import re
 import shutil
-import subprocess
+import threading
 from typing import Union
-from zipfile import ZipFile
 
-import matplotlib.pyplot as plt
-import numpy
-
-import pyproj
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.template.loader import render_to_string
+from django.utils import timezone
 from enum import Enum
 import uuid as u
 
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -24,9 +21,10 @@ from PIL import Image, ImageOps
 from weasyprint import HTML
 
 from django.conf import settings
-from core.parser import FormulaParser
-from core.utils.disk_space_tracking import DiskSpaceTrackerMixin, DiskRelationTrackerMixin
-from core.utils.working_dir import cd
+from core.parser import FormulaParser, BUILTIN_FORMULAS
+from core.utils.disk_space_tracking import DiskSpaceTrackerMixin, DiskRelationTrackerMixin, forget_dir
+from core.utils.files import link_or_copy, locked, materialize, remove_materialized
+from core.utils.remote_zip import check_remote_file, extract_remote_zip
 
 
 class UserType(Enum):
@@ -50,7 +48,7 @@ class User(DiskRelationTrackerMixin, AbstractUser):
     image_month_quota = models.PositiveIntegerField(default=3000)
 
     def get_disk_related_models(self):
-        return list(self.flight_set.filter(is_demo=False)) + list(self.user_projects.filter(is_demo=False))
+        return [self.flight_set.filter(is_demo=False), self.user_projects.filter(is_demo=False)]
 
 
 class BaseProject(models.Model):
@@ -89,19 +87,19 @@ class UserProject(DiskSpaceTrackerMixin, BaseProject):
         self._create_mainortho_datastore()
         # For multispectral: repeat for any bands apart from RGB
 
+    @staticmethod
+    def _get_granule_name(flight):
+        # The date is the time dimension of the ImageMosaic (see timeregex.properties)
+        return "ortho_{:04d}{:02d}{:02d}.tif".format(flight.date.year, flight.date.month, flight.date.day)
+
     def _create_mainortho_datastore(self):
         os.makedirs(self.get_disk_path() + "/mainortho")
         # For multispectral: slice GeoTIFF bands 0:2, save on /projects/uuid/mainortho
-        # Otherwise: just copy GeoTIFFs to /projects/uuid/mainortho
+        # Otherwise: just link GeoTIFFs to /projects/uuid/mainortho
         for flight in self.flights.all():
-            # Copy all TIFFs to project folder, rename them
-            ortho_name = "rgb.tif" if flight.camera == Camera.REDEDGE.name else "odm_orthophoto.tif"
-            shutil.copy(flight.get_disk_path() + "/odm_orthophoto/" + ortho_name,
-                        self.get_disk_path() + "/mainortho")
-            os.rename(self.get_disk_path() + "/mainortho/" + ortho_name,
-                      self.get_disk_path() + "/mainortho/" + "ortho_{:04d}{:02d}{:02d}.tif".format(flight.date.year,
-                                                                                                   flight.date.month,
-                                                                                                   flight.date.day))
+            # rgb.tif is the COG version of the orthophoto, for every camera
+            materialize(flight.get_disk_path() + "/odm_orthophoto/rgb.tif",
+                        self.get_disk_path() + "/mainortho/" + self._get_granule_name(flight))
         with open(self.get_disk_path() + "/mainortho/indexer.properties", "w") as f:
             f.write("""TimeAttribute=ingestion
 Schema=*the_geom:Polygon,location:String,ingestion:java.util.Date
@@ -126,18 +124,53 @@ PropertyCollectors=TimestampFileNameExtractorSPI[timeregex](ingestion)""")
                  '"OutputTransparentColor", "#000000" ] } ] } }} ',
             auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
 
+    def _get_layers(self):
+        """
+        Returns: Dict from the name of every ImageMosaic of the project to the raster of each Flight (on its
+            odm_orthophoto folder) that becomes a granule
+        """
+        layers = {"mainortho": "rgb.tif"}
+        for artifact in self.artifacts.filter(type=ArtifactType.INDEX.name):
+            layers[artifact.name] = artifact.name + ".tif"
+        return layers
+
+    def sync_layers(self):
+        """
+        Adds and removes granules of every ImageMosaic of the project (mainortho and the indices) so that they match the
+        current Flights. Only the granules that changed are harvested or removed on GeoServer
+        """
+        GEOSERVER_BASE_URL = "http://container-geoserver:8080/geoserver/rest/workspaces/" + \
+                             self._get_geoserver_ws_name() + "/coveragestores/"
+        for layer, raster_name in self._get_layers().items():
+            folder = self.get_disk_path() + "/" + layer
+            if not os.path.isdir(folder):
+                continue
+            expected = {}
+            for flight in self.flights.all():
+                path = flight.get_disk_path() + "/odm_orthophoto/" + raster_name
+                if os.path.exists(path):  # Indices are only created for multispectral Flights
+                    expected[self._get_granule_name(flight)] = path
+            current = {os.path.basename(path) for path in glob.glob(folder + "/ortho_*.tif")}
+
+            for granule in sorted(current - expected.keys()):
+                remove_materialized(folder + "/" + granule)
+                requests.delete(GEOSERVER_BASE_URL + layer + "/coverages/" + layer + "/index/granules.json",
+                                params={"filter": "location='" + granule + "'"},
+                                auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
+            for granule in sorted(expected.keys() - current):
+                materialize(expected[granule], folder + "/" + granule)
+                # Harvests a single file into the existing ImageMosaic
+                requests.post(GEOSERVER_BASE_URL + layer + "/external.imagemosaic",
+                              headers={"Content-Type": "text/plain"},
+                              data="file:///media/USB/" + str(self.uuid) + "/" + layer + "/" + granule,
+                              auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
+
     def _create_index_datastore(self, index):
         index_folder = self.get_disk_path() + "/" + index
-        os.makedirs(index_folder)
+        os.makedirs(index_folder, exist_ok=True)  # The Job that creates it may be retried
         for flight in self.flights.all():
-            # Copy all TIFFs to project folder, rename them
-            ortho_name = index + ".tif"
-            shutil.copy(flight.get_disk_path() + "/odm_orthophoto/" + ortho_name,
-                        index_folder)
-            os.rename(index_folder + "/" + ortho_name,
-                      index_folder + "/" + "ortho_{:04d}{:02d}{:02d}.tif".format(flight.date.year,
-                                                                                 flight.date.month,
-                                                                                 flight.date.day))
+            materialize(flight.get_disk_path() + "/odm_orthophoto/" + index + ".tif",
+                        index_folder + "/" + self._get_granule_name(flight))
         with open(index_folder + "/indexer.properties", "w") as f:
             f.write("""TimeAttribute=ingestion
         Schema=*the_geom:Polygon,location:String,ingestion:java.util.Date
@@ -183,6 +216,19 @@ class FlightState(Enum):
     ERROR = "Error"
 
 
+class OutputPending(Exception):
+    """
+    Raised when a file of a Flight is requested while a Job creates it (see Flight.fetch_output)
+
+    Attributes:
+        job: The Job that creates the file
+    """
+
+    def __init__(self, job):
+        super().__init__(f"Job {job.pk} is creating the file")
+        self.job = job
+
+
 class Flight(DiskSpaceTrackerMixin, models.Model):
     uuid = models.UUIDField(primary_key=True, default=u.uuid4, editable=False)
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
@@ -223,9 +269,15 @@ class Flight(DiskSpaceTrackerMixin, models.Model):
     def get_small_ortho_path(self, extension="png"):
         return f"{self.get_disk_path()}/odm_orthophoto/odm_orthophoto_small.{extension}"
 
+    def get_preview_path(self, height: int):
+        return f"{self.get_disk_path()}/odm_orthophoto/odm_orthophoto_{height}.png"
+
     def get_png_ortho_path(self):
         return self.get_disk_path() + "/odm_orthophoto/odm_orthophoto.png"
 
+    def get_render_path(self, size: int, extension: str):
+        return f"{self.get_disk_path()}/odm_orthophoto/renders/odm_orthophoto_{size}.{extension}"
+
     @property
     def orig_dsm_path(self):
         return self.get_disk_path() + "/odm_dem/dsm.tif"
@@ -237,159 +289,253 @@ class Flight(DiskSpaceTrackerMixin, models.Model):
     def get_annotated_png_ortho_path(self):
         return self.get_disk_path() + "/odm_orthophoto/odm_orthophoto_annotated.png"
 
+    def get_camera_positions_path(self):
+        return self.get_disk_path() + "/odm_orthophoto/camera_positions.json"
+
     def _get_geoserver_ws_name(self):
         return "flight_" + str(self.uuid)
 
-    def download_and_decompress_results(self):
+    def _get_results_url(self):
+        return f"{settings.NODEODM_SERVER_URL}/task/{str(self.uuid)}/download/all.zip?token={settings.NODEODM_SERVER_TOKEN}"
+
+    def download_and_decompress_results(self, include=None):
+        """
+        Extracts the NodeODM results on the Flight folder, reading all.zip directly from NodeODM
+
+        Args:
+            include: Optional iterable of the files or folders of all.zip to be extracted.
+                By default, the ones on the ODM_REQUIRED_OUTPUTS setting
+        """
+        if include is None:
+            include = settings.ODM_REQUIRED_OUTPUTS
         try:
             os.mkdir(self.get_disk_path())
         except FileExistsError:
             pass  # just ignore it and continue as you were
-        zip_url = f"{settings.NODEODM_SERVER_URL}/task/{str(self.uuid)}/download/all.zip?token={settings.NODEODM_SERVER_TOKEN}"
-        zip_local_name = f"./tmp/{str(self.uuid)}.zip"
-        # https://stackoverflow.com/a/16696317
-        with requests.get(zip_url) as r:
-            r.raise_for_status()
-            with open(zip_local_name, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-
-        with ZipFile(zip_local_name, 'r') as zip:
-            zip.extractall(path=self.get_disk_path())
-        os.remove(zip_local_name)
+        # all.zip is only stored on ./tmp if NodeODM doesn't support range requests
+        extract_remote_zip(self._get_results_url(), self.get_disk_path(), include=include,
+                           fallback_path=f"./tmp/{str(self.uuid)}.zip")
+
+    def check_results_available(self):
+        """
+        Raises RemoteFileMissing if the NodeODM results can't be extracted anymore (e.g. the task was removed)
+        """
+        check_remote_file(self._get_results_url())
+
+    def fetch_output(self, output: str):
+        """
+        Returns the path of a NodeODM output
+
+        Optional outputs (see ODM_OPTIONAL_OUTPUTS) are extracted the first time they are requested, by a FLIGHT_OUTPUTS
+        Job, since some of them (e.g. the textured model) take minutes
+
+        Args:
+            output: A path relative to the Flight folder (e.g. odm_meshing/odm_mesh.ply)
+
+        Raises:
+            OutputPending: Until the Job is done
+            RemoteFileMissing: If the output must be extracted, but the NodeODM task no longer exists
+        """
+        path = self.get_disk_path() + "/" + output
+        if os.path.exists(path):
+            return path
+        # odm_texturing/odm_textured_model.obj requires the whole odm_texturing folder
+        lazy_outputs = [optional for optional in settings.ODM_OPTIONAL_OUTPUTS
+                        if output == optional or output.startswith(optional.rstrip("/") + "/")]
+        if not lazy_outputs:
+            return path
+        from core.jobs import enqueue_flight_outputs
+        raise OutputPending(enqueue_flight_outputs(self, lazy_outputs))
+
+    def extract_output(self, output: str):
+        """
+        Extracts an optional NodeODM output (see fetch_output). Each output is extracted by one process at a time
+        """
+        os.makedirs(self.get_disk_path(), exist_ok=True)
+        with locked(f"{self.get_disk_path()}/.{output.strip('/').replace('/', '_')}.lock"):
+            # Whatever was extracted while waiting for the lock is skipped, see extract_zip
+            self.download_and_decompress_results(include=[output])
 
     @staticmethod
     def tiff_to_png(tiff: str, png: str):
+        from core.utils import raster
         assert tiff.endswith(".tif"), f"Input file {tiff} must be a TIFF file!"
         assert png.endswith(".png"), f"Output file {png} must be a PNG file!"
         assert tiff.startswith("/"), f"Input filename {tiff} must be an absolute path"
         assert png.startswith("/"), f"Output filename {png} must be an absolute path"
 
-        cmd = f"gdal_translate {tiff} {png}"
-        os.system(cmd)
+        raster.to_png(tiff, png)
 
     def create_rgb_tiff(self):
-        with cd(f"{self.get_disk_path()}/odm_orthophoto/"):
-
-            if self.camera == Camera.RGB.name:
-                cmd = f'gdal_translate -b 1 -b 2 -b 3 -b mask odm_orthophoto.tif rgb.tif -scale 0 255 -ot Byte -co "TILED=YES"'
-            elif self.camera == Camera.REDEDGE.name:
-                cmd = f'gdal_translate -b 3 -b 2 -b 1 -b mask odm_orthophoto.tif rgb.tif -scale 0 65535 -ot Byte -co "TILED=YES"'
-            else:
-                cmd = ""  # should never happen!
-            os.system(cmd)
-
-    def _create_orthomosaic(self, height, out_name):
-        cmd = f"gdal_translate -outsize 0 {height} {self.get_disk_path()}/odm_orthophoto/rgb.tif {out_name}"
-        os.system(cmd)
-
-    def try_create_thumbnail(self):
-        self._create_orthomosaic(512, self.get_thumbnail_path())
-
-    def try_create_png_ortho(self):
+        from core.utils import raster
+        ortho_folder = f"{self.get_disk_path()}/odm_orthophoto/"
+
+        if self.camera == Camera.RGB.name:
+            bands, max_value = (1, 2, 3), 255
+        elif self.camera == Camera.REDEDGE.name:
+            bands, max_value = (3, 2, 1), 65535
+        else:
+            return  # should never happen!
+        raster.extract_bands(ortho_folder + "odm_orthophoto.tif", ortho_folder + "rgb.tif", bands, max_value,
+                             compression=settings.COG_RGB_COMPRESSION, quality=settings.COG_JPEG_QUALITY)
+
+    def create_previews(self):
+        """
+        Writes the thumbnail (512 px high), the small orthophoto (1080 px, as GeoTIFF and PNG) and a PNG for every
+        height on PREVIEW_SIZES, all of them from the overviews of rgb.tif
+        """
+        from core.utils import raster
+        previews = {512: [self.get_thumbnail_path()],
+                    1080: [self.get_small_ortho_path(extension="tif"), self.get_small_ortho_path(extension="png")]}
+        for height in settings.PREVIEW_SIZES:
+            previews.setdefault(height, []).append(self.get_preview_path(height))
+        raster.create_previews(f"{self.get_disk_path()}/odm_orthophoto/rgb.tif", previews)
+
+    def fetch_png_ortho(self):
+        """
+        Returns the path of the full resolution PNG orthophoto. It's created by a PNG_ORTHO Job the first time it's
+        requested, since encoding it takes minutes on big Flights (OutputPending is raised until the Job is done).
+        For viewing the orthophoto, see render_ortho (or the GeoServer layer)
+        """
+        path = self.get_png_ortho_path()
+        if os.path.exists(path) or not os.path.exists(f"{self.get_disk_path()}/odm_orthophoto/rgb.tif"):
+            return path
+        from core.jobs import enqueue_png_ortho
+        raise OutputPending(enqueue_png_ortho(self))
+
+    def create_png_ortho(self):
         self.tiff_to_png(f"{self.get_disk_path()}/odm_orthophoto/rgb.tif", self.get_png_ortho_path())
 
+    def render_ortho(self, size: int, extension: str):
+        """
+        Returns the path of an image of the orthophoto that fits in size x size pixels, rendering it from the
+        overviews of rgb.tif the first time it's requested
+
+        Args:
+            size: Maximum width and height. Rounded up to a multiple of 256 (at least 256) and capped at
+                RENDER_MAX_SIZE, so that only a few renders are ever cached
+            extension: "jpg" or "webp"
+        """
+        from core.utils import raster
+        size = min(max(-(-size // 256) * 256, 256), settings.RENDER_MAX_SIZE)
+        path = self.get_render_path(size, extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            raster.render(f"{self.get_disk_path()}/odm_orthophoto/rgb.tif", path, size,
+                          driver={"jpg": "JPEG", "webp": "WEBP"}[extension])
+        return path
+
     def try_create_png_dsm(self):
         self.tiff_to_png(self.get_dsm_path(extension="tif"), self.get_dsm_path(extension="png"))
 
     def create_colored_dsm(self):
-        cmd1 = 'gdaldem color-relief {} ./core/utils/color_relief.txt "{}" -alpha -co ALPHA=YES'.format(
-            self.orig_dsm_path, self.get_dsm_path(extension="tif", hillshade=False))
-        os.system(cmd1)
-        cmd2 = 'gdaldem hillshade {} {} -z 1.0 -s 1.0 -az 315.0 -alt 45.0'.format(
-            self.orig_dsm_path, self.get_dsm_path(extension="tif", colored=False))
-        os.system(cmd2)
-        cmd3 = 'python3 ./core/utils/hsv_merge.py {} {} {}'.format(
-            self.get_dsm_path(extension="tif", colored=True, hillshade=False),
-            self.get_dsm_path(extension="tif", colored=False, hillshade=True),
-            self.get_dsm_path(extension="tif"),
-        )
-        os.system(cmd3)
+        from core.utils import raster
+        from core.utils.shaded_relief import render_shaded_relief
+        keep = settings.KEEP_DSM_INTERMEDIATES
+        render_shaded_relief(self.orig_dsm_path, self.get_dsm_path(extension="tif"), "./core/utils/color_relief.txt",
+                             z=1.0, scale=1.0, azimuth=315.0, altitude=45.0,
+                             color_path=self.get_dsm_path(extension="tif", hillshade=False) if keep else None,
+                             hillshade_path=self.get_dsm_path(extension="tif", colored=False) if keep else None)
+        raster.convert_to_cog(self.get_dsm_path(extension="tif"), settings.COG_COMPRESSION)
 
     def try_create_dsm_colorbar(self):
+        from core.utils import raster
         from core.utils.colorbar_creator import create_colorbar
-        result = subprocess.run(['gdalinfo', '-mm', 'dsm.tif'], stdout=subprocess.PIPE,
-                                cwd=self.get_disk_path() + "/odm_dem/").stdout.decode("utf-8")
-        min_val, max_val = re.search(r"Computed Min/Max=(-?\d+\.\d+),(-?\d+\.\d+)", result).groups()
-        min_val = "{:.1f} m".format(float(min_val))
-        max_val = "{:.1f} m".format(float(max_val))
+        min_val, max_val = raster.min_max(self.orig_dsm_path)
+        min_val = "{:.1f} m".format(min_val)
+        max_val = "{:.1f} m".format(max_val)
         create_colorbar(min_val, max_val, save_path=self.get_disk_path() + "/odm_dem/colorbar.png")
 
-    def try_create_annotated_png_ortho(self):
-        self._create_orthomosaic(1080, self.get_small_ortho_path(extension="tif"))
-        self.tiff_to_png(self.get_small_ortho_path(extension="tif"), self.get_small_ortho_path(extension="png"))
-
-        result = subprocess.run(
-            ['gdalinfo', '-proj4', self.get_small_ortho_path(extension="tif")],
-            stdout=subprocess.PIPE).stdout.decode("utf-8")
-        local_proj = re.search(r"PROJ\.4 string is:[\r\n]+'([^\r\n']+)'", result).groups()[0]
-        offs_x, offs_y = re.search(r"Origin = \((-?\d+\.\d+),(-?\d+\.\d+)\)", result).groups()
-        ps_x, ps_y = re.search(r"Pixel Size = \((-?\d+\.\d+),(-?\d+\.\d+)\)", result).groups()
-        transformer = pyproj.Transformer.from_crs("epsg:4326", local_proj)
+    def create_camera_positions(self):
+        """
+        Projects the position of every image (from images.json) to the CRS of the orthophoto and to the pixels of the
+        small orthophoto, and saves them as camera_positions.json:
+        [{"filename", "latitude", "longitude", "x", "y", "pixel_x", "pixel_y"}, ...]
+        """
+        from core.utils import geo, raster
+        small_ortho = raster.info(self.get_small_ortho_path(extension="tif"))
         with open(self.get_disk_path() + "/images.json") as f:
             images = json.loads(f.read())
-        image_coords = {}
-        for image in images:
-            coord_x, coord_y = transformer.transform(image["latitude"], image["longitude"])
-            pixel_x = int((coord_x - float(offs_x)) / float(ps_x))
-            pixel_y = int((coord_y - float(offs_y)) / float(ps_y))
-            image_coords[image["filename"]] = (pixel_x, pixel_y)
-        im = plt.imread(self.get_small_ortho_path(extension="png"))
-        fig = plt.figure()
-        plt.axis('off')
-        plt.imshow(im, zorder=1)
-        for image_name, (x, y) in image_coords.items():
-            plt.scatter(x, y, zorder=2, color="r")
-            # Uncomment below to show arrows on images
-            # plt.arrow(x, y, 300, 300, color="r", head_length=100,head_width=80, zorder=2)
-
-        def fig2data(fig):
-            """
-            @brief Convert a Matplotlib figure to a 4D numpy array with RGBA channels and return it
-            @param fig a matplotlib figure
-            @return a numpy 3D array of RGBA values
-            """
-            # draw the renderer
-            fig.canvas.draw()
-
-            # Get the RGBA buffer from the figure
-            data = numpy.fromstring(fig.canvas.tostring_rgb(), dtype=numpy.uint8, sep='')
-            return data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-
-        plt.imsave(self.get_disk_path() + "/odm_orthophoto/odm_orthophoto_annotated.png", fig2data(fig))
+        xs, ys = geo.transform([image["longitude"] for image in images], [image["latitude"] for image in images],
+                               geo.WGS84, small_ortho.projection)
+        pixels_x, pixels_y = geo.to_pixels(xs, ys, small_ortho.geotransform)
+        positions = [{"filename": image["filename"], "latitude": image["latitude"], "longitude": image["longitude"],
+                      "x": x, "y": y, "pixel_x": int(pixel_x), "pixel_y": int(pixel_y)}
+                     for image, x, y, pixel_x, pixel_y in zip(images, xs.tolist(), ys.tolist(), pixels_x, pixels_y)]
+        with open(self.get_camera_positions_path(), "w") as f:
+            json.dump(positions, f)
+
+    def try_create_annotated_png_ortho(self):
+        from core.utils.markers import annotate_image
+        with open(self.get_camera_positions_path()) as f:
+            positions = json.load(f)
+        annotate_image(self.get_small_ortho_path(extension="png"), [p["pixel_x"] for p in positions],
+                       [p["pixel_y"] for p in positions], self.get_annotated_png_ortho_path())
 
     def create_index_raster(self, index: str, formula: str):
-        COMMANDS = {
-            "ndvi": 'gdal_calc.py -A odm_orthophoto.tif --A_band=3 -B odm_orthophoto.tif --B_band=4 --calc="((asarray(B,dtype=float32)-asarray(A, dtype=float32))/(asarray(B, dtype=float32)+asarray(A, dtype=float32)) + 1.) * 127." --outfile=ndvi.tif --type=Byte --co="TILED=YES" --overwrite --NoDataValue=-1',
-            "ndre": 'gdal_calc.py -A odm_orthophoto.tif --A_band=5 -B odm_orthophoto.tif --B_band=4 --calc="((asarray(B,dtype=float32)-asarray(A, dtype=float32))/(asarray(B, dtype=float32)+asarray(A, dtype=float32)) + 1.) * 127." --outfile=ndre.tif --type=Byte --co="TILED=YES" --overwrite --NoDataValue=-1'}
+        self.create_index_rasters({index: formula})
+
+    def get_index_cache_path(self, formula_hash: str):
+        return f"{self.get_disk_path()}/odm_orthophoto/index_cache/{formula_hash}.tif"
+
+    def create_index_rasters(self, indices: dict):
+        """
+        Creates several index rasters (<index>.tif on odm_orthophoto) reading the multispectral orthophoto only once
+
+        Rasters are cached by formula (see FormulaParser.formula_hash), so a formula that was already computed for this
+        Flight, under any index name, is linked instead of computed again.
+
+        Args:
+            indices: Dict from index name to formula. The formulas of NDVI and NDRE are built-in, so they are ignored
+        """
         if self.state != FlightState.COMPLETE.name or self.camera != Camera.REDEDGE.name:
             return
 
-        with cd(self.get_disk_path() + "/odm_orthophoto/"):
-            # NDVI and NDRE are built-in, anything else gets parsed
-            command = COMMANDS.get(index, None) or FormulaParser().generate_gdal_calc_command(formula, index)
-            os.system(command)  # Create raster, save it to <index>.tif on folder <flight_uuid>/odm_orthophoto
+        from core.utils import raster, raster_calc
+        ortho_folder = self.get_disk_path() + "/odm_orthophoto/"
+        parser = FormulaParser()
+        formulas = {index: BUILTIN_FORMULAS.get(index) or formula for index, formula in indices.items()}
+        cached = {index: self.get_index_cache_path(parser.formula_hash(formula)) for index, formula in formulas.items()}
+        # Rasters are computed on partial files and renamed when complete, so the cache never has partial rasters.
+        # Their names are unique for every process and thread, since other Jobs may be computing the same formula
+        suffix = f".{os.getpid()}.{threading.get_ident()}.part.tif"
+        missing = {cached[index][:-len(".tif")] + suffix: parser.compile(formula)
+                   for index, formula in formulas.items() if not os.path.exists(cached[index])}
+        if missing:
+            os.makedirs(os.path.dirname(self.get_index_cache_path("")), exist_ok=True)
+            try:
+                raster_calc.calculate_many(ortho_folder + "odm_orthophoto.tif", missing)
+                for part in missing:
+                    raster.convert_to_cog(part, settings.COG_COMPRESSION)
+                    os.replace(part, part[:-len(suffix)] + ".tif")
+            finally:
+                for part in missing:
+                    if os.path.exists(part):
+                        os.remove(part)
+        for index, path in cached.items():
+            link_or_copy(path, f"{ortho_folder}{index}.tif")
 
     def create_geoserver_workspace_and_upload_geotiff(self):
         requests.post("http://container-geoserver:8080/geoserver/rest/workspaces",
                       headers={"Content-Type": "application/json"},
                       data='{"workspace": {"name": "' + self._get_geoserver_ws_name() + '"}}',
                       auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
-        using_micasense = self.camera == Camera.REDEDGE.name
-        geotiff_name = "odm_orthophoto.tif" if not using_micasense else "rgb.tif"
+        # rgb.tif is a COG for every camera (see create_rgb_tiff)
         requests.put(
             "http://container-geoserver:8080/geoserver/rest/workspaces/" + self._get_geoserver_ws_name() + "/coveragestores/ortho/external.geotiff",
             headers={"Content-Type": "text/plain"},
-            data="file:///media/input/" + str(self.uuid) + "/odm_orthophoto/" + geotiff_name,
+            data="file:///media/input/" + str(self.uuid) + "/odm_orthophoto/rgb.tif",
+            auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
+        parameters = [{"string": ["SUGGESTED_TILE_SIZE", "512,512"]}]
+        if self.camera == Camera.REDEDGE.name:  # Configure transparent color on black
+            parameters.insert(0, {"string": ["InputTransparentColor", "#000000"]})
+        # Change name to odm_orthophoto, like the coverage of the original ODM orthophoto
+        requests.put(
+            "http://container-geoserver:8080/geoserver/rest/workspaces/" + self._get_geoserver_ws_name() + "/coveragestores/ortho/coverages/rgb.json",
+            headers={"Content-Type": "application/json"},
+            data=json.dumps({"coverage": {"name": "odm_orthophoto", "title": "odm_orthophoto", "enabled": True,
+                                          "parameters": {"entry": parameters}}}),
             auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
-        if using_micasense:  # Change name to odm_orthomosaic and configure transparent color on black
-            requests.put(
-                "http://container-geoserver:8080/geoserver/rest/workspaces/" + self._get_geoserver_ws_name() + "/coveragestores/ortho/coverages/rgb.json",
-                headers={"Content-Type": "application/json"},
-                data='{"coverage": {"name": "odm_orthophoto", "title": "odm_orthophoto", "enabled": true, ' +
-                     '"parameters": { "entry": [ { "string": [ "InputTransparentColor", "#000000" ] }, ' +
-                     '{ "string": [ "SUGGESTED_TILE_SIZE", "512,512" ] } ] }}} ',
-                auth=HTTPBasicAuth('admin', settings.GEOSERVER_PASSWORD))
 
     def create_report(self, context):
         report = render_to_string('reports/report.html', {"flight": self, "extras": context})
@@ -456,9 +602,45 @@ def delete_on_disk(sender, instance: Union[Flight, UserProject], **kwargs):
         shutil.rmtree(instance.get_disk_path())
     except FileNotFoundError:
         pass  # no need to do anything, carry on
+    forget_dir(instance.get_disk_path())
     instance.user.update_disk_space()
 
 
+def sync_project_layers(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # flight.user_projects.clear() doesn't tell which projects were affected, so they are found out before
+        instance._projects_to_sync = list(instance.user_projects.all())
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        projects = [instance]
+    elif pk_set:  # Projects added to or removed from a Flight
+        projects = UserProject.objects.filter(pk__in=pk_set)
+    else:
+        projects = instance.__dict__.pop("_projects_to_sync", [])
+    _enqueue_project_syncs(projects)
+
+
+def _enqueue_project_syncs(projects):
+    from core.jobs import enqueue_project_sync
+    for project in projects:
+        # The layers of new projects are created from scratch, see _create_geoserver_proj_workspace
+        if os.path.isdir(project.get_disk_path() + "/mainortho"):
+            enqueue_project_sync(project)
+
+
+def remember_flight_projects(sender, instance: Flight, **kwargs):
+    # Deleting a Flight removes it from its projects without sending m2m_changed
+    instance._projects_to_sync = [project.pk for project in instance.user_projects.all()]
+
+
+def sync_projects_of_deleted_flight(sender, instance: Flight, **kwargs):
+    pks = instance.__dict__.pop("_projects_to_sync", [])
+    # After the deletion is committed, since the projects may be deleted too (e.g. along with their User)
+    transaction.on_commit(lambda: _enqueue_project_syncs(UserProject.objects.filter(pk__in=pks)))
+
+
 def delete_thumbnail(sender, instance: Flight, **kwargs):
     if os.path.exists(instance.get_thumbnail_path()):
         os.remove(instance.get_thumbnail_path())
@@ -471,6 +653,9 @@ post_delete.connect(delete_geoserver_workspace, sender=Flight)
 post_delete.connect(delete_geoserver_workspace, sender=UserProject)
 post_delete.connect(delete_on_disk, sender=Flight)
 post_delete.connect(delete_on_disk, sender=UserProject)
+pre_delete.connect(remember_flight_projects, sender=Flight)
+post_delete.connect(sync_projects_of_deleted_flight, sender=Flight)
+m2m_changed.connect(sync_project_layers, sender=UserProject.flights.through)
 
 
 class ArtifactType(Enum):
@@ -491,6 +676,7 @@ class Artifact(models.Model):
     name = models.CharField(max_length=256)
     title = models.CharField(max_length=256)
     project = models.ForeignKey(UserProject, on_delete=models.CASCADE, related_name="artifacts", null=True)
+    formula = models.TextField(blank=True)  # Only for indices, so they can be created for Flights added later
 
     def get_disk_path(self):
         return self.project.get_disk_path() + "/" + self.name + "/" + ArtifactType.filename(self)
@@ -507,3 +693,80 @@ class BlockCriteria(models.Model):
     type = models.CharField(max_length=20, choices=[(tag.name, tag.value) for tag in BlockType])
     ip = models.GenericIPAddressField(max_length=256, null=True)
     value = models.CharField(max_length=80, null=True)
+
+
+class DirectoryUsage(models.Model):
+    """
+    Cached disk usage of a single directory, not including its subdirectories (see
+    core.utils.disk_space_tracking.cached_size_of_dir)
+    """
+    path = models.CharField(max_length=255, unique=True)
+    mtime = models.BigIntegerField()  # st_mtime_ns of the directory when it was scanned, -1 if it must be scanned again
+    size = models.BigIntegerField()  # in bytes, the directory itself plus its files
+    subdirectories = models.TextField()  # JSON list of paths
+    links = models.TextField()  # JSON list of [st_dev, st_ino, size] of the files with several hardlinks
+
+
+class JobType(Enum):
+    FLIGHT_POSTPROCESSING = "Flight post-processing"
+    PROJECT_INDICES = "Project indices"
+    PROJECT_SYNC = "Project layer sync"
+    DISK_RECOMPUTE = "Disk space recompute"
+    FLIGHT_OUTPUTS = "Flight outputs extraction"
+    PNG_ORTHO = "Full resolution PNG orthophoto"
+
+
+class JobState(Enum):
+    QUEUED = "Queued"
+    RUNNING = "Running"
+    COMPLETE = "Complete"
+    ERROR = "Error"
+
+
+class Job(models.Model):
+    """
+    A unit of background work, stored on the database and executed by the `runworker` command (see core/jobs.py)
+    """
+    type = models.CharField(max_length=30, choices=[(tag.name, tag.value) for tag in JobType])
+    state = models.CharField(max_length=10,
+                             choices=[(tag.name, tag.value) for tag in JobState],
+                             default=JobState.QUEUED.name)
+    flight = models.ForeignKey(Flight, null=True, blank=True, on_delete=models.CASCADE, related_name="jobs")
+    project = models.ForeignKey(UserProject, null=True, blank=True, on_delete=models.CASCADE, related_name="jobs")
+    parameters = models.TextField(blank=True)  # JSON, its contents depend on the type
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created"]
+
+    def get_parameters(self):
+        return json.loads(self.parameters or "{}")
+
+    def progress(self):
+        """
+        Returns: The fraction of stages that are complete, between 0 and 1
+        """
+        if self.state == JobState.COMPLETE.name:
+            return 1.0
+        states = [stage.state for stage in self.stages.all()]
+        return states.count(JobState.COMPLETE.name) / len(states) if states else 0.0
+
+
+class JobStage(models.Model):
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="stages")
+    name = models.CharField(max_length=255)  # may have a parameter, e.g. extract_output:<path of the output>
+    order = models.PositiveIntegerField()
+    state = models.CharField(max_length=10,
+                             choices=[(tag.name, tag.value) for tag in JobState],
+                             default=JobState.QUEUED.name)
+    attempts = models.PositiveIntegerField(default=0)
+    started = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(default=0)  # in seconds
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ["order"]
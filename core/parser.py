@@ -1,8 +1,18 @@
+import hashlib
+from functools import lru_cache
+
 from lark import Lark, Transformer, LarkError
 
+from core.utils.raster_calc import CompiledFormula
 
-class FormulaParser:
-    grammar = """start: term (FACTOR_OP term)*
+# The built-in indices, scaled from [-1, 1] to [0, 254]
+BUILTIN_FORMULAS = {
+    "ndvi": "((nir-red)/(nir+red)+1)*127",
+    "ndre": "((nir-rdedge)/(nir+rdedge)+1)*127",
+}
+
+
+GRAMMAR = """start: term (FACTOR_OP term)*
 term: factor (TERM_OP factor)*
 factor: (FACTOR_OP factor) -> plusminus
       | atom 
@@ -19,11 +29,37 @@ TERM_OP: "*" | "/"
 %ignore WS
     """
 
+
+# Analyzing the grammar is much slower than parsing a formula, so it's done once per process
+_PARSER = Lark(GRAMMAR, parser="lalr")
+
+
+@lru_cache(maxsize=1024)
+def _parse(formula):
+    return _PARSER.parse(formula)
+
+
+@lru_cache(maxsize=1024)
+def _expression(formula):
+    return FormulaCompiler().transform(_parse(formula))
+
+
+@lru_cache(maxsize=1024)
+def _make_string(formula):
+    return FormulaTransformer().transform(_parse(formula))
+
+
+class FormulaParser:
+    """
+    Parses index formulas. Instances are cheap: they share the parser, and parsed formulas are cached
+    """
+    grammar = GRAMMAR
+
     def __init__(self):
-        self.parser = Lark(self.grammar)
+        self.parser = _PARSER
 
     def _parse(self, formula):
-        return self.parser.parse(formula)
+        return _parse(formula)
 
     def is_valid(self, formula):
         try:
@@ -33,14 +69,36 @@ TERM_OP: "*" | "/"
             return False
 
     def make_string(self, formula):
-        return FormulaTransformer().transform(self._parse(formula))
-
-    def generate_gdal_calc_command(self, formula: str, index_name: str):
-        return 'gdal_calc.py -A odm_orthophoto.tif --A_band=1 -B odm_orthophoto.tif --B_band=2 ' \
-               '-C odm_orthophoto.tif --C_band=3 -D odm_orthophoto.tif --D_band=4 -E odm_orthophoto.tif --E_band=5 ' \
-               '--calc="{}" ' \
-               '--outfile={}.tif --type=Byte --co="TILED=YES" --overwrite --NoDataValue=0'.format(
-                self.make_string(formula), index_name)
+        return _make_string(formula)
+
+    def compile(self, formula) -> CompiledFormula:
+        return CompiledFormula(_expression(formula))
+
+    def normalize(self, formula) -> str:
+        """
+        Returns a canonical form of the formula: spacing, redundant parentheses and the order of the operands of + and *
+        don't matter, so "(nir + red)" and "red+nir" have the same canonical form
+        """
+        return _canonical(_expression(formula))
+
+    def formula_hash(self, formula) -> str:
+        """
+        Returns a stable identifier of the formula, the same for every formula with the same canonical form
+        """
+        return hashlib.sha256(self.normalize(formula).encode("utf-8")).hexdigest()[:16]
+
+
+def _canonical(node):
+    if node[0] == "band":
+        return node[1]
+    if node[0] == "number":
+        return repr(float(node[1]))
+    if node[0] == "neg":
+        return "(-" + _canonical(node[1]) + ")"
+    operands = [_canonical(child) for child in node[1:]]
+    if node[0] in ("+", "*"):  # Commutative, and exactly so on floating point too
+        operands.sort()
+    return "(" + node[0].join(operands) + ")"
 
 
 class FormulaTransformer(Transformer):
@@ -76,3 +134,40 @@ class FormulaTransformer(Transformer):
 
     def NUMBER(self, number):
         return str(float(number))
+
+
+class FormulaCompiler(Transformer):
+    """
+    Transforms the parse tree into an expression tree for CompiledFormula
+    """
+
+    def _chain(self, items):
+        # Operators of the same precedence are left-associative: a-b+c is (a-b)+c
+        result = items[0]
+        for operator, operand in zip(items[1::2], items[2::2]):
+            result = (str(operator), result, operand)
+        return result
+
+    start = _chain
+    term = _chain
+
+    def plusminus(self, items):
+        return items[1] if items[0] == "+" else ("neg", items[1])
+
+    def factor(self, items):
+        return items[0]
+
+    def power(self, items):
+        return "**", items[0], items[1]
+
+    def parens(self, items):
+        return items[0]
+
+    def atom(self, items):
+        return items[0]
+
+    def NAME(self, name):
+        return "band", str(name)
+
+    def NUMBER(self, number):
+        return "number", float(number)
@@ -0,0 +1,254 @@
+from datetime import timedelta
+from typing import List
+
+import pytest
+from django.utils import timezone
+
+from core import jobs
+from core.jobs import FLIGHT_POSTPROCESSING_STAGES, claim_next_job, enqueue_disk_recompute, \
+    enqueue_flight_postprocessing, enqueue_project_indices, requeue_stale_jobs, retry, run_next_job
+from core.models import DirectoryUsage, Flight, FlightState, Job, JobState, JobType, User, UserProject
+from core.management.commands import runworker
+from core.test_viewsets import FlightsMixin, BaseTestViewSet
+from core.utils.dag import topological_order
+
+STAGE_NAMES = [stage.name for stage in topological_order(FLIGHT_POSTPROCESSING_STAGES)]
+
+
+def _stage_on_new_connections(flight_uuid, stage_name):
+    # Replaces _run_flight_stage on the stage processes, which must not use the DB connections of the worker
+    from django.db import connection
+    assert connection.connection is None and not connection.in_atomic_block, f"{stage_name} inherited a connection"
+
+
+@pytest.mark.django_db
+class TestJobQueue(FlightsMixin, BaseTestViewSet):
+    @pytest.fixture
+    def executed(self, monkeypatch, fs, flights: List[Flight]):
+        """
+        Replaces every post-processing stage with a function that records its name, and returns the records
+        """
+        executed = []
+
+        def make_stage(name):
+            def stage(flight):
+                del (flight,)  # unused
+                executed.append(name)
+
+            return stage
+
+        for name in STAGE_NAMES:
+            monkeypatch.setattr(Flight, name, make_stage(name))
+        fs.create_dir(flights[0].get_disk_path())
+        return executed
+
+    def test_enqueue_creates_all_stages(self, flights: List[Flight]):
+        job = enqueue_flight_postprocessing(flights[0])
+
+        assert job.state == JobState.QUEUED.name
+        assert [stage.name for stage in job.stages.all()] == STAGE_NAMES
+        assert all(stage.state == JobState.QUEUED.name for stage in job.stages.all())
+
+    def test_claimed_job_is_not_claimed_again(self, flights: List[Flight]):
+        job = enqueue_flight_postprocessing(flights[0])
+
+        assert claim_next_job() == job
+        assert claim_next_job() is None
+
+    def test_run_all_stages(self, executed, flights: List[Flight]):
+        job = enqueue_flight_postprocessing(flights[0])
+
+        assert run_next_job() == job
+        job.refresh_from_db()
+        assert job.state == JobState.COMPLETE.name
+        assert executed == STAGE_NAMES
+        assert all(stage.state == JobState.COMPLETE.name and stage.attempts == 1 for stage in job.stages.all())
+
+    def test_run_on_several_processes(self, monkeypatch, settings, fs, flights: List[Flight]):
+        from pyfakefs.fake_filesystem_unittest import Pause
+        settings.POSTPROCESSING_PROCESSES = 2
+        monkeypatch.setattr(jobs, "_run_flight_stage", _stage_on_new_connections)
+        get_stages, make_runner, _ = jobs._JOB_DEFINITIONS[JobType.FLIGHT_POSTPROCESSING.name]
+        monkeypatch.setitem(jobs._JOB_DEFINITIONS, JobType.FLIGHT_POSTPROCESSING.name,
+                            (get_stages, make_runner, lambda job: None))  # The Flight folder is on the fake filesystem
+        job = enqueue_flight_postprocessing(flights[0])
+
+        with Pause(fs):  # pyfakefs doesn't support the pipes of the process pool
+            run_next_job()
+
+        job.refresh_from_db()
+        assert [stage.error for stage in job.stages.all()] == [""] * len(STAGE_NAMES)
+        assert job.state == JobState.COMPLETE.name
+
+    def test_failed_stage_is_retried_alone(self, executed, monkeypatch, settings, flights: List[Flight]):
+        settings.JOB_RETRY_DELAY = 0
+
+        def fail(flight):
+            raise RuntimeError("GDAL exploded")
+
+        monkeypatch.setattr(Flight, "create_colored_dsm", fail)
+        job = enqueue_flight_postprocessing(flights[0])
+        run_next_job()
+
+        job.refresh_from_db()
+        assert job.state == JobState.QUEUED.name  # will be retried
+        # The DSM branch stops, but the orthophoto branch is not affected
+        assert set(executed) == set(STAGE_NAMES) - {"create_colored_dsm", "try_create_png_dsm"}
+        stage = job.stages.get(name="create_colored_dsm")
+        assert stage.state == JobState.ERROR.name
+        assert "GDAL exploded" in stage.error
+        assert job.stages.get(name="try_create_png_dsm").attempts == 0
+
+        monkeypatch.undo()
+        executed.clear()
+        for name in STAGE_NAMES:
+            monkeypatch.setattr(Flight, name, lambda flight, name=name: executed.append(name))
+        run_next_job()
+
+        job.refresh_from_db()
+        assert job.state == JobState.COMPLETE.name
+        assert executed == ["create_colored_dsm", "try_create_png_dsm"]  # download etc. were NOT executed again
+        assert job.stages.get(name="create_colored_dsm").attempts == 2
+
+    def test_job_fails_after_max_attempts(self, executed, monkeypatch, settings, flights: List[Flight]):
+        settings.JOB_RETRY_DELAY = 0
+        settings.JOB_MAX_ATTEMPTS = 2
+
+        def fail(flight):
+            raise RuntimeError()
+
+        monkeypatch.setattr(Flight, "download_and_decompress_results", fail)
+        job = enqueue_flight_postprocessing(flights[0])
+        while run_next_job() is not None:
+            pass
+
+        job.refresh_from_db()
+        assert job.state == JobState.ERROR.name
+        assert job.attempts == 2
+        assert not executed
+
+        retry(job)
+        job.refresh_from_db()
+        assert job.state == JobState.QUEUED.name
+        assert job.attempts == 0
+
+    def test_error_after_stages_is_a_failed_attempt(self, executed, monkeypatch, settings, flights: List[Flight]):
+        settings.JOB_RETRY_DELAY = 0
+
+        def fail(flight):
+            raise RuntimeError("disk full")
+
+        monkeypatch.setattr(Flight, "update_disk_space", fail)
+        job = enqueue_flight_postprocessing(flights[0])
+
+        assert run_next_job() == job
+
+        job.refresh_from_db()
+        assert job.state == JobState.QUEUED.name  # not RUNNING forever
+        assert job.attempts == 1
+
+    def test_stale_jobs_are_requeued(self, settings, flights: List[Flight]):
+        settings.JOB_TIMEOUT = 60
+        settings.JOB_MAX_ATTEMPTS = 2
+        long_ago = timezone.now() - timedelta(seconds=61)
+        stale = enqueue_flight_postprocessing(flights[0])
+        exhausted = enqueue_flight_postprocessing(flights[1])
+        running = enqueue_flight_postprocessing(flights[2])
+        Job.objects.filter(pk=stale.pk).update(state=JobState.RUNNING.name, started=long_ago, attempts=1)
+        Job.objects.filter(pk=exhausted.pk).update(state=JobState.RUNNING.name, started=long_ago, attempts=2)
+        Job.objects.filter(pk=running.pk).update(state=JobState.RUNNING.name, started=timezone.now(), attempts=1)
+
+        assert requeue_stale_jobs() == 2
+
+        assert Job.objects.get(pk=stale.pk).state == JobState.QUEUED.name
+        assert Job.objects.get(pk=exhausted.pk).state == JobState.ERROR.name
+        assert Job.objects.get(pk=running.pk).state == JobState.RUNNING.name
+        assert claim_next_job() == stale
+
+    def test_worker_survives_errors(self, monkeypatch):
+        results = iter([RuntimeError("database is locked"), None])
+
+        def run_next_job():
+            result = next(results)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        monkeypatch.setattr(runworker, "run_next_job", run_next_job)
+        monkeypatch.setattr(runworker.time, "sleep", lambda seconds: None)
+
+        runworker._work(poll_interval=1, once=True)  # returns once the queue is empty
+
+    def test_completed_job_updates_disk_space(self, executed, fs, flights: List[Flight]):
+        flight = flights[0]
+        flight.state = FlightState.COMPLETE.name
+        flight.save()
+        fs.create_file(flight.get_disk_path() + "/odm_orthophoto/rgb.tif", contents="A" * 1024 * 1024)
+        enqueue_flight_postprocessing(flight)
+        run_next_job()
+
+        flight.refresh_from_db()
+        flight.user.refresh_from_db()
+        assert flight.used_space == 1024
+        assert flight.user.used_space == 1024
+
+    def test_stages_added_after_enqueueing_are_run(self, executed, flights: List[Flight]):
+        job = enqueue_flight_postprocessing(flights[0])
+        job.stages.filter(name="create_camera_positions").delete()  # as if the job was enqueued by an older version
+
+        run_next_job()
+
+        job.refresh_from_db()
+        assert job.state == JobState.COMPLETE.name
+        assert "create_camera_positions" in executed
+        assert job.stages.get(name="create_camera_positions").state == JobState.COMPLETE.name
+
+    def test_project_indices_run_per_flight(self, monkeypatch, users, flights: List[Flight]):
+        project = users[0].user_projects.create(name="proj")
+        project.flights.add(flights[0], flights[1])
+        created, datastores = [], []
+        monkeypatch.setattr(Flight, "create_index_rasters",
+                            lambda flight, indices: created.append((str(flight.uuid), indices)))
+        monkeypatch.setattr(UserProject, "_create_index_datastore", lambda p, index: datastores.append(index))
+        for model in (Flight, UserProject, User):
+            monkeypatch.setattr(model, "update_disk_space", lambda obj: None)
+
+        job = enqueue_project_indices(project, {"ndvi": "", "custom": "nir/red"})
+        assert job.stages.count() == 2  # one per Flight
+        run_next_job()
+
+        job.refresh_from_db()
+        assert job.state == JobState.COMPLETE.name
+        assert job.progress() == 1.0
+        assert sorted(created) == sorted((str(f.uuid), {"ndvi": "", "custom": "nir/red"}) for f in flights[:2])
+        # The datastores are created only once, after all the Flights
+        assert datastores == ["ndvi", "custom"]
+        assert sorted(project.artifacts.values_list("name", flat=True)) == ["custom", "ndvi"]
+
+        jobs._finish_project_indices(job)  # e.g. the Job failed after its first call and is retried
+        assert sorted(project.artifacts.values_list("name", flat=True)) == ["custom", "ndvi"]
+
+    def test_disk_recompute_in_batches(self, monkeypatch, fs, users, flights: List[Flight]):
+        monkeypatch.setattr(jobs, "DISK_RECOMPUTE_BATCH_SIZE", 2)
+        project = users[0].user_projects.create(name="proj")
+        for i, flight in enumerate(flights[:3]):
+            fs.create_file(flight.get_disk_path() + "/odm_orthophoto/odm_orthophoto.tif", contents="Z" * 1024 * (i + 1))
+        fs.create_file(project.get_disk_path() + "/somefile.txt", contents="A" * 1024 * 10)
+        # Cached sizes may have missed files modified in place, so they are discarded
+        DirectoryUsage.objects.create(path=flights[0].get_disk_path(), mtime=0, size=10 ** 9, subdirectories="[]",
+                                      links="[]")
+        recomputed = []
+        monkeypatch.setattr(User, "update_disk_space", lambda user: recomputed.append(user.pk))
+
+        job = enqueue_disk_recompute(flights=flights[:3], projects=[project])
+        assert job.stages.count() == 2  # 4 objects, 2 per stage
+        assert job.progress() == 0.0
+        run_next_job()
+
+        job.refresh_from_db()
+        assert job.state == JobState.COMPLETE.name
+        assert [Flight.objects.get(pk=f.pk).used_space for f in flights[:3]] == [1, 2, 3]
+        assert UserProject.objects.get(pk=project.pk).used_space == 10
+        assert not DirectoryUsage.objects.exists()
+        # Once per User, after all the objects were updated
+        assert sorted(recomputed) == sorted({f.user.pk for f in flights[:3]} | {users[0].pk})
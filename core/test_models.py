@@ -8,6 +8,7 @@ from django.urls import reverse
 from httpretty import httpretty
 
 from core.models import *
+from core.utils import files
 from core.test_viewsets import FlightsMixin, BaseTestViewSet
 
 
@@ -78,6 +79,61 @@ class TestUserProjectModel(FlightsMixin, ProjectsMixin, BaseTestViewSet):
         with open(project_path + "/mainortho/timeregex.properties") as f:
             assert f.read() == "regex=[0-9]{8},format=yyyyMMdd"
 
+    def test_sync_layers_when_flights_change(self, fs, flights, projects):
+        from core.jobs import run_next_job
+        harvested, removed = [], []
+
+        def mark_harvested(request, uri, response_headers):
+            harvested.append(request.body.decode("utf-8"))
+            return [200, response_headers, ""]
+
+        def mark_removed(request, uri, response_headers):
+            removed.append(request.querystring["filter"][0])
+            return [200, response_headers, ""]
+
+        workspace = "http://container-geoserver:8080/geoserver/rest/workspaces/project_" + str(projects[0].uuid)
+        httpretty.register_uri(httpretty.POST, workspace + "/coveragestores/mainortho/external.imagemosaic",
+                               mark_harvested)
+        httpretty.register_uri(httpretty.DELETE, workspace + "/coveragestores/mainortho/coverages/mainortho/index/"
+                                                             "granules.json", mark_removed)
+        for flight in flights[:2]:
+            fs.create_file(flight.get_disk_path() + "/odm_orthophoto/rgb.tif", contents="A" * 1024)
+        mainortho = projects[0].get_disk_path() + "/mainortho/"
+        projects[0].flights.add(flights[0])  # Not synced, the project has no layers yet
+        fs.create_dir(mainortho)
+        files.materialize(flights[0].get_disk_path() + "/odm_orthophoto/rgb.tif",
+                          mainortho + UserProject._get_granule_name(flights[0]))
+
+        projects[0].flights.add(flights[1])
+        assert run_next_job().type == JobType.PROJECT_SYNC.name
+        projects[0].flights.remove(flights[0])
+        run_next_job()
+
+        granule0, granule1 = (UserProject._get_granule_name(f) for f in flights[:2])
+        assert harvested == ["file:///media/USB/{}/mainortho/{}".format(projects[0].uuid, granule1)]
+        assert removed == ["location='{}'".format(granule0)]
+        assert sorted(os.listdir(mainortho)) == [".shared", granule1]
+        assert files.shared_files(mainortho) == {granule1}
+
+    def test_sync_layers_when_flights_are_deleted_or_cleared(self, fs, monkeypatch, flights, projects):
+        from core import models
+        monkeypatch.setattr(models.transaction, "on_commit", lambda function: function())  # Tests never commit
+        for project in projects[:2]:
+            project.flights.add(flights[0])
+        projects[1].flights.add(flights[1])
+        for project in projects[:2]:
+            fs.create_dir(project.get_disk_path() + "/mainortho/")
+
+        flights[1].user_projects.clear()
+        assert list(Job.objects.values_list("type", "project")) == [(JobType.PROJECT_SYNC.name, projects[1].pk)]
+        Job.objects.all().delete()
+
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/remove", "")
+        httpretty.register_uri(httpretty.DELETE, "http://container-geoserver:8080/geoserver/rest/workspaces/flight_" +
+                               str(flights[0].uuid))
+        flights[0].delete()
+        assert sorted(Job.objects.values_list("project", flat=True)) == sorted(p.pk for p in projects[:2])
+
     def test_compute_disk_space(self, fs, projects: List[UserProject]):
         """
         Tests that the used disk space is updated correctly
@@ -140,6 +196,63 @@ class TestFlightModel(FlightsMixin, BaseTestViewSet):
         assert str(f.uuid) in f.get_png_ortho_path()
         assert f.get_png_ortho_path().endswith("/odm_orthophoto/odm_orthophoto.png")
 
+    def test_create_previews(self, users, monkeypatch, settings):
+        import sys
+        from types import SimpleNamespace
+        import core.utils
+        settings.PREVIEW_SIZES = [320, 1080]
+        created = {}
+        fake_raster = SimpleNamespace(create_previews=lambda src, previews: created.update(previews))
+        monkeypatch.setitem(sys.modules, "core.utils.raster", fake_raster)  # GDAL isn't available on tests
+        monkeypatch.setattr(core.utils, "raster", fake_raster, raising=False)
+        f = users[0].flight_set.create(name="flight", date=datetime.now())
+
+        f.create_previews()
+
+        assert created[512] == [f.get_thumbnail_path()]
+        assert created[1080] == [f.get_small_ortho_path(extension="tif"), f.get_small_ortho_path(extension="png"),
+                                 f.get_preview_path(1080)]
+        assert created[320] == [f.get_preview_path(320)]
+
+    def test_create_index_rasters(self, fs, users, monkeypatch):
+        import sys
+        from types import SimpleNamespace
+        import core.utils
+        from core.utils import raster_calc
+        computed = []
+
+        def mock_calculate_many(src, outputs):
+            computed.extend(outputs)
+            for path in outputs:
+                fs.create_file(path, contents="the index")
+
+        fake_raster = SimpleNamespace(convert_to_cog=lambda path, compression: None)
+        monkeypatch.setitem(sys.modules, "core.utils.raster", fake_raster)  # GDAL isn't available on tests
+        monkeypatch.setattr(core.utils, "raster", fake_raster, raising=False)
+        monkeypatch.setattr(raster_calc, "calculate_many", mock_calculate_many)
+        f = users[0].flight_set.create(name="flight", date=datetime.now(), camera=Camera.REDEDGE.name,
+                                       state=FlightState.COMPLETE.name)
+        fs.create_dir(f.get_disk_path() + "/odm_orthophoto")
+
+        f.create_index_rasters({"ndvi": "", "custom": "nir + red"})
+
+        # Partial files have unique names, concurrent Jobs may be computing the same formula
+        assert len(computed) == 2 and all(f".{os.getpid()}." in path for path in computed)
+        assert sorted(os.listdir(os.path.dirname(f.get_index_cache_path("")))) == \
+               sorted(path.split("/")[-1].split(".")[0] + ".tif" for path in computed)
+        assert open(f.get_disk_path() + "/odm_orthophoto/custom.tif").read() == "the index"
+
+        cached = sorted(os.listdir(os.path.dirname(f.get_index_cache_path(""))))
+
+        def fail(src, outputs):
+            mock_calculate_many(src, outputs)
+            raise RuntimeError("GDAL error")
+
+        monkeypatch.setattr(raster_calc, "calculate_many", fail)
+        with pytest.raises(RuntimeError):
+            f.create_index_rasters({"ndre": ""})
+        assert sorted(os.listdir(os.path.dirname(f.get_index_cache_path("")))) == cached  # No partial files are left
+
     def test_get_nodeodm_info(self, users):
         f: Flight = users[0].flight_set.create(name="flight", date=datetime.now())
         f.state = FlightState.PROCESSING.name
@@ -170,6 +283,16 @@ class TestFlightModel(FlightsMixin, BaseTestViewSet):
 
         assert f.used_space == (3 * 1024) + 3
 
+    def test_compute_disk_space_hardlinks(self, fs, users):
+        f = users[0].flight_set.create(name="flight", date=datetime.now())
+        fs.create_file(f.get_index_cache_path("abc"), contents="Z" * 1024 * 1024)
+        os.link(f.get_index_cache_path("abc"), f.get_disk_path() + "/odm_orthophoto/ndvi.tif")
+
+        f.update_disk_space()
+        f.refresh_from_db()
+
+        assert f.used_space == 1024  # Hardlinks are counted once
+
 
 @pytest.mark.django_db
 class TestUserModel(FlightsMixin, ProjectsMixin, BaseTestViewSet):
@@ -198,3 +321,76 @@ class TestUserModel(FlightsMixin, ProjectsMixin, BaseTestViewSet):
         u.refresh_from_db()
 
         assert u.used_space == 3 + (3 * 1024) + 41 + 1024
+
+    def test_compute_disk_space_in_database(self, users, flights, projects, django_assert_num_queries):
+        u: User = users[0]
+        u.flight_set.update(used_space=100)
+        u.user_projects.update(used_space=10)
+        demo = u.flight_set.all()[0]
+        demo.is_demo = True
+        demo.save()
+        stale = User.objects.get(pk=u.pk)
+        User.objects.filter(pk=u.pk).update(remaining_images=1234)  # e.g. another worker processing an upload
+
+        with django_assert_num_queries(2):  # The UPDATE with the sum, and the reload of used_space
+            stale.update_disk_space()
+
+        u.refresh_from_db()
+        assert stale.used_space == u.used_space
+        assert u.used_space == 100 * (u.flight_set.count() - 1) + 10 * u.user_projects.count()
+        assert u.remaining_images == 1234  # Not overwritten by the stale instance
+
+    def test_compute_disk_space_without_flights(self, users):
+        u: User = users[0]
+        u.flight_set.all().delete()
+        u.user_projects.all().delete()
+        u.used_space = 1000
+        u.save()
+
+        u.update_disk_space()
+
+        assert u.used_space == 0
+
+
+@pytest.mark.django_db
+class TestDirectoryUsage:
+    def test_only_changed_directories_are_scanned(self, tmp_path, monkeypatch):
+        from core.utils import disk_space_tracking
+        root = str(tmp_path)
+        for folder in ("odm_orthophoto", "odm_dem"):
+            os.makedirs(f"{root}/{folder}")
+            with open(f"{root}/{folder}/raster.tif", "w") as f:
+                f.write("Z" * 1024)
+        for folder in ("", "/odm_orthophoto", "/odm_dem"):  # Not modified recently, so they can be cached
+            os.utime(root + folder, ns=(0, 0))
+        directory_size = disk_space_tracking.cached_size_of_dir(root)
+        assert directory_size == DiskSpaceTrackerMixin._size_of_dir(root)
+
+        scanned = []
+        scan_dir = disk_space_tracking._scan_dir
+        monkeypatch.setattr(disk_space_tracking, "_scan_dir",
+                            lambda path, *args: scanned.append(path) or scan_dir(path, *args))
+        with open(f"{root}/odm_dem/dtm.tif", "w") as f:
+            f.write("Z" * 1024)
+
+        assert disk_space_tracking.cached_size_of_dir(root) == directory_size + 1024
+        assert scanned == [root + "/odm_dem"]
+
+        # Files modified in place don't change the mtime of their directory, reconciliation finds them
+        with open(f"{root}/odm_orthophoto/raster.tif", "a") as f:
+            f.write("Z" * 1024)
+        assert disk_space_tracking.cached_size_of_dir(root, reconcile=True) == directory_size + 2048
+        assert not DirectoryUsage.objects.exists()  # filled again by the next call
+        assert disk_space_tracking.cached_size_of_dir(root) == directory_size + 2048
+
+    def test_deleted_directories_are_forgotten(self, tmp_path):
+        from core.utils import disk_space_tracking
+        root = str(tmp_path)
+        os.makedirs(root + "/odm_dem")
+        disk_space_tracking.cached_size_of_dir(root)
+        os.rmdir(root + "/odm_dem")
+
+        disk_space_tracking.cached_size_of_dir(root)
+        assert list(DirectoryUsage.objects.values_list("path", flat=True)) == [root]
+        disk_space_tracking.forget_dir(root)
+        assert not DirectoryUsage.objects.exists()
@@ -0,0 +1,616 @@
+import colorsys
+import importlib
+import io
+import os
+import shutil
+import subprocess
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy
+import pytest
+import requests
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from httpretty import httpretty
+from urllib3.filepost import encode_multipart_formdata
+
+from core.parser import BUILTIN_FORMULAS, FormulaParser
+from core.utils import color_ramp, files, geo
+from core.utils.colorbar_creator import gradient
+from core.utils.disk_space_tracking import DiskSpaceTrackerMixin
+from core.utils.dag import Stage, dependencies, run_dag, topological_order
+from core.utils.hsv_merge import merge_intensity, windows
+from core.utils.markers import draw_markers
+from core.utils.multipart import MultipartEncoder
+from core.utils.remote_zip import extract_remote_zip, extract_zip
+from core.utils.shaded_relief import hillshade
+
+PIPELINE = (
+    Stage("download", outputs=("outputs",)),
+    Stage("rgb", inputs=("outputs",), outputs=("rgb.tif",)),
+    Stage("thumbnail", inputs=("rgb.tif",), outputs=("thumbnail.png",)),
+    Stage("dsm", inputs=("outputs",), outputs=("dsm.tif",)),
+    Stage("dsm_png", inputs=("dsm.tif",), outputs=("dsm.png",)),
+)
+
+
+def _record_pid(name):
+    return name, os.getpid()
+
+
+class TestDag:
+    def test_dependencies(self):
+        deps = dependencies(PIPELINE)
+        assert deps["download"] == set()
+        assert deps["thumbnail"] == {"rgb"}
+        assert deps["dsm_png"] == {"dsm"}
+
+    def test_duplicate_output(self):
+        with pytest.raises(ValueError):
+            dependencies([Stage("a", outputs=("x",)), Stage("b", outputs=("x",))])
+
+    def test_topological_order(self):
+        order = [s.name for s in topological_order(reversed(PIPELINE))]
+        assert order.index("download") == 0
+        assert order.index("rgb") < order.index("thumbnail")
+        assert order.index("dsm") < order.index("dsm_png")
+
+    def test_cycle(self):
+        with pytest.raises(ValueError):
+            topological_order([Stage("a", inputs=("y",), outputs=("x",)), Stage("b", inputs=("x",), outputs=("y",))])
+
+    def test_run_sequential(self):
+        executed = []
+        failed = run_dag(PIPELINE, executed.append)
+        assert not failed
+        assert executed == [s.name for s in topological_order(PIPELINE)]
+
+    def test_failure_blocks_only_dependent_stages(self):
+        executed, finished = [], {}
+
+        def run_stage(name):
+            if name == "dsm":
+                raise RuntimeError("boom")
+            executed.append(name)
+
+        def on_finish(name, duration, error):
+            finished[name] = error
+
+        failed = run_dag(PIPELINE, run_stage, on_finish=on_finish)
+        assert failed == {"dsm"}
+        assert set(executed) == {"download", "rgb", "thumbnail"}
+        assert "boom" in finished["dsm"]
+        assert "dsm_png" not in finished
+
+    def test_completed_stages_are_skipped(self):
+        executed = []
+        run_dag(PIPELINE, executed.append, completed=["download", "rgb", "dsm"])
+        assert set(executed) == {"thumbnail", "dsm_png"}
+
+    def test_run_on_process_pool(self):
+        started, finished = [], []
+        failed = run_dag(PIPELINE, _record_pid, max_workers=2, on_start=started.append,
+                         on_finish=lambda name, duration, error: finished.append((name, error)))
+        assert not failed
+        assert sorted(started) == sorted(s.name for s in PIPELINE)
+        assert all(error is None for _, error in finished)
+
+
+class TestRemoteZip:
+    URL = "http://container-nodeodm:3000/task/abc/download/all.zip"
+
+    @pytest.fixture
+    def zip_bytes(self):
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w", compression=ZIP_DEFLATED) as z:
+            z.writestr("images.json", "[]")
+            z.writestr("odm_orthophoto/odm_orthophoto.tif", os.urandom(300000))
+            z.writestr("odm_texturing/odm_textured_model.obj", b"O" * 1000)
+        return buffer.getvalue()
+
+    @pytest.fixture
+    def server(self, zip_bytes):
+        """
+        Serves zip_bytes with range request support, and records the requested ranges
+        """
+        requested = []
+
+        def serve_range(request, uri, response_headers):
+            start, end = map(int, request.headers["Range"][len("bytes="):].split("-"))
+            requested.append((start, end))
+            response_headers["Content-Range"] = f"bytes {start}-{end}/{len(zip_bytes)}"
+            return [206, response_headers, zip_bytes[start:end + 1]]
+
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.URL, body=serve_range)
+        yield requested
+        httpretty.disable()
+        httpretty.reset()
+
+    def test_extract_everything(self, server, tmp_path):
+        extract_remote_zip(self.URL, str(tmp_path), buffer_size=64 * 1024)
+        assert (tmp_path / "images.json").read_text() == "[]"
+        assert (tmp_path / "odm_orthophoto" / "odm_orthophoto.tif").stat().st_size == 300000
+        assert (tmp_path / "odm_texturing" / "odm_textured_model.obj").exists()
+        assert not list(tmp_path.glob("**/*.part"))
+
+    def test_extract_subset(self, server, tmp_path, zip_bytes):
+        stats = extract_remote_zip(self.URL, str(tmp_path), include=["images.json", "odm_texturing"],
+                                   buffer_size=16 * 1024)
+        assert (tmp_path / "images.json").exists()
+        assert (tmp_path / "odm_texturing" / "odm_textured_model.obj").exists()
+        assert not (tmp_path / "odm_orthophoto").exists()
+        assert stats.bytes < len(zip_bytes)  # the big orthophoto was never downloaded
+
+    def test_extracted_entries_are_not_downloaded_again(self, server, tmp_path):
+        extract_remote_zip(self.URL, str(tmp_path), buffer_size=64 * 1024)
+        first_run = len(server)
+        server.clear()
+        extract_remote_zip(self.URL, str(tmp_path), buffer_size=64 * 1024)
+        assert len(server) < first_run
+
+    def test_fallback_without_range_support(self, tmp_path, zip_bytes):
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.URL, body=zip_bytes)
+        try:
+            extract_remote_zip(self.URL, str(tmp_path / "out"), include=["images.json"],
+                               fallback_path=str(tmp_path / "all.zip"))
+        finally:
+            httpretty.disable()
+            httpretty.reset()
+        assert (tmp_path / "out" / "images.json").exists()
+        assert not (tmp_path / "all.zip").exists()
+
+    def test_interrupted_fallback_leaves_no_zip_file(self, tmp_path, zip_bytes, monkeypatch):
+        def interrupted_download(response, chunk_size):
+            yield zip_bytes[:chunk_size // 2]
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+        monkeypatch.setattr(requests.Response, "iter_content", interrupted_download)
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, self.URL, body=zip_bytes)
+        try:
+            with pytest.raises(requests.exceptions.ChunkedEncodingError):
+                extract_remote_zip(self.URL, str(tmp_path / "out"), fallback_path=str(tmp_path / "all.zip"))
+        finally:
+            httpretty.disable()
+            httpretty.reset()
+        assert not (tmp_path / "all.zip").exists()
+
+    def test_failed_entries_leave_no_part_files(self, tmp_path, zip_bytes):
+        corrupted = bytearray(zip_bytes)
+        corrupted[1000:1100] = b"\x00" * 100  # inside the compressed data of the orthophoto
+        with ZipFile(io.BytesIO(bytes(corrupted))) as z, pytest.raises(Exception):
+            extract_zip(z, str(tmp_path), include=["odm_orthophoto"])
+        assert not list(tmp_path.glob("**/*.part"))
+        assert not (tmp_path / "odm_orthophoto" / "odm_orthophoto.tif").exists()
+
+    def test_zip_slip(self, tmp_path):
+        buffer = io.BytesIO()
+        with ZipFile(buffer, "w") as z:
+            z.writestr("../evil.txt", "x")
+        with ZipFile(buffer) as z, pytest.raises(ValueError):
+            extract_zip(z, str(tmp_path / "out"))
+
+
+class TestHsvMerge:
+    @staticmethod
+    def reference_merge(rgb, intensity):
+        # What the original GDAL script did, one pixel at a time
+        out = numpy.empty(rgb.shape, dtype=numpy.uint8)
+        for y in range(rgb.shape[1]):
+            for x in range(rgb.shape[2]):
+                h, s, _ = colorsys.rgb_to_hsv(*(float(c) for c in rgb[:, y, x]))
+                out[:, y, x] = [int(c) for c in colorsys.hsv_to_rgb(h, s, float(intensity[y, x]))]
+        return out
+
+    def test_same_as_hsv_conversion(self):
+        rng = numpy.random.default_rng(0)
+        rgb = rng.integers(0, 256, size=(3, 20, 30), dtype=numpy.uint8)
+        rgb[:, 0, :5] = 0  # black pixels have no hue
+        rgb[:, 1, :5] = 128  # neither do greys
+        intensity = rng.integers(0, 256, size=(20, 30), dtype=numpy.uint8)
+
+        merged = merge_intensity(rgb, intensity)
+
+        # Truncation of float results may differ by one unit
+        assert numpy.abs(merged.astype(int) - self.reference_merge(rgb, intensity)).max() <= 1
+        assert (merged[:, 0, :5] == intensity[0, :5]).all()
+
+    def test_nodata_keeps_colour(self):
+        rgb = numpy.full((3, 2, 2), 200, dtype=numpy.uint8)
+        rgb[0] = 50
+        intensity = numpy.array([[0, 100], [0, 255]], dtype=numpy.uint8)
+
+        merged = merge_intensity(rgb, intensity, nodata=0)
+
+        assert (merged[:, 0, 0] == rgb[:, 0, 0]).all()
+        assert (merged[:, 1, 0] == rgb[:, 1, 0]).all()
+        assert list(merged[:, 0, 1]) == [25, 100, 100]
+
+    def test_buffers_are_reused(self):
+        rgb = numpy.ones((3, 4, 4), dtype=numpy.uint8)
+        out = numpy.empty((3, 4, 4), dtype=numpy.uint8)
+        work = numpy.empty((4, 4, 4), dtype=numpy.float32)
+
+        assert merge_intensity(rgb, numpy.full((4, 4), 9), out=out, work=work) is out
+        assert (out == 9).all()
+
+    def test_windows_cover_the_raster(self):
+        result = windows(1100, 600, 512, 512)
+
+        assert result[0] == (0, 0, 512, 512)
+        assert result[-1] == (1024, 512, 76, 88)
+        assert sum(w * h for _, _, w, h in result) == 1100 * 600
+
+
+class TestShadedRelief:
+    COLOR_FILE = "./core/utils/color_relief.txt"
+
+    def test_load_color_ramp(self):
+        ramp = color_ramp.load(self.COLOR_FILE)
+
+        assert ramp.stops[0] == (0.0, True, (255, 0, 255, 255))
+        assert ramp.stops[-1] == (100.0, True, (255, 0, 0, 255))
+        assert ramp.nodata_color == (0, 0, 0, 0)
+
+    def test_lookup_table_interpolates_percentages(self):
+        lut = color_ramp.lookup_table(color_ramp.load(self.COLOR_FILE), 100, 200, size=21)
+
+        assert list(lut[:, 0]) == [255, 0, 255, 255]  # 0%
+        assert list(lut[:, 1]) == [192, 0, 255, 255]  # 5%, halfway between 0% and 10%
+        assert list(lut[:, 20]) == [255, 0, 0, 255]  # 100%
+
+    def test_colorbar_matches_the_dsm_colors(self):
+        bar = gradient(501, 20, self.COLOR_FILE)
+
+        assert bar.shape == (20, 501, 4)
+        assert list(bar[0, 0]) == [255, 0, 255, 255]  # 0% of color_relief.txt
+        assert list(bar[0, 250]) == [0, 255, 128, 255]  # 50%
+        assert list(bar[19, 500]) == [255, 0, 0, 255]  # 100%
+
+    def test_colorize(self):
+        ramp = color_ramp.load(self.COLOR_FILE)
+        lut = color_ramp.lookup_table(ramp, 0, 10)
+        data = numpy.array([[-5, 0, 10, numpy.nan]], dtype=numpy.float32)
+
+        color = color_ramp.colorize(data, lut, 0, 10, ramp.nodata_color)
+
+        assert list(color[:, 0, 0]) == list(color[:, 0, 1]) == [255, 0, 255, 255]  # below min is clamped
+        assert list(color[:, 0, 2]) == [255, 0, 0, 255]
+        assert list(color[:, 0, 3]) == [0, 0, 0, 0]
+
+    def test_hillshade_of_flat_terrain(self):
+        dem = numpy.full((5, 6), 100, dtype=numpy.float32)
+
+        shade = hillshade(dem, 1.0, -1.0)
+
+        assert shade.shape == (3, 4)
+        assert numpy.allclose(shade, 1 + 254 * numpy.sin(numpy.radians(45)))
+
+    def test_slopes_facing_the_light_are_brighter(self):
+        x = numpy.arange(6, dtype=numpy.float32)
+        rising_to_the_east = numpy.tile(x, (5, 1))  # faces west, the default light comes from the northwest
+
+        assert (hillshade(rising_to_the_east, 1.0, -1.0) > hillshade(-rising_to_the_east, 1.0, -1.0)).all()
+
+    def test_hillshade_nodata(self):
+        dem = numpy.full((5, 5), 100, dtype=numpy.float32)
+        dem[0, 0] = numpy.nan
+
+        shade = hillshade(dem, 1.0, -1.0)
+
+        assert numpy.isnan(shade[0, 0])
+        assert not numpy.isnan(shade[1:, 1:]).any()
+
+
+class TestMarkers:
+    def test_draw_markers(self):
+        image = numpy.zeros((20, 30, 3), dtype=numpy.uint8)
+
+        draw_markers(image, numpy.array([5, 29]), numpy.array([10, 0]), radius=2)
+
+        assert list(image[10, 5]) == [255, 0, 0]  # center
+        assert list(image[10, 7]) == [255, 0, 0]  # on the radius
+        assert list(image[12, 7]) == [0, 0, 0]  # outside of the circle
+        assert list(image[0, 29]) == [255, 0, 0]  # partially outside of the image, clipped
+        assert (image[:, :, 0] == 255).sum() == 13 + 6
+
+    def test_no_markers(self):
+        image = numpy.zeros((4, 4, 4), dtype=numpy.uint8)
+
+        assert not draw_markers(image, numpy.array([]), numpy.array([])).any()
+
+
+class TestGeo:
+    def test_transformers_are_cached(self):
+        assert geo.get_transformer(geo.WGS84, "EPSG:32717") is geo.get_transformer(geo.WGS84, "EPSG:32717")
+
+    def test_transform_arrays(self):
+        xs, ys = geo.transform([-79.0, -78.0], [-2.0, -2.5], geo.WGS84, "EPSG:32717")  # lon, lat
+
+        assert xs.shape == ys.shape == (2,)
+        assert 600000 < xs[0] < 800000  # UTM 17S, the central meridian (-81) is at x = 500000
+        assert xs[1] > xs[0]
+        assert ys[1] < ys[0]
+
+    def test_to_pixels(self):
+        geotransform = (1000.0, 0.5, 0.0, 2000.0, 0.0, -0.5)
+
+        columns, rows = geo.to_pixels([1000.0, 1010.0], [2000.0, 1990.0], geotransform)
+
+        assert list(columns) == [0, 20]
+        assert list(rows) == [0, 20]
+
+    def test_to_pixels_rotated(self):
+        geotransform = (0.0, 1.0, 2.0, 0.0, 3.0, 4.0)
+
+        columns, rows = geo.to_pixels([1 * 1.0 + 2 * 2.0], [1 * 3.0 + 2 * 4.0], geotransform)
+
+        assert numpy.allclose(columns, [1]) and numpy.allclose(rows, [2])
+
+
+class TestFiles:
+    @pytest.fixture
+    def src(self, tmp_path):
+        (tmp_path / "flight").mkdir()
+        (tmp_path / "project").mkdir()
+        path = tmp_path / "flight" / "rgb.tif"
+        path.write_bytes(b"the ortho")
+        return str(path)
+
+    def test_materialize_shares_the_file(self, tmp_path, src):
+        dst = str(tmp_path / "project" / "ortho_20200101.tif")
+
+        assert files.materialize(src, dst) in ("reflink", "hardlink")
+
+        with open(dst, "rb") as f:
+            assert f.read() == b"the ortho"
+        assert files.shared_files(str(tmp_path / "project")) == {"ortho_20200101.tif"}
+
+    def test_materialize_copies_across_filesystems(self, tmp_path, src, monkeypatch):
+        def fail(*args, **kwargs):
+            raise OSError("Invalid cross-device link")
+
+        monkeypatch.setattr(files, "_reflink", fail)
+        monkeypatch.setattr(os, "link", fail)
+        dst = str(tmp_path / "project" / "ortho_20200101.tif")
+
+        assert files.materialize(src, dst) == "copy"
+        assert files.shared_files(str(tmp_path / "project")) == set()  # copies belong to the project
+
+    def test_remove_materialized(self, tmp_path, src):
+        for name in ("ortho_20200101.tif", "ortho_20200102.tif"):
+            files.materialize(src, str(tmp_path / "project" / name))
+
+        files.remove_materialized(str(tmp_path / "project" / "ortho_20200101.tif"))
+
+        assert not (tmp_path / "project" / "ortho_20200101.tif").exists()
+        assert files.shared_files(str(tmp_path / "project")) == {"ortho_20200102.tif"}
+        assert files.shared_entries(str(tmp_path / "project"))["ortho_20200102.tif"][1] == src
+
+    def test_shared_files_are_charged_once_the_original_is_deleted(self, tmp_path, src):
+        files.materialize(src, str(tmp_path / "project" / "ortho_20200101.tif"))
+        project_size = DiskSpaceTrackerMixin._size_of_dir(str(tmp_path / "project"))
+
+        os.remove(src)
+
+        assert DiskSpaceTrackerMixin._size_of_dir(str(tmp_path / "project")) == project_size + len(b"the ortho")
+
+    def test_old_manifests_are_read(self, tmp_path, src):
+        os.link(src, tmp_path / "project" / "ortho_20200101.tif")
+        (tmp_path / "project" / files.SHARED_MANIFEST).write_text("ortho_20200101.tif\n")
+
+        assert files.shared_entries(str(tmp_path / "project")) == {"ortho_20200101.tif": (None, None)}
+        assert files.still_shared(os.stat(tmp_path / "project" / "ortho_20200101.tif"), None, None)
+
+
+class TestSizeOfDir:
+    @pytest.fixture
+    def tree(self, tmp_path):
+        for folder in ("odm_orthophoto/index_cache", "odm_dem", "odm_texturing/deep/deeper"):
+            os.makedirs(tmp_path / folder)
+        (tmp_path / "images.json").write_bytes(b"[]" * 100)
+        (tmp_path / "odm_orthophoto" / "index_cache" / "abc.tif").write_bytes(b"x" * 10000)
+        os.link(tmp_path / "odm_orthophoto" / "index_cache" / "abc.tif", tmp_path / "odm_orthophoto" / "ndvi.tif")
+        os.link(tmp_path / "odm_orthophoto" / "index_cache" / "abc.tif", tmp_path / "odm_dem" / "weird_link.tif")
+        (tmp_path / "odm_dem" / "dsm.tif").write_bytes(b"x" * 5000)
+        os.symlink(tmp_path / "odm_dem" / "dsm.tif", tmp_path / "odm_texturing" / "dsm_link.tif")
+        for i in range(50):
+            (tmp_path / "odm_texturing" / "deep" / "deeper" / f"texture_{i}.png").write_bytes(b"x" * i * 100)
+        with open(tmp_path / "odm_dem" / "sparse.tif", "wb") as f:
+            f.truncate(10 * 1024 * 1024)
+        return str(tmp_path)
+
+    @pytest.mark.skipif(shutil.which("du") is None, reason="du is not available")
+    @pytest.mark.parametrize("allocated, du_option", [(False, "-sb"), (True, "-sB1")])
+    def test_same_as_du(self, tree, allocated, du_option):
+        du = int(subprocess.run(["du", du_option, tree], check=True, capture_output=True).stdout.split()[0])
+        assert DiskSpaceTrackerMixin._size_of_dir(tree, allocated=allocated) == du
+
+    def test_same_result_with_one_thread(self, tree):
+        assert DiskSpaceTrackerMixin._size_of_dir(tree, max_workers=1) == DiskSpaceTrackerMixin._size_of_dir(tree)
+
+
+class TestMultipartEncoder:
+    def test_same_body_as_requests(self):
+        images = [SimpleUploadedFile("image1.jpg", b"foo" * 1000, content_type="image/jpeg"),
+                  SimpleUploadedFile("image2.tif", b"\x00\r\n" * 10, content_type=None)]
+        encoder = MultipartEncoder("images", images, chunk_size=100)
+
+        body = b"".join(encoder)
+
+        expected, content_type = encode_multipart_formdata(
+            [("images", ("image1.jpg", b"foo" * 1000, "image/jpeg")),
+             ("images", ("image2.tif", b"\x00\r\n" * 10, "application/octet-stream"))],
+            boundary=encoder.boundary)
+        assert body == expected
+        assert encoder.content_type == content_type
+        assert len(encoder) == len(body)
+
+    def test_files_are_read_in_chunks(self):
+        encoder = MultipartEncoder("images", [File(io.BytesIO(b"x" * 1000), name="image.jpg")], chunk_size=100)
+
+        assert max(len(chunk) for chunk in encoder) <= 200  # The part header and chunks of the file
+
+    def test_no_files(self):
+        encoder = MultipartEncoder("images", [])
+
+        assert b"".join(encoder) == f"--{encoder.boundary}--\r\n".encode()
+        assert len(encoder) == len(b"".join(encoder))
+
+
+class TestRaster:
+    """
+    Tests of core.utils.raster on real rasters, they need the GDAL Python bindings
+    """
+
+    @pytest.fixture
+    def gdal(self):
+        return pytest.importorskip("osgeo.gdal")
+
+    @pytest.fixture
+    def raster(self, gdal):
+        return importlib.import_module("core.utils.raster")
+
+    @pytest.fixture
+    def rgb(self, gdal, tmp_path):
+        from osgeo import osr
+
+        path = str(tmp_path / "rgb.tif")
+        dataset = gdal.GetDriverByName("GTiff").Create(path, 1100, 700, 3, gdal.GDT_Byte)
+        dataset.SetGeoTransform((600000, 0.05, 0, 9800000, 0, -0.05))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32717)
+        dataset.SetProjection(srs.ExportToWkt())
+        for i in range(3):
+            dataset.GetRasterBand(i + 1).WriteArray(
+                (numpy.indices((700, 1100)).sum(axis=0) * (i + 1) % 256).astype(numpy.uint8))
+        dataset = None
+        return path
+
+    @pytest.mark.parametrize("cog_driver", [True, False])
+    def test_to_cog_round_trip(self, gdal, raster, rgb, tmp_path, monkeypatch, cog_driver):
+        if cog_driver and gdal.GetDriverByName("COG") is None:
+            pytest.skip("The COG driver needs GDAL 3.1")
+        if not cog_driver:  # Like GDAL 3.0
+            get_driver = gdal.GetDriverByName
+            monkeypatch.setattr(gdal, "GetDriverByName", lambda name: None if name == "COG" else get_driver(name))
+        dst = str(tmp_path / "cog.tif")
+
+        raster.to_cog(rgb, dst)
+
+        src_dataset, dataset = gdal.Open(rgb), gdal.Open(dst)
+        assert dataset.GetGeoTransform() == src_dataset.GetGeoTransform()
+        assert dataset.GetProjection() == src_dataset.GetProjection()
+        for i in range(1, 4):
+            band = dataset.GetRasterBand(i)
+            assert band.GetBlockSize() == [512, 512]
+            assert band.GetOverviewCount() >= 1
+            assert band.GetOverview(0).XSize == 550
+            assert (band.ReadAsArray() == src_dataset.GetRasterBand(i).ReadAsArray()).all()
+        assert dataset.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") == "DEFLATE"
+        assert sorted(os.listdir(tmp_path)) == ["cog.tif", "rgb.tif"]  # No temporary files are left
+
+    def test_render_leaves_only_the_image(self, gdal, raster, rgb, tmp_path):
+        dst = str(tmp_path / "render_256.jpg")
+
+        raster.render(rgb, dst, 256)
+
+        dataset = gdal.Open(dst)
+        assert (dataset.RasterXSize, dataset.RasterYSize) == (256, 163)
+        assert sorted(os.listdir(tmp_path)) == ["render_256.jpg", "rgb.tif"]  # No .part or .aux.xml files
+
+    def test_to_png_leaves_only_the_image(self, gdal, raster, rgb, tmp_path):
+        dst = str(tmp_path / "rgb.png")
+
+        raster.to_png(rgb, dst)
+
+        assert (gdal.Open(dst).RasterXSize, gdal.Open(dst).RasterYSize) == (1100, 700)
+        assert sorted(os.listdir(tmp_path)) == ["rgb.png", "rgb.tif"]  # No .part or .aux.xml files
+
+    def test_replaced_files_are_not_read_stale(self, gdal, raster, rgb, tmp_path):
+        assert raster.info(rgb).width == 1100
+        smaller = str(tmp_path / "smaller.tif")
+        raster.translate(rgb, smaller, width=550, height=350)
+        os.replace(smaller, rgb)
+
+        assert raster.info(rgb).width == 550
+
+
+class TestBlockProcessing:
+    """
+    Tests of raster_calc and shaded_relief on real rasters (on GDAL's in-memory filesystem), they need the GDAL Python
+    bindings. Outputs are computed window by window, so they must match the same computation on the whole raster
+    """
+
+    @pytest.fixture
+    def gdal(self):
+        gdal = pytest.importorskip("osgeo.gdal")
+        yield gdal
+        for path in gdal.ReadDir("/vsimem/") or []:
+            gdal.Unlink("/vsimem/" + path)
+
+    @staticmethod
+    def create(gdal, path, bands, data_type, nodata=None):
+        height, width = bands[0].shape
+        dataset = gdal.GetDriverByName("GTiff").Create(path, width, height, len(bands), data_type,
+                                                       options=["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+        dataset.SetGeoTransform((600000, 0.5, 0, 9800000, 0, -0.5))
+        for i, data in enumerate(bands):
+            if nodata is not None:
+                dataset.GetRasterBand(i + 1).SetNoDataValue(nodata)
+            dataset.GetRasterBand(i + 1).WriteArray(data)
+        dataset.FlushCache()
+        return path
+
+    @staticmethod
+    def read(gdal, path):
+        return gdal.Open(path).ReadAsArray()
+
+    @pytest.mark.parametrize("use_numexpr", [True, False])
+    def test_calculate_many(self, gdal, use_numexpr):
+        from core.utils import raster_calc
+        y, x = numpy.indices((70, 90))
+        red = ((x + y) % 100 + 1).astype(numpy.uint16)
+        nir = red + x % 50
+        blue = numpy.full_like(red, 7)
+        blue[:10, :20] = 0  # nodata, on the mask of the first band
+        ortho = self.create(gdal, "/vsimem/ortho.tif", [blue, red, red, nir, red], gdal.GDT_UInt16, nodata=0)
+        parser = FormulaParser()
+
+        raster_calc.calculate_many(ortho, {"/vsimem/ndvi.tif": parser.compile(BUILTIN_FORMULAS["ndvi"]),
+                                           "/vsimem/diff.tif": parser.compile("nir - red * 2")},
+                                   block_size=32, use_numexpr=use_numexpr)
+
+        nir, red = nir.astype(numpy.float32), red.astype(numpy.float32)
+        for path, values in (("/vsimem/ndvi.tif", ((nir - red) / (nir + red) + 1) * 127),
+                             ("/vsimem/diff.tif", nir - red * 2)):
+            expected = numpy.rint(numpy.clip(values, 0, 255))
+            expected[:10, :20] = 0
+            assert numpy.abs(self.read(gdal, path) - expected).max() <= 1
+            assert gdal.Open(path).GetGeoTransform() == gdal.Open(ortho).GetGeoTransform()
+
+    def test_render_shaded_relief(self, gdal):
+        from core.utils.shaded_relief import render_shaded_relief
+        y, x = numpy.indices((60, 80))
+        dem = (100 + 0.5 * x + 0.02 * (y - 30) ** 2).astype(numpy.float32)
+        dem[:5, :5] = -9999
+        self.create(gdal, "/vsimem/dsm.tif", [dem], gdal.GDT_Float32, nodata=-9999)
+
+        render_shaded_relief("/vsimem/dsm.tif", "/vsimem/out.tif", TestShadedRelief.COLOR_FILE, block_size=32,
+                             color_path="/vsimem/color.tif", hillshade_path="/vsimem/hillshade.tif")
+
+        padded = numpy.full((62, 82), numpy.nan, dtype=numpy.float32)
+        padded[1:-1, 1:-1] = numpy.where(dem == -9999, numpy.nan, dem)
+        shade = numpy.rint(numpy.nan_to_num(hillshade(padded, 0.5, -0.5), nan=0)).astype(numpy.uint8)
+        ramp = color_ramp.load(TestShadedRelief.COLOR_FILE)
+        valid = dem[dem != -9999]
+        lut = color_ramp.lookup_table(ramp, valid.min(), valid.max())
+        color = color_ramp.colorize(padded[1:-1, 1:-1], lut, valid.min(), valid.max(), ramp.nodata_color)
+        assert (self.read(gdal, "/vsimem/hillshade.tif") == shade).all()
+        assert (self.read(gdal, "/vsimem/color.tif") == color).all()
+        out = self.read(gdal, "/vsimem/out.tif").astype(int)
+        assert numpy.abs(out[:3] - merge_intensity(color[:3], shade, nodata=0)).max() <= 1
+        assert (out[3] == color[3]).all()
+        assert shade[0].max() == 0 and shade[1:-1, 6:-1].min() > 0  # No hillshade on the edges, like gdaldem
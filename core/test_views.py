@@ -2,66 +2,21 @@ import inspect
 import json
 import os
 import re
+import sys
 from datetime import datetime
+from types import SimpleNamespace
 from typing import List
 
 import pytest
-from PIL import Image, ImageOps, ImageFont, ImageDraw
 from django.urls import reverse
 from httpretty import httpretty
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
-from core.models import FlightState, UserType, Flight, Camera, UserProject, ArtifactType, Artifact, User
-
-
-class MockFont:
-    pass
-
-
-class MockDraw:
-    @staticmethod
-    def textsize(text: str, font: MockFont):
-        del (text,)  # unused
-        assert isinstance(font, MockFont)
-        return 100, 10
-
-    @staticmethod
-    def text(pos, text, color, font):
-        del (pos, text, color)  # unused
-        assert isinstance(font, MockFont)
-
-
-class MockImage:
-    def thumbnail(self, size):
-        assert size == (512, 512)
-        return self
-
-    def resize(self, xy):
-        del (xy,)  # unused
-        return self
-
-    def save(self, out_path: str, fmt: str):
-        assert out_path.endswith(".png")
-        assert fmt == "PNG"
-        return self
-
-    def putalpha(self, mask):
-        assert isinstance(mask, MockImage)
-        return self
-
-    def paste(self, another, xy):
-        del (xy,)  # unused
-        assert isinstance(another, MockImage)
-        return self
-
-    def split(self):
-        return [self]
-
-    def putpixel(self, xy, color):
-        del (color,)  # unused
-        assert xy[1] == 0
-        return self
+from core.jobs import enqueue_flight_postprocessing, run_next_job
+from core.models import FlightState, UserType, Flight, Camera, UserProject, ArtifactType, Artifact, User, Job, \
+    JobState
+from core.utils.multipart import BatchUploadHandler
 
 
 @pytest.mark.django_db
@@ -149,6 +104,42 @@ class TestStandaloneViews:
         users[0].refresh_from_db()
         assert users[0].remaining_images == 18
 
+    def test_upload_images_in_batches(self, c, users, flights, fs, settings, monkeypatch):
+        settings.NODEODM_UPLOAD_BATCH_SIZE = 1
+        previous_requests = len(httpretty.latest_requests)
+        events, sent_files = [], []
+        new_file, send_batch = BatchUploadHandler.new_file, BatchUploadHandler._send_batch
+
+        def record_new_file(handler, *args, **kwargs):
+            events.append("received")
+            return new_file(handler, *args, **kwargs)
+
+        def record_send_batch(handler):
+            events.append("sent")
+            sent_files.extend(handler.batch)
+            return send_batch(handler)
+
+        monkeypatch.setattr(BatchUploadHandler, "new_file", record_new_file)
+        monkeypatch.setattr(BatchUploadHandler, "_send_batch", record_send_batch)
+
+        resp = self._test_upload_two_images(c, fs, users, flights)
+
+        assert resp.status_code == 200
+        # Every image is sent before the next one is received, and its temporary file is closed
+        assert events == ["received", "sent", "received", "sent"]
+        assert len(sent_files) == 2 and all(f.closed for f in sent_files)
+        # httpretty records every chunk of a streamed body as another request, with the same headers
+        uploads = {}
+        for request in httpretty.latest_requests[previous_requests:]:
+            if "/task/new/upload/" in request.path:
+                uploads.setdefault(request.headers["Content-Type"], request)
+        assert len(uploads) == 2  # one request per image
+        for upload, name in zip(uploads.values(), ("image1.jpg", "image2.jpg")):
+            assert upload.headers["Content-Type"].startswith("multipart/form-data; boundary=")
+            assert int(upload.headers["Content-Length"]) == len(upload.body)
+            assert upload.body.count(b"filename=") == 1
+            assert f'filename="{name}"'.encode() in upload.body
+
     def test_upload_images_error_on_creation(self, c, users, flights, fs):
         import inspect
         import django
@@ -229,6 +220,68 @@ class TestStandaloneViews:
         assert resp.status_code == 402
         assert resp.content.decode("utf8") == "Subida fallida. Tiene un límite de 1 imágenes."
 
+    def test_upload_images_too_many_after_a_batch(self, c, fs, users: List[User], flights, settings):
+        settings.NODEODM_UPLOAD_BATCH_SIZE = 1
+        users[0].remaining_images = 1
+        users[0].save()
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/remove", "")
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/new/init", "")
+        httpretty.register_uri(httpretty.POST, "http://container-webhook-adapter:8080/register/" + str(flights[0].uuid),
+                               "")
+        previous_requests = len(httpretty.latest_requests)
+
+        resp = self._test_upload_two_images(c, fs, users, flights)
+
+        assert resp.status_code == 402
+        # The first image was already sent when the second one arrived, so the task is created again without it
+        paths = [request.path for request in httpretty.latest_requests[previous_requests:]]
+        assert any(path.startswith("/task/remove") for path in paths)
+        assert any(path.startswith("/task/new/init") for path in paths)
+        assert not any(path.startswith("/task/new/commit") for path in paths)
+        users[0].refresh_from_db()
+        assert users[0].remaining_images == 1
+
+    @pytest.mark.parametrize("failure", ["batch", "commit"])
+    def test_upload_images_failed_after_a_batch(self, c, fs, users: List[User], flights, settings, failure):
+        settings.NODEODM_UPLOAD_BATCH_SIZE = 1
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/remove", "")
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/new/init", "")
+        httpretty.register_uri(httpretty.POST, "http://container-webhook-adapter:8080/register/" + str(flights[0].uuid),
+                               "")
+        previous_requests = len(httpretty.latest_requests)
+        remaining_images = users[0].remaining_images
+
+        def upload(request, uri, response_headers):
+            failed = failure == "batch" and b'filename="image2.jpg"' in request.body
+            return [500 if failed else 200, response_headers, ""]
+
+        def commit(request, uri, response_headers):
+            return [500 if failure == "commit" else 200, response_headers, ""]
+
+        self._auth(c, users[0])
+        import django
+        import pytz
+        fs.add_real_directory(os.path.dirname(inspect.getfile(django)))
+        fs.add_real_directory(os.path.dirname(inspect.getfile(pytz)))
+        fs.create_file("/tmp/image1.jpg", contents="foobar")
+        fs.create_file("/tmp/image2.jpg", contents="foobar")
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/new/upload/" + str(flights[0].uuid),
+                               body=upload)
+        httpretty.register_uri(httpretty.POST, "http://container-nodeodm:3000/task/new/commit/" + str(flights[0].uuid),
+                               body=commit)
+        with open("/tmp/image1.jpg") as f1, open("/tmp/image2.jpg") as f2:
+            resp = c.post(reverse('upload_files', kwargs={"uuid": flights[0].uuid}), {"images": [f1, f2]})
+
+        assert resp.status_code == 500
+        # Some images were already sent, so the task is created again without them, and a retry doesn't repeat them
+        paths = [request.path for request in httpretty.latest_requests[previous_requests:]]
+        assert any(path.startswith("/task/remove") for path in paths)
+        assert any(path.startswith("/task/new/init") for path in paths)
+        users[0].refresh_from_db()
+        assert users[0].remaining_images == remaining_images
+        flights[0].refresh_from_db()
+        assert flights[0].state != FlightState.PROCESSING.name
+
     def _test_webhook(self, c, monkeypatch, fs, flight, false_code, real_code):
         """
         Helper function that tests the webhook with configurable behavior
@@ -292,89 +345,30 @@ class TestStandaloneViews:
         fs.create_file("/flights/{}/odm_orthophoto/odm_orthophoto_small.tif".format(flight.uuid), contents="")
         fs.create_file("/flights/{}/images.json".format(flight.uuid), contents="[]")
 
-        def mock_create_image(*args, **kwargs):
-            del (args, kwargs)  # unused
-            return MockImage()
-
-        def mock_create_font(*args, **kwargs):
-            del (kwargs,)  # unused
-            assert args[0] == "DejaVuSans.ttf"
-            return MockFont()
-
-        def mock_create_draw(*args, **kwargs):
-            del (kwargs,)  # unused
-            assert isinstance(args[0], MockImage)
-            return MockDraw()
-
-        def mock_subprocess(*args, **kwargs):
-            del (kwargs,)  # unused
-
-            class FakeStdout:
-                @staticmethod
-                def decode(encoding):
-                    assert encoding == "utf-8"
-                    return "PROJ.4 string is:\n'+proj=longlat +datum=WGS84 +no_defs'\n" \
-                           "Origin = (0.0,0.0)\nPixel Size = (1.0,1.0)\n" \
-                           "Computed Min/Max=0.0,1.0"
-
-            class FakeSubprocessCall:
-                stdout = FakeStdout()
-
-            assert "gdalinfo" == args[0][0]
-            return FakeSubprocessCall()
-
         def donothing(*args, **kwargs):
             del (args, kwargs)  # unused
             # intentionally empty
 
-        def mock_figure(*args, **kwargs):
-            del (args, kwargs)  # unused
-
-            class MockCanvas:
-                def draw(self):
-                    # intentionally empty
-                    pass
-
-                @staticmethod
-                def tostring_rgb():
-                    return ""
-
-                @staticmethod
-                def get_width_height():
-                    return 100, 200
-
-            class MockFigure:
-                canvas = MockCanvas()
-
-            return MockFigure()
-
-        def mock_fromstring(*args, **kwargs):
-            del (args, kwargs)  # unused
-
-            class FakeNumpy:
-                def reshape(self, new_shape):
-                    assert new_shape == (200, 100, 3)  # Reverse X and Y, add a 3 for RGB channels
-                    return self
-
-            return FakeNumpy()
-
-        monkeypatch.setattr(Image, "open", mock_create_image)
-        monkeypatch.setattr(Image, "new", mock_create_image)
-        monkeypatch.setattr(ImageFont, "truetype", mock_create_font)
-        monkeypatch.setattr(ImageOps, "fit", mock_create_image)
-        monkeypatch.setattr(ImageDraw, "Draw", mock_create_draw)
-        import matplotlib
-        import numpy
-        monkeypatch.setattr(matplotlib.pyplot, "imread", donothing)
-        monkeypatch.setattr(matplotlib.pyplot, "figure", mock_figure)
-        monkeypatch.setattr(matplotlib.pyplot, "axis", donothing)
-        monkeypatch.setattr(matplotlib.pyplot, "imshow", donothing)
-        monkeypatch.setattr(matplotlib.pyplot, "imsave", donothing)
-        monkeypatch.setattr(numpy, "fromstring", mock_fromstring)
-        import subprocess
-        monkeypatch.setattr(subprocess, "run", mock_subprocess)
+        # GDAL isn't available on the test environment, replace the in-process raster operations
+        import core.utils
+        fake_raster = SimpleNamespace(
+            to_png=donothing, extract_bands=donothing, create_previews=donothing, convert_to_cog=donothing,
+            min_max=lambda path: (0.0, 1.0),
+            info=lambda path: SimpleNamespace(geotransform=(0.0, 1.0, 0.0, 0.0, 0.0, 1.0), projection="EPSG:4326",
+                                              proj4="+proj=longlat +datum=WGS84 +no_defs"))
+        monkeypatch.setitem(sys.modules, "core.utils.raster", fake_raster)
+        monkeypatch.setattr(core.utils, "raster", fake_raster, raising=False)
+        import core.utils.shaded_relief
+        monkeypatch.setattr(core.utils.shaded_relief, "render_shaded_relief", donothing)
+        import core.utils.markers
+        monkeypatch.setattr(core.utils.markers, "annotate_image", donothing)
+        import core.utils.colorbar_creator
+        monkeypatch.setattr(core.utils.colorbar_creator, "create_colorbar", donothing)
         resp = c.post(reverse("webhook"), json.dumps(
             {"uuid": str(flight.uuid), "status": {"code": false_code}}), content_type="application/text")
+        # Post-processing is queued by the webhook, run it right now
+        while run_next_job() is not None:
+            pass
         if real_code == 40:
             assert all(executed)
         else:
@@ -384,7 +378,7 @@ class TestStandaloneViews:
     def test_webhook_successful(self, c, monkeypatch, fs, flights):
         resp = self._test_webhook(c, monkeypatch, fs, flights[0], false_code=40, real_code=40)
 
-        assert resp.status_code == 200
+        assert resp.status_code == 202  # post-processing has been queued
         flights[0].refresh_from_db()
         assert flights[0].state == FlightState.COMPLETE.name
         flights[0].user.refresh_from_db()
@@ -418,7 +412,7 @@ class TestStandaloneViews:
 
     def test_webhook_doesnt_trust_webhook_data(self, c, monkeypatch, fs, flights):
         resp = self._test_webhook(c, monkeypatch, fs, flights[0], false_code=50, real_code=40)
-        assert resp.status_code == 200
+        assert resp.status_code == 202
         flights[0].refresh_from_db()
         assert flights[0].state == FlightState.COMPLETE.name  # Should be COMPLETE (40), not CANCELED (50)
         # This time comes from the REAL API call, the webhook POST has no processing time
@@ -468,6 +462,111 @@ class TestStandaloneViews:
         resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "someunknownartifact"}))
         assert resp.status_code == 404
 
+    def test_download_optional_artifact_lazily(self, c, flights, fs, monkeypatch):
+        uuid = str(flights[0].uuid)
+        fetched = []
+
+        def mock_download(flight, include=None):
+            fetched.extend(include)
+            fs.create_file("/flights/" + uuid + "/odm_texturing/odm_textured_model.obj", contents="the texture")
+
+        monkeypatch.setattr(Flight, "download_and_decompress_results", mock_download)
+        httpretty.register_uri(httpretty.GET, f"http://container-nodeodm:3000/task/{uuid}/download/all.zip",
+                               status=206, content_type="application/zip", body=b"P",
+                               adding_headers={"Content-Range": "bytes 0-0/1000"})
+        fs.create_dir("/flights/" + uuid)
+        for _ in range(2):
+            resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "3dmodel_texture"}))
+            assert resp.status_code == 202  # the extraction runs on a Job, only queued once
+            job = Job.objects.get()
+            assert resp.json() == {"job": job.pk, "status": reverse("job_status", kwargs={"pk": job.pk})}
+            assert resp["Location"] == reverse("job_status", kwargs={"pk": job.pk})
+        assert fetched == []
+
+        assert run_next_job() is not None
+        assert run_next_job() is None
+        assert fetched == ["odm_texturing"]  # the whole folder, since the model needs its textures
+
+        resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "3dmodel_texture"}))
+        assert next(resp.streaming_content).decode("utf-8") == "the texture"
+        assert fetched == ["odm_texturing"]  # not fetched again
+
+    def test_download_optional_artifact_of_removed_task(self, c, flights, fs):
+        uuid = str(flights[0].uuid)
+        # What NodeODM answers after the task was removed
+        httpretty.register_uri(httpretty.GET, f"http://container-nodeodm:3000/task/{uuid}/download/all.zip",
+                               body=json.dumps({"error": f"{uuid} not found"}), content_type="application/json")
+        fs.create_dir("/flights/" + uuid)
+
+        resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "3dmodel"}))
+
+        assert resp.status_code == 410
+        assert run_next_job() is None
+
+    def test_download_png_ortho_lazily(self, c, flights, fs, monkeypatch):
+        uuid = str(flights[0].uuid)
+        converted = []
+
+        def mock_tiff_to_png(tiff, png):
+            converted.append(tiff)
+            fs.create_file(png, contents="PNG orthomosaic")
+
+        monkeypatch.setattr(Flight, "tiff_to_png", staticmethod(mock_tiff_to_png))
+        fs.create_file("/flights/" + uuid + "/odm_orthophoto/rgb.tif", contents="the ortho")
+        for _ in range(2):
+            resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "orthomosaic.png"}))
+            assert resp.status_code == 202  # created by a Job, only queued once
+        assert converted == []
+
+        assert c.head(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "orthomosaic.png"})).status_code == 202
+
+        assert run_next_job() is not None
+        assert run_next_job() is None
+        resp = c.head(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "orthomosaic.png"}))
+        assert resp.status_code == 200  # ready, without streaming it
+        for _ in range(2):
+            resp = c.get(reverse("download_artifact", kwargs={"uuid": uuid, "artifact": "orthomosaic.png"}))
+            assert next(resp.streaming_content).decode("utf-8") == "PNG orthomosaic"
+        assert converted == ["/flights/" + uuid + "/odm_orthophoto/rgb.tif"]  # created once, then cached
+
+    def test_render_preview(self, c, flights, fs, monkeypatch, settings):
+        import core.utils
+        settings.RENDER_MAX_SIZE = 1024
+        rendered = []
+
+        def mock_render(src, dst, max_size, driver):
+            rendered.append((max_size, driver))
+            fs.create_file(dst, contents="the render")
+
+        fake_raster = SimpleNamespace(render=mock_render)  # GDAL isn't available on the test environment
+        monkeypatch.setitem(sys.modules, "core.utils.raster", fake_raster)
+        monkeypatch.setattr(core.utils, "raster", fake_raster, raising=False)
+        uuid = flights[0].uuid
+        fs.create_dir(flights[0].get_disk_path() + "/odm_orthophoto")
+        resp = c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 600, "extension": "jpg"}))
+        assert resp.status_code == 404  # not processed yet
+        flights[0].state = FlightState.COMPLETE.name
+        flights[0].save()
+        job = enqueue_flight_postprocessing(flights[0])
+        resp = c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 600, "extension": "jpg"}))
+        assert resp.status_code == 409  # rgb.tif doesn't exist yet
+        job.state = JobState.ERROR.name
+        job.save()
+        resp = c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 600, "extension": "jpg"}))
+        assert resp.status_code == 404  # the post-processing failed
+        fs.create_file(flights[0].get_disk_path() + "/odm_orthophoto/rgb.tif")
+
+        resp = c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 600, "extension": "jpg"}))
+        assert next(resp.streaming_content).decode("utf-8") == "the render"
+        c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 700, "extension": "jpg"}))
+        c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 5000, "extension": "webp"}))
+        c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 0, "extension": "webp"}))
+        # 600 and 700 are both rounded to 768, which is cached; sizes are between 256 and RENDER_MAX_SIZE
+        assert rendered == [(768, "JPEG"), (1024, "WEBP"), (256, "WEBP")]
+
+        resp = c.get(reverse("render_flight_preview", kwargs={"uuid": uuid, "size": 600, "extension": "gif"}))
+        assert resp.status_code == 404
+
     def test_download_report(self, c, flights, fs, monkeypatch):
         uuid = str(flights[0].uuid)
         report_invoked = False
@@ -658,7 +757,7 @@ class TestStandaloneViews:
         assert projects[0].user.used_space == 50 * 1024 ** 2
 
     @staticmethod
-    def _upload_index(c, fs, flights, projects):
+    def _upload_index(c, fs, flights, projects, monkeypatch, indices=None, calculations=None):
         """
         Helper function to upload a raster index to a Project
         Args:
@@ -666,28 +765,50 @@ class TestStandaloneViews:
             fs: The pyfakefs fixture
             flights: A fixture containing pregenerated Projects
             projects: A fixture containing pregenerated Projects
+            monkeypatch: The monkeypatch fixture
+            indices: If given, a dict from index name to formula to upload in a batch. By default, a single index
+                called my_index is uploaded
+            calculations: If given, a list where the outputs of every raster calculation are appended
         """
         project: UserProject = projects[0]
         flight: Flight = flights[0]
         flight.state = FlightState.COMPLETE.name
         flight.save()
         fs.create_dir("/projects/{}".format(project.uuid))
-        fs.create_file("/flights/{}/odm_orthophoto/my_index.tif".format(flight.uuid), contents="A" * 1024 ** 2)
         import django
         import lark
         fs.add_real_directory(os.path.dirname(inspect.getfile(django)))
         fs.add_real_directory(os.path.dirname(inspect.getfile(lark)))
-        httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/workspaces/project_" +
-                               str(project.uuid) + "/coveragestores/my_index/external.imagemosaic", "")
-        httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/workspaces/project_" +
-                               str(project.uuid) + "/coveragestores/my_index/coverages/my_index.json", "")
-        httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/layers/project_" +
-                               str(project.uuid) + ":my_index.json", "")
-        resp = c.post(reverse("create_raster_index", kwargs={"uuid": str(project.uuid)}),
-                      json.dumps({"index": "my_index", "formula": "red+1"}), content_type="application/text")
-        return resp
-
-    def test_upload_index(self, c, fs, flights, projects):
+        for index in (indices or {"my_index": "red+1"}):
+            httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/workspaces/project_" +
+                                   str(project.uuid) + "/coveragestores/" + index + "/external.imagemosaic", "")
+            httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/workspaces/project_" +
+                                   str(project.uuid) + "/coveragestores/" + index + "/coverages/" + index + ".json",
+                                   "")
+            httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/layers/project_" +
+                                   str(project.uuid) + ":" + index + ".json", "")
+        # GDAL isn't available on the test environment, replace the in-process raster operations
+        import core.utils
+        import core.utils.raster_calc
+        fake_raster = SimpleNamespace(convert_to_cog=lambda *args, **kwargs: None)
+        monkeypatch.setitem(sys.modules, "core.utils.raster", fake_raster)
+        monkeypatch.setattr(core.utils, "raster", fake_raster, raising=False)
+        if calculations is None:
+            calculations = []
+
+        def mock_calculate_many(src, outputs, *args, **kwargs):
+            calculations.append(outputs)
+            for path in outputs:
+                fs.create_file(path, contents="A" * 1024 ** 2)
+
+        monkeypatch.setattr(core.utils.raster_calc, "calculate_many", mock_calculate_many)
+        if indices is None:
+            return c.post(reverse("create_raster_index", kwargs={"uuid": str(project.uuid)}),
+                          json.dumps({"index": "my_index", "formula": "red+1"}), content_type="application/text")
+        return c.post(reverse("create_raster_indices", kwargs={"uuid": str(project.uuid)}),
+                      json.dumps({"indices": indices}), content_type="application/text")
+
+    def test_upload_index(self, c, fs, flights, projects, monkeypatch):
         """
         Tests uploading a raster index in the successful case
         Args:
@@ -695,16 +816,27 @@ class TestStandaloneViews:
             fs: The pyfakefs fixture
             flights: A fixture containing pregenerated Projects
             projects: A fixture containing pregenerated Projects
+            monkeypatch: The monkeypatch fixture
         """
-        resp = self._upload_index(c, fs, flights, projects)
-        assert resp.status_code == 200
-
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch)
+        assert resp.status_code == 202
+        status_url = reverse("job_status", kwargs={"pk": resp.json()["job"]})
+        assert c.get(status_url).status_code == 401
+        self._auth(c, projects[0].user)
+        assert c.get(status_url).json()["progress"] == 0.0
+
+        # The indices are created in the background
+        assert run_next_job() is not None
+        status = c.get(status_url).json()
+        assert status["state"] == "COMPLETE"
+        assert status["progress"] == 1.0
+        assert status["stages"] == [{"name": "create_index_rasters:" + str(flights[0].uuid), "state": "COMPLETE"}]
         projects[0].refresh_from_db()
         projects[0].user.refresh_from_db()
-        assert projects[0].used_space == 1024  # 1MB for the fake index
-        assert projects[0].user.used_space == 2048  # 1MB for the fake index in the Flight, same for the Project
+        assert projects[0].used_space == 0  # The index is shared with the Flight
+        assert projects[0].user.used_space == 1024  # 1MB for the fake index in the Flight
 
-    def test_upload_index_over_quota(self, c, fs, flights, projects):
+    def test_upload_index_over_quota(self, c, fs, flights, projects, monkeypatch):
         """
         Tests that uploading a raster index to a Project fails if the User is over his disk quota
         Args:
@@ -712,10 +844,11 @@ class TestStandaloneViews:
             fs: The pyfakefs fixture
             flights: A fixture containing pregenerated Projects
             projects: A fixture containing pregenerated Projects
+            monkeypatch: The monkeypatch fixture
         """
         projects[0].user.used_space = 50 * 1024 ** 2
         projects[0].user.save()
-        resp = self._upload_index(c, fs, flights, projects)
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch)
 
         assert resp.status_code == 402
         projects[0].refresh_from_db()
@@ -723,6 +856,70 @@ class TestStandaloneViews:
         assert projects[0].used_space == 0
         assert projects[0].user.used_space == 50 * 1024 ** 2
 
+    def test_upload_indices(self, c, fs, flights, projects, monkeypatch):
+        calculations = []
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch,
+                                  indices={"ndvi": "", "my_index": "red+1"}, calculations=calculations)
+        assert resp.status_code == 202
+        run_next_job()
+
+        # The orthophoto of the only Flight is read once, for both indices
+        assert len(calculations) == 1
+        assert sorted(formula.bands for formula in calculations[0].values()) == [["red"], ["red", "nir"]]
+        assert {a.name for a in projects[0].artifacts.all()} == {"ndvi", "my_index"}
+        projects[0].refresh_from_db()
+        flights[0].refresh_from_db()
+        assert projects[0].used_space == 0
+        assert flights[0].used_space == 2 * 1024  # the index files are hardlinks to the cached ones
+
+    def test_upload_index_reuses_cached_formula(self, c, fs, flights, projects, monkeypatch):
+        calculations = []
+        self._upload_index(c, fs, flights, projects, monkeypatch, indices={"my_index": "nir+ red"},
+                           calculations=calculations)
+        run_next_job()
+        # Same formula under another name, written differently
+        workspace = "http://container-geoserver:8080/geoserver/rest/workspaces/project_" + str(projects[0].uuid)
+        httpretty.register_uri(httpretty.PUT, workspace + "/coveragestores/other/external.imagemosaic", "")
+        httpretty.register_uri(httpretty.PUT, workspace + "/coveragestores/other/coverages/other.json", "")
+        httpretty.register_uri(httpretty.PUT, "http://container-geoserver:8080/geoserver/rest/layers/project_" +
+                               str(projects[0].uuid) + ":other.json", "")
+        resp = c.post(reverse("create_raster_indices", kwargs={"uuid": str(projects[0].uuid)}),
+                      json.dumps({"indices": {"other": "(red+nir)"}}), content_type="application/text")
+        assert resp.status_code == 202
+        run_next_job()
+
+        assert len(calculations) == 1
+        odm_orthophoto = flights[0].get_disk_path() + "/odm_orthophoto/"
+        assert os.path.samefile(odm_orthophoto + "my_index.tif", odm_orthophoto + "other.tif")
+
+    def test_upload_indices_invalid_formula(self, c, fs, flights, projects, monkeypatch):
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch, indices={"ndvi": "", "my_index": "red+"})
+        assert resp.status_code == 400
+        assert not projects[0].artifacts.exists()
+
+    def test_upload_index_invalid_formula(self, c, fs, flights, projects, monkeypatch):
+        resp = c.post(reverse("create_raster_index", kwargs={"uuid": str(projects[0].uuid)}),
+                      json.dumps({"index": "my_index", "formula": "red+"}), content_type="application/text")
+        assert resp.status_code == 400
+        assert not projects[0].jobs.exists()
+
+    def test_upload_index_already_exists(self, c, fs, flights, projects, monkeypatch):
+        projects[0].artifacts.create(name="my_index", type=ArtifactType.INDEX.name, title="MY_INDEX")
+
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch)
+
+        assert resp.status_code == 409
+        assert not projects[0].jobs.exists()
+
+    def test_job_status_other_user(self, c, fs, users, flights, projects, monkeypatch):
+        resp = self._upload_index(c, fs, flights, projects, monkeypatch)
+        status_url = reverse("job_status", kwargs={"pk": resp.json()["job"]})
+
+        self._auth(c, users[1])
+        assert c.get(status_url).status_code == 403
+        self._auth(c, users[2])  # admin
+        assert c.get(status_url).status_code == 200
+
     def test_preview_flight_url(self, c, flights):
         executed = False
 
@@ -336,8 +336,8 @@ class TestUserProjectViewSet(FlightsMixin, BaseTestViewSet):
         assert resp.status_code == 201
         data = resp.json()
         p = UserProject.objects.get(uuid=data["uuid"])
-        assert p.used_space == 2048  # 2 orthomosaics, each takes 1MB
-        assert users[0].used_space == 6 * 1024  # 2 flights of 2MB each (2 orthos, 1MB each) and the project takes 2MB
+        assert p.used_space == 0  # The 2 orthomosaics are shared with the flights, only small text files are left
+        assert users[0].used_space == 4 * 1024  # 2 flights of 2MB each (2 orthos, 1MB each)
 
     def test_project_deletion_disk_space(self, c, fs, users: List[User], flights: List[Flight],
                                          projects: List[UserProject]):
@@ -355,4 +355,5 @@ class TestUserProjectViewSet(FlightsMixin, BaseTestViewSet):
         c.delete(reverse('projects-detail', kwargs={"pk": str(p.uuid)}))  # Issue single DELETE request
 
         users[0].refresh_from_db()
-        assert users[0].used_space < prev_space  # not 0 because there are leftover FLights and Projects
+        # The project only had files shared with the flights, which are still there
+        assert users[0].used_space == prev_space
@@ -4,7 +4,9 @@ from lark import LarkError
 from .models import *
 
 # Create your tests here.
+from .parser import BUILTIN_FORMULAS
 from .templatetags.greaterthan import gt
+from .utils.raster_calc import BANDS, to_byte
 
 
 class TestParser:
@@ -56,6 +58,51 @@ class TestParser:
     def test_unary_minus_complex(self, parser):
         assert parser.make_string("blue/(-red)") == "asarray(A, dtype=float32)/(-1.0*asarray(C, dtype=float32))"
 
+    def test_compile_reads_only_used_bands(self, parser):
+        assert parser.compile("(nir-red)/(nir+red)").bands == ["red", "nir"]
+        assert parser.compile("2*3").bands == []
+
+    @pytest.mark.parametrize("formula, expected", [
+        ("nir", lambda b, g, r, n, e: n),
+        ("blue-green+red-nir", lambda b, g, r, n, e: b - g + r - n),
+        ("blue/green*red", lambda b, g, r, n, e: b / g * r),
+        ("-red**2+rdedge", lambda b, g, r, n, e: -r ** 2 + e),
+        ("((nir-red)/(nir+red)+1)*127", lambda b, g, r, n, e: ((n - r) / (n + r) + 1) * 127),
+    ])
+    def test_compiled_formula(self, parser, formula, expected):
+        import numpy
+        bands = numpy.random.default_rng(42).uniform(1, 100, size=(5, 4, 3)).astype(numpy.float32)
+        compiled = parser.compile(formula)
+        values = {name: bands[BANDS[name] - 1] for name in compiled.bands}
+
+        for use_numexpr in (False, True):
+            result = compiled.evaluate(values, compiled.allocate((4, 3)), use_numexpr)
+            numpy.testing.assert_allclose(result, expected(*bands), rtol=1e-5)
+
+    def test_compiled_formula_to_byte(self, parser):
+        import numpy
+        compiled = parser.compile(BUILTIN_FORMULAS["ndvi"])
+        red = numpy.array([[1, 0, 0, 50]], dtype=numpy.float32)
+        nir = numpy.array([[1, 0, 10, 0]], dtype=numpy.float32)
+
+        result = compiled.evaluate({"red": red, "nir": nir}, compiled.allocate(red.shape), use_numexpr=False)
+
+        # 0/0 is not a number, so it becomes nodata
+        assert to_byte(result, numpy.empty(red.shape, dtype=numpy.uint8)).tolist() == [[127, 0, 254, 0]]
+
+    def test_parser_is_shared(self, parser):
+        assert FormulaParser().parser is parser.parser
+        assert parser.compile("nir/red").instructions == FormulaParser().compile("nir/red").instructions
+
+    def test_normalize(self, parser):
+        assert parser.normalize("((nir +red))") == parser.normalize("red+nir") == "(nir+red)"
+        assert parser.normalize("red*2") == parser.normalize("2.0 * red")
+        assert parser.normalize("nir-red") != parser.normalize("red-nir")
+
+    def test_formula_hash(self, parser):
+        assert parser.formula_hash("(nir-red)/(nir+red)") == parser.formula_hash("(nir - red) / (red + nir)")
+        assert parser.formula_hash("(nir-red)/(nir+red)") != parser.formula_hash("(nir-red)/(nir-red)")
+
 
 class TestGreaterThanTemplateTag:
     def test_tag(self):
@@ -0,0 +1,80 @@
+"""
+Colour ramps in the gdaldem color-relief text format (e.g. color_relief.txt), applied with lookup tables
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy
+
+ColorRamp = namedtuple("ColorRamp", ["stops", "nodata_color"])
+ColorRamp.__doc__ = """
+A parsed colour ramp
+
+Attributes:
+    stops: List of (value, is_percentage, (r, g, b, a)) tuples, sorted by value
+    nodata_color: (r, g, b, a) for nodata pixels
+"""
+
+LUT_SIZE = 1024
+
+
+@lru_cache()
+def load(path: str) -> ColorRamp:
+    """
+    Parses a gdaldem color-relief colour file. Lines are "<value> <r> <g> <b> [<a>]", where value is an elevation,
+    a percentage of the raster range (e.g. 10%) or nv (nodata)
+    """
+    stops, nodata_color = [], (0, 0, 0, 0)
+    with open(path) as f:
+        for line in f:
+            fields = re.split(r"[\s,:]+", line.strip())
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            color = tuple(int(c) for c in fields[1:5])
+            color = color + (255,) * (4 - len(color))
+            if fields[0] == "nv":
+                nodata_color = color
+            elif fields[0].endswith("%"):
+                stops.append((float(fields[0][:-1]), True, color))
+            else:
+                stops.append((float(fields[0]), False, color))
+    return ColorRamp(stops=sorted(stops, key=lambda stop: stop[0]), nodata_color=nodata_color)
+
+
+def lookup_table(ramp: ColorRamp, min_value: float, max_value: float, size: int = LUT_SIZE):
+    """
+    Samples a colour ramp at size evenly spaced values between min_value and max_value, interpolating linearly between
+    stops like gdaldem does. Percentages are relative to [min_value, max_value]
+
+    Returns: A uint8 array of shape (4, size)
+    """
+    values = [min_value + value / 100 * (max_value - min_value) if is_percentage else value
+              for value, is_percentage, _ in ramp.stops]
+    samples = numpy.linspace(min_value, max_value, size)
+    return numpy.array([numpy.rint(numpy.interp(samples, values, [color[band] for _, _, color in ramp.stops]))
+                        for band in range(4)], dtype=numpy.uint8)
+
+
+def colorize(data, lut, min_value: float, max_value: float, nodata_color, out=None):
+    """
+    Applies a lookup table from lookup_table() to an array
+
+    Args:
+        data: Float array of shape (height, width). NaN is nodata
+        lut: Lookup table for [min_value, max_value]
+        min_value: The value of the first entry of lut
+        max_value: The value of the last entry of lut
+        nodata_color: (r, g, b, a) for NaN values
+        out: Optional uint8 array of shape (4, height, width) that receives the result
+
+    Returns: The RGBA colours, as a uint8 array of shape (4, height, width) (out, if given)
+    """
+    size = lut.shape[1]
+    factor = (size - 1) / (max_value - min_value) if max_value > min_value else 0
+    nodata = numpy.isnan(data)
+    index = numpy.nan_to_num((data - min_value) * factor)
+    numpy.clip(index, 0, size - 1, out=index)
+    out = numpy.take(lut, numpy.rint(index).astype(numpy.intp), axis=1, out=out)
+    out[:, nodata] = numpy.array(nodata_color, dtype=numpy.uint8)[:, numpy.newaxis]
+    return out
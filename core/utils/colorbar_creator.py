@@ -1,48 +1,23 @@
+import io
+from functools import lru_cache
+
+import numpy
 from PIL import Image, ImageDraw, ImageFont
-from matplotlib import colors
-
-
-def pseudocolor(val, minval, maxval):
-    data = {'red': [(0.0, 1.0, 1.0),
-                    (0.1, 0.5, 0.5),
-                    (0.2, 0.0, 0.0),
-                    (0.3, 0.0, 0.0),
-                    (0.4, 0.0, 0.0),
-                    (0.5, 0.0, 0.0),
-                    (0.6, 0.0, 0.0),
-                    (0.7, 0.5, 0.5),
-                    (0.8, 1.0, 1.0),
-                    (0.9, 1.0, 1.0),
-                    (1.0, 1.0, 1.0)],
-
-            'green': [(0.0, 0.0, 0.0),
-                      (0.1, 0.0, 0.0),
-                      (0.2, 0.0, 0.0),
-                      (0.3, 0.5, 0.5),
-                      (0.4, 1.0, 1.0),
-                      (0.5, 1.0, 1.0),
-                      (0.6, 1.0, 1.0),
-                      (0.7, 1.0, 1.0),
-                      (0.8, 1.0, 1.0),
-                      (0.9, 0.5, 0.5),
-                      (1.0, 0.0, 0.0)],
-
-            'blue': [(0.0, 1.0, 1.0),
-                     (0.1, 1.0, 1.0),
-                     (0.2, 1.0, 1.0),
-                     (0.3, 1.0, 1.0),
-                     (0.4, 1.0, 1.0),
-                     (0.5, 0.5, 0.5),
-                     (0.6, 0.0, 0.0),
-                     (0.7, 0.0, 0.0),
-                     (0.8, 0.0, 0.0),
-                     (0.9, 0.0, 0.0),
-                     (1.0, 0.0, 0.0)]}
-    cmap = colors.LinearSegmentedColormap("mycustommap", data)
-
-    val = (val - minval) / (maxval - minval)
-    color = cmap(val)
-    return tuple(int(x * 255) for x in color)
+
+from core.utils import color_ramp
+
+# The colorbar must match the colours of the DSM, see Flight.create_colored_dsm
+COLOR_FILE = "./core/utils/color_relief.txt"
+
+
+def gradient(width, height, color_file=COLOR_FILE):
+    """
+    Samples a colour ramp from its minimum (left) to its maximum (right)
+
+    Returns: An RGBA array of shape (height, width, 4)
+    """
+    lut = color_ramp.lookup_table(color_ramp.load(color_file), 0.0, 1.0, size=width)
+    return numpy.ascontiguousarray(numpy.broadcast_to(lut.T, (height, width, 4)))
 
 
 def center_text(img, font, text, strip, color=(0, 0, 0)):
@@ -75,18 +50,24 @@ N = 500
 HEIGHT = 20
 
 
-def create_colorbar(min_label, max_label, save_path):
-    gradient = Image.new('RGBA', (N, 1))
-    for i in range(N):
-        rgb_val = pseudocolor(i, 0, N)
-        gradient.putpixel((i, 0), rgb_val)
+@lru_cache(maxsize=128)
+def render_colorbar(min_label, max_label, width=N):
+    """
+    Draws a colorbar with its labels. Flights with the same labels share the result
 
-    base = Image.new("RGBA", (N, 80))
-    gradient = gradient.resize((N, HEIGHT))
+    Returns: The colorbar, as PNG bytes
+    """
+    base = Image.new("RGBA", (width, 80))
+    base.paste(Image.fromarray(gradient(width, HEIGHT), "RGBA"), (0, 0))
     font = ImageFont.truetype("DejaVuSans.ttf", 20)
-
-    base.paste(gradient, (0, 0))
     left_text(base, font, min_label, (0, HEIGHT + 5))
-    right_text(base, font, max_label, (N - 1, HEIGHT + 5))
+    right_text(base, font, max_label, (width - 1, HEIGHT + 5))
+
+    png = io.BytesIO()
+    base.save(png, "PNG")
+    return png.getvalue()
+
 
-    base.save(save_path, "PNG")
+def create_colorbar(min_label, max_label, save_path, width=N):
+    with open(save_path, "wb") as f:
+        f.write(render_colorbar(min_label, max_label, width))
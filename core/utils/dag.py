@@ -0,0 +1,131 @@
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+Stage = namedtuple("Stage", ["name", "inputs", "outputs"])
+Stage.__doc__ = """
+A step of a pipeline
+
+Attributes:
+    name: The stage name, must be unique on its pipeline
+    inputs: Names of the products required by the stage. Products that no stage outputs are assumed to exist already
+    outputs: Names of the products created by the stage
+"""
+Stage.__new__.__defaults__ = ((), ())
+
+
+def dependencies(stages):
+    """
+    Computes which stages must be completed before each stage can be started
+    Args:
+        stages: An iterable of Stage
+
+    Returns: A dict {stage name: set of names of the stages that create its inputs}
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is created by both {producers[output]} and {stage.name}")
+            producers[output] = stage.name
+    return {stage.name: {producers[i] for i in stage.inputs if i in producers} for stage in stages}
+
+
+def topological_order(stages):
+    """
+    Sorts the stages so that every stage comes after all of its dependencies. Ties keep the declaration order.
+    Args:
+        stages: An iterable of Stage
+
+    Returns: A list of Stage
+
+    Raises:
+        ValueError: if the stages have a circular dependency
+    """
+    stages = list(stages)
+    deps = dependencies(stages)
+    ordered, done = [], set()
+    while len(ordered) < len(stages):
+        ready = [s for s in stages if s.name not in done and deps[s.name] <= done]
+        if not ready:
+            raise ValueError("Circular dependency between stages " +
+                             ", ".join(s.name for s in stages if s.name not in done))
+        ordered.append(ready[0])
+        done.add(ready[0].name)
+    return ordered
+
+
+def _timed_call(run_stage, name):
+    """
+    Runs a stage, never raises
+
+    Returns: A tuple (duration in seconds, traceback string or None if the stage succeeded)
+    """
+    start = time.monotonic()
+    try:
+        run_stage(name)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return time.monotonic() - start, error
+
+
+def run_dag(stages, run_stage, max_workers=1, completed=(), on_start=None, on_finish=None, initializer=None):
+    """
+    Runs a pipeline of stages, starting every stage as soon as all its dependencies have finished
+
+    When a stage fails, the stages that depend on it (directly or not) are not started, but the independent branches
+    keep running.
+    Args:
+        stages: An iterable of Stage
+        run_stage: Callable that receives a stage name and runs it. It must be picklable if max_workers > 1
+        max_workers: Maximum number of stages running at the same time, each one on its own process.
+            If 1, stages are executed one by one on the current process
+        completed: Names of the stages that already finished on a previous run, they won't be executed again
+        on_start: Optional callable (stage name), called on this process before a stage is started
+        on_finish: Optional callable (stage name, duration, error), called on this process after a stage ends.
+            error is a traceback string, or None if the stage succeeded
+        initializer: Optional callable, called on every new process before it runs any stage (if max_workers > 1).
+            Processes are forked from this one, after on_start may have been called
+
+    Returns: The set of names of the stages that failed. Stages that were not started because of them are not included
+    """
+    stages = topological_order(stages)
+    deps = dependencies(stages)
+    done, failed = set(completed), set()
+    pending = [s.name for s in stages if s.name not in done]
+
+    def ready_stages():
+        # Stages that depend on a failed stage never become ready, since their dependencies are never done
+        return [name for name in pending if deps[name] <= done]
+
+    def finish(name, duration, error):
+        (failed if error is not None else done).add(name)
+        if on_finish is not None:
+            on_finish(name, duration, error)
+
+    def start(name):
+        pending.remove(name)
+        if on_start is not None:
+            on_start(name)
+
+    if max_workers <= 1:
+        ready = ready_stages()
+        while ready:
+            start(ready[0])
+            finish(ready[0], *_timed_call(run_stage, ready[0]))
+            ready = ready_stages()
+        return failed
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer) as pool:
+        while True:
+            for name in ready_stages()[:max_workers - len(running)]:
+                start(name)
+                running[pool.submit(_timed_call, run_stage, name)] = name
+            if not running:
+                return failed
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                finish(running.pop(future), *future.result())
@@ -1,6 +1,14 @@
+import json
 import os
 import subprocess
+import time
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db.models import F, Func, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from core.utils.files import shared_entries, still_shared
 
 
 class DiskSpaceTrackerMixin:
@@ -22,41 +30,211 @@ class DiskSpaceTrackerMixin:
     def get_disk_path(self):
         raise NotImplementedError("get_disk_path() should be implemented!")
 
-    # https://stackoverflow.com/a/4368431
-    # This method is *supposed to* return exactly the same number as du -sb
+    # This method returns exactly the same number as du -sb (or du -sB1 when allocated is True)
     @staticmethod
-    def _size_of_dir(path):
-        total_size = os.path.getsize(path)
-        for item in os.listdir(path):
-            itempath = os.path.join(path, item)
-            if os.path.isfile(itempath):
-                # print(itempath, "=", os.path.getsize(itempath))  # Uncomment to print filename and size for every file
-                total_size += os.path.getsize(itempath)
-            elif os.path.isdir(itempath):
-                total_size += DiskSpaceTrackerMixin._size_of_dir(itempath)
+    def _size_of_dir(path, allocated=False, max_workers=8):
+        """
+        Walks the whole directory, without using the DirectoryUsage cache. Every top-level subdirectory
+        (odm_orthophoto, odm_dem, odm_texturing...) is walked on its own thread
+
+        Args:
+            path: The directory
+            allocated: Count the disk blocks allocated to the files, instead of their apparent size (du without -b).
+                Sparse files use less than their size, small files use a whole block
+            max_workers: Maximum number of threads
+        """
+        size, subdirectories, links = _scan_dir(path, allocated)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            subtrees = list(pool.map(lambda subdirectory: _walk(subdirectory, allocated), subdirectories))
+        seen_inodes = set()
+        total_size = size + _new_links_size(links, seen_inodes)
+        # Hardlinks are deduplicated here, since they may be on different subtrees
+        for subtree_size, subtree_links in subtrees:
+            total_size += subtree_size + _new_links_size(subtree_links, seen_inodes)
         return total_size
 
-    def update_disk_space(self):
+    def update_disk_space(self, reconcile=False):
+        """
+        Args:
+            reconcile: Rescan every directory, instead of only the ones that changed since the last update
+        """
         # print("DISK SPACE", self) # Uncomment if debug info required
-        self.used_space = DiskSpaceTrackerMixin._size_of_dir(self.get_disk_path()) // 1024
-        self.save()  # this will call Flight.save() or UserProject.save()
+        self.used_space = cached_size_of_dir(self.get_disk_path(), reconcile) // 1024
+        self.save(update_fields=["used_space"])  # Only used_space, so concurrent changes to other fields are kept
+
+
+def _scan_dir(path, allocated=False):
+    """
+    Lists a single directory, with a single stat() call per entry (DirEntry caches them)
+
+    Like du, symlinks are not followed and files with several hardlinks (e.g. the index cache, see
+    Flight.create_index_rasters) must count once, so they are returned apart. Files shared with another folder (see
+    core.utils.files.materialize) are charged to the original, so they are ignored while the original still exists.
+
+    Returns: (size of the directory and of the files directly inside it, paths of the subdirectories,
+              [st_dev, st_ino, size] of the files with several hardlinks)
+    """
+    size = _stat_size(os.stat(path), allocated)
+    shared = shared_entries(path)
+    subdirectories, links = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if entry.name in shared and still_shared(stat, *shared[entry.name]):
+                continue
+            # print(entry.path, "=", stat.st_size)  # Uncomment to print filename and size for every file
+            if stat.st_nlink > 1:
+                links.append([stat.st_dev, stat.st_ino, _stat_size(stat, allocated)])
+            else:
+                size += _stat_size(stat, allocated)
+    return size, subdirectories, links
+
+
+def _stat_size(stat, allocated):
+    return stat.st_blocks * 512 if allocated else stat.st_size
+
+
+def _walk(path, allocated=False):
+    """
+    Returns: (size of the whole directory tree except hardlinked files, the hardlinked files as in _scan_dir)
+    """
+    total_size, all_links, pending = 0, [], [path]
+    while pending:
+        size, subdirectories, links = _scan_dir(pending.pop(), allocated)
+        total_size += size
+        all_links.extend(links)
+        pending.extend(subdirectories)
+    return total_size, all_links
+
+
+def _new_links_size(links, seen_inodes):
+    size = 0
+    for dev, ino, link_size in links:
+        if (dev, ino) not in seen_inodes:
+            seen_inodes.add((dev, ino))
+            size += link_size
+    return size
+
+
+# Directory timestamps have a limited resolution, so a directory could still change without changing its mtime for a
+# while after it was scanned. Those directories are not trusted on the next walk
+_RACY_NANOSECONDS = 2 * 10 ** 9
+
+
+def cached_size_of_dir(path, reconcile=False):
+    """
+    Returns the same as DiskSpaceTrackerMixin._size_of_dir, but only lists the directories that changed since the
+    previous call
+
+    The size of every directory (of its files, not recursive) is kept on the DirectoryUsage table along with the mtime
+    of the directory. Creating, deleting or renaming a file updates the mtime of its directory, so those directories
+    are scanned again and the rest are taken from the table. Files that are modified in place (without a rename) are
+    not detected until the next reconciliation.
+
+    Args:
+        path: The directory
+        reconcile: Ignore the table and scan every directory again. Like recompute_disk_space, the tree is walked on
+            several threads and its cached sizes are discarded, the next call fills them again
+    """
+    from core.models import DirectoryUsage
+
+    if reconcile:
+        size = DiskSpaceTrackerMixin._size_of_dir(path)
+        forget_dir(path)
+        return size
+
+    rows = {row.path: row for row in DirectoryUsage.objects.filter(Q(path=path) | Q(path__startswith=path + "/"))}
+    new_rows, changed_rows, visited = [], [], set()
+    total_size, seen_inodes, pending = 0, set(), [path]
+    now = time.time_ns()
+    while pending:
+        directory = pending.pop()
+        visited.add(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        row = rows.get(directory)
+        if row is not None and row.mtime == mtime:
+            size, subdirectories, links = row.size, json.loads(row.subdirectories), json.loads(row.links)
+        else:
+            size, subdirectories, links = _scan_dir(directory)
+            if row is None:
+                row = DirectoryUsage(path=directory)
+                new_rows.append(row)
+            else:
+                changed_rows.append(row)
+            row.mtime = mtime if now - mtime > _RACY_NANOSECONDS else -1
+            row.size, row.subdirectories, row.links = size, json.dumps(subdirectories), json.dumps(links)
+        total_size += size + _new_links_size(links, seen_inodes)
+        pending.extend(subdirectories)
+
+    # Another process may be walking the same directory at the same time, the last one wins
+    DirectoryUsage.objects.bulk_create(new_rows, ignore_conflicts=True)
+    DirectoryUsage.objects.bulk_update(changed_rows, ["mtime", "size", "subdirectories", "links"])
+    removed = [row.pk for directory, row in rows.items() if directory not in visited]
+    if removed:
+        DirectoryUsage.objects.filter(pk__in=removed).delete()
+    return total_size
+
+
+def forget_dir(path):
+    """
+    Removes the cached sizes of a directory that was deleted (see cached_size_of_dir)
+    """
+    from core.models import DirectoryUsage
+
+    DirectoryUsage.objects.filter(Q(path=path) | Q(path__startswith=path + "/")).delete()
+
+
+def recompute_disk_space(objects, max_workers=8):
+    """
+    Updates the `used_space` of many DiskSpaceTrackerMixin objects at once, rescanning all their files (like
+    update_disk_space(reconcile=True))
+
+    Every directory is walked by DiskSpaceTrackerMixin._size_of_dir, on several threads, and the results are saved
+    with one bulk_update per model. The cached directory sizes (see cached_size_of_dir) are discarded, since they may
+    have missed files modified in place. Missing directories count as empty. The users' totals are not updated, see
+    DiskRelationTrackerMixin.
+
+    Args:
+        objects: An Iterable of Flights and UserProjects
+        max_workers: Maximum number of threads walking each directory
+    """
+    from core.models import DirectoryUsage
+
+    objects = list(objects)
+    paths = [obj.get_disk_path() for obj in objects]
+    for obj, path in zip(objects, paths):
+        size = DiskSpaceTrackerMixin._size_of_dir(path, max_workers=max_workers) if os.path.isdir(path) else 0
+        obj.used_space = size // 1024
+
+    by_model = {}
+    for obj in objects:
+        by_model.setdefault(type(obj), []).append(obj)
+    for model, model_objects in by_model.items():
+        model.objects.bulk_update(model_objects, ["used_space"])
+    query = Q(pk__in=[])
+    for path in paths:
+        query |= Q(path=path) | Q(path__startswith=path + "/")
+    DirectoryUsage.objects.filter(query).delete()
 
 
 class DiskRelationTrackerMixin:
     """
         A Mixin that implements related-model disk space tracking for Django models
 
-        The target class should be a Django model (since the save(self) method is used)
+        The target class should be a Django model
         The target class should have a `used_space` model field, of type PositiveIntegerField
         The target class should provide a get_disk_related_models(self) method
-        that returns an Iterable of all models that are included in this model's used space.
-        All related models should have a `update_disk_space()` method  and a `used_space` property
+        that returns an Iterable of QuerySets with all models that are included in this model's used space.
+        All related models should have a `update_disk_space()` method  and a `used_space` field
 
         Added methods
         -------
         update_disk_space():
             Updates the `used_space` field on the object to be the sum of the disk spaces
-            returned by all models in the `get_disk_related_models()` method.
+            of all models in the `get_disk_related_models()` QuerySets.
     """
     used_space = None
 
@@ -66,7 +244,15 @@ class DiskRelationTrackerMixin:
 
     def update_disk_space(self):
         # print("DISK SPACE USER", self) # Uncomment if debug info required
-        # print(self.get_disk_related_models()) # Uncomment if debug info required
-        self.used_space = sum([obj.used_space for obj in self.get_disk_related_models()])
-        self.save()  # this will call User.save()
+        # The sum is computed and written by a single UPDATE, so nothing is loaded into Python and concurrent updates
+        # (e.g. webhooks of several Flights) can't overwrite each other, nor the other fields of the object
+        total = sum((Coalesce(Subquery(_sum_of_used_space(queryset)), 0)
+                     for queryset in self.get_disk_related_models()), Value(0))
+        type(self).objects.filter(pk=self.pk).update(used_space=total)
+        self.refresh_from_db(fields=["used_space"])
         # print("DISK SPACE USER", self, self.used_space)  # Uncomment if debug info required
+
+
+def _sum_of_used_space(queryset):
+    # SUM() as a plain function instead of an aggregate, so Django doesn't add a GROUP BY and the subquery has one row
+    return queryset.order_by().annotate(total=Func(F("used_space"), function="SUM")).values("total")
@@ -0,0 +1,137 @@
+"""
+Helpers for sharing files between folders without duplicating their contents, and between processes
+"""
+import contextlib
+import fcntl
+import os
+import shutil
+import subprocess
+
+# Files that were materialized from files of another folder (see materialize) are listed on this file, on the folder
+# that contains them. Every line has the name of the file, how it was materialized and the original path, separated by
+# tabs (older lines only have the name). Their size is charged to the original, not to this folder, while they still
+# share its data (see still_shared)
+SHARED_MANIFEST = ".shared"
+
+
+def link_or_copy(src, dst):
+    """
+    Makes dst have the contents of src, as a hardlink if possible (same filesystem) and as a copy otherwise. dst is
+    replaced if it exists
+
+    Both paths share the data, so src must not be modified in place afterwards (replacing it is fine)
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _reflink(src, dst):
+    # GNU cp does the FICLONE ioctl, and fails if the filesystem doesn't support it
+    subprocess.run(["cp", "--reflink=always", src, dst], check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def materialize(src, dst):
+    """
+    Makes dst have the contents of src, using as little disk space as possible. In order of preference:
+    - a reflink (an independent file that shares the data of src until one of them is modified; Btrfs, XFS...)
+    - a hardlink (src must not be modified in place afterwards, replacing it is fine)
+    - a copy
+
+    Reflinks and hardlinks are recorded as shared (see shared_files), a copy is a regular file of dst's folder.
+
+    Returns: "reflink", "hardlink" or "copy"
+    """
+    if os.path.lexists(dst):
+        remove_materialized(dst)
+    try:
+        _reflink(src, dst)
+        method = "reflink"
+    except (OSError, subprocess.CalledProcessError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            method = "hardlink"
+        except OSError:
+            shutil.copyfile(src, dst)
+            return "copy"
+    with open(os.path.join(os.path.dirname(dst), SHARED_MANIFEST), "a") as f:
+        f.write(f"{os.path.basename(dst)}\t{method}\t{os.path.abspath(src)}\n")
+    return method
+
+
+def shared_files(folder):
+    """
+    Returns: The set of names of the files of folder that were materialized as reflinks or hardlinks
+    """
+    return set(shared_entries(folder))
+
+
+def shared_entries(folder):
+    """
+    Returns: A dict from the name of every file of folder that was materialized as a reflink or hardlink to a tuple
+        (method, original path). Both are None for files listed by older versions
+    """
+    entries = {}
+    for line in _manifest_lines(folder):
+        fields = line.split("\t")
+        entries[fields[0]] = (fields[1], fields[2]) if len(fields) == 3 else (None, None)
+    return entries
+
+
+def still_shared(stat, method, source):
+    """
+    Whether a materialized file still shares its data with the original, so it must not be charged to its folder
+
+    A hardlink stops being shared when the original is deleted or replaced (its link count drops to 1). A reflink is
+    assumed to be shared while the original exists
+
+    Args:
+        stat: The os.stat_result of the materialized file (without following symlinks)
+        method, source: As returned by shared_entries
+    """
+    if method == "reflink":
+        return os.path.exists(source)
+    return stat.st_nlink > 1
+
+
+def _manifest_lines(folder):
+    try:
+        with open(os.path.join(folder, SHARED_MANIFEST)) as f:
+            return [line.rstrip("\n") for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def remove_materialized(path):
+    """
+    Removes a file created by materialize, and its entry on the manifest
+    """
+    os.remove(path)
+    folder, name = os.path.split(path)
+    lines = _manifest_lines(folder)
+    remaining = [line for line in lines if line.split("\t")[0] != name]
+    if len(remaining) < len(lines):
+        with open(os.path.join(folder, SHARED_MANIFEST), "w") as f:
+            f.writelines(line + "\n" for line in remaining)
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Holds an exclusive lock on path (an empty file, created if needed) while the block runs
+
+    The lock is released if the process dies. Every call opens the file again, so it also excludes the threads of the
+    same process
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,58 @@
+"""
+Coordinate transformations between CRSs and raster pixels, on numpy arrays
+"""
+import threading
+
+import numpy
+import pyproj
+
+WGS84 = "EPSG:4326"
+
+_local = threading.local()
+
+
+def get_transformer(src_crs: str, dst_crs: str) -> pyproj.Transformer:
+    """
+    Returns a Transformer between two CRSs (anything accepted by pyproj: "EPSG:4326", WKT, PROJ strings...), with
+    x/longitude first
+
+    Creating a Transformer is much slower than using it, so they are cached. pyproj Transformers can't be shared
+    between threads, so every thread has its own cache.
+    """
+    if not hasattr(_local, "transformers"):
+        _local.transformers = {}
+    key = (src_crs, dst_crs)
+    if key not in _local.transformers:
+        _local.transformers[key] = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return _local.transformers[key]
+
+
+def transform(xs, ys, src_crs: str, dst_crs: str):
+    """
+    Transforms arrays of coordinates with a single call
+
+    Args:
+        xs: Array of x coordinates (longitudes, for geographic CRSs)
+        ys: Array of y coordinates (latitudes, for geographic CRSs)
+        src_crs: The CRS of the input coordinates
+        dst_crs: The CRS of the output coordinates
+
+    Returns: A tuple (xs, ys) of numpy arrays
+    """
+    xs, ys = get_transformer(src_crs, dst_crs).transform(numpy.asarray(xs, dtype=float),
+                                                         numpy.asarray(ys, dtype=float))
+    return numpy.asarray(xs), numpy.asarray(ys)
+
+
+def to_pixels(xs, ys, geotransform):
+    """
+    Converts CRS coordinates to (fractional) pixel coordinates, inverting a GDAL geotransform
+
+    Returns: A tuple (columns, rows) of numpy arrays
+    """
+    origin_x, pixel_width, row_rotation, origin_y, column_rotation, pixel_height = geotransform
+    dx, dy = numpy.asarray(xs, dtype=float) - origin_x, numpy.asarray(ys, dtype=float) - origin_y
+    determinant = pixel_width * pixel_height - row_rotation * column_rotation
+    columns = (dx * pixel_height - dy * row_rotation) / determinant
+    rows = (dy * pixel_width - dx * column_rotation) / determinant
+    return columns, rows
@@ -31,83 +31,149 @@
 #  DEALINGS IN THE SOFTWARE.
 #******************************************************************************
 
+"""
+Merges a greyscale raster (e.g. a hillshade) as the intensity of a colour raster (e.g. a DSM colour relief)
+
+Based on the hsv_merge.py script from GDAL, but importable and processing the rasters in tile-aligned windows
+instead of scanlines. Replacing the V (value) of a colour in HSV keeps its hue and saturation, and for fixed hue and
+saturation R, G and B are all proportional to V, so the merge is a per-pixel scale: rgb * hillshade / max(r, g, b).
+That is a handful of in-place numpy operations on preallocated buffers, with no HSV conversion.
+"""
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
-from osgeo import gdal
 
-# =============================================================================
-# rgb_to_hsv()
-#
-# rgb comes in as [r,g,b] with values in the range [0,255].  The returned
-# hsv values will be with hue and saturation in the range [0,1] and value
-# in the range [0,255]
-#
-def rgb_to_hsv( r,g,b ):
-
-    maxc = numpy.maximum(r,numpy.maximum(g,b))
-    minc = numpy.minimum(r,numpy.minimum(g,b))
-
-    v = maxc
-
-    minc_eq_maxc = numpy.equal(minc,maxc)
-
-    # compute the difference, but reset zeros to ones to avoid divide by zeros later.
-    ones = numpy.ones((r.shape[0],r.shape[1]))
-    maxc_minus_minc = numpy.choose( minc_eq_maxc, (maxc-minc,ones) )
-
-    s = (maxc-minc) / numpy.maximum(ones,maxc)
-    rc = (maxc-r) / maxc_minus_minc
-    gc = (maxc-g) / maxc_minus_minc
-    bc = (maxc-b) / maxc_minus_minc
-
-    maxc_is_r = numpy.equal(maxc,r)
-    maxc_is_g = numpy.equal(maxc,g)
-    maxc_is_b = numpy.equal(maxc,b)
-
-    h = numpy.zeros((r.shape[0],r.shape[1]))
-    h = numpy.choose( maxc_is_b, (h,4.0+gc-rc) )
-    h = numpy.choose( maxc_is_g, (h,2.0+rc-bc) )
-    h = numpy.choose( maxc_is_r, (h,bc-gc) )
-
-    h = numpy.mod(h/6.0,1.0)
-
-    hsv = numpy.asarray([h,s,v])
-
-    return hsv
-
-# =============================================================================
-# hsv_to_rgb()
-#
-# hsv comes in as [h,s,v] with hue and saturation in the range [0,1],
-# but value in the range [0,255].
-
-def hsv_to_rgb( hsv ):
-
-    h = hsv[0]
-    s = hsv[1]
-    v = hsv[2]
-
-    #if s == 0.0: return v, v, v
-    i = (h*6.0).astype(int)
-    f = (h*6.0) - i
-    p = v*(1.0 - s)
-    q = v*(1.0 - s*f)
-    t = v*(1.0 - s*(1.0-f))
-
-    r = i.choose( v, q, p, p, t, v )
-    g = i.choose( t, v, v, q, p, p )
-    b = i.choose( p, p, t, v, v, q )
 
-    rgb = numpy.asarray([r,g,b]).astype(numpy.uint8)
-
-    return rgb
+def merge_intensity(rgb, intensity, nodata=None, out=None, work=None):
+    """
+    Replaces the HSV value of every pixel of rgb with intensity
+
+    Args:
+        rgb: Array of shape (3, height, width) with values in [0, 255]
+        intensity: Array of shape (height, width) with values in [0, 255]
+        nodata: Intensity value that keeps the original colour
+        out: Optional uint8 array of shape (3, height, width) that receives the result
+        work: Optional float32 array of shape (4, height, width), used as scratch space. Passing the same buffers
+            on every call avoids all temporary allocations
+
+    Returns: The merged colours, as uint8 (out, if given)
+    """
+    height, width = intensity.shape
+    if out is None:
+        out = numpy.empty((3, height, width), dtype=numpy.uint8)
+    if work is None:
+        work = numpy.empty((4, height, width), dtype=numpy.float32)
+    merged, scale = work[:3], work[3]
+
+    numpy.copyto(merged, rgb)
+    numpy.max(merged, axis=0, out=scale)
+    black = scale == 0  # no hue: HSV to RGB gives (v, v, v)
+    numpy.maximum(scale, 1, out=scale)
+    numpy.divide(intensity, scale, out=scale)
+    numpy.multiply(merged, scale, out=merged)
+    numpy.copyto(merged, intensity, where=black)
+    if nodata is not None:
+        numpy.copyto(merged, rgb, where=intensity == nodata)
+    numpy.copyto(out, merged, casting="unsafe")  # truncates, like the original script
+    return out
+
+
+def windows(width, height, window_width, window_height):
+    """
+    Splits a raster into windows, in row-major order
+
+    Returns: A list of (x_offset, y_offset, width, height) tuples
+    """
+    return [(x, y, min(window_width, width - x), min(window_height, height - y))
+            for y in range(0, height, window_height) for x in range(0, width, window_width)]
+
+
+def aligned_size(native, requested):
+    # The biggest multiple of the native block size that is not bigger than requested (at least one block)
+    return max(native, requested // native * native)
+
+
+def hsv_merge(color_path, hill_path, out_path, block_size=512, threads=1, driver="GTiff",
+              creation_options=("TILED=YES",), progress=None):
+    """
+    Uses a greyscale raster as the intensity of a RGB(A) raster
+
+    Args:
+        color_path: The RGB or RGBA raster (e.g. the output of gdaldem color-relief)
+        hill_path: The greyscale raster, with the same size (e.g. the output of gdaldem hillshade)
+        out_path: The output raster. Alpha, if any, is copied from color_path
+        block_size: Approximate window size, in pixels. Windows are aligned to the blocks of color_path
+        threads: Number of threads that merge windows concurrently. Reads and writes are serialized, because GDAL
+            datasets can't be shared between threads, but numpy releases the GIL while merging
+        driver: GDAL driver of the output raster
+        creation_options: Creation options of the output raster
+        progress: Optional callable that receives the completed fraction after every window
+    """
+    from osgeo import gdal
+
+    colordataset = gdal.Open(color_path, gdal.GA_ReadOnly)
+    hilldataset = gdal.Open(hill_path, gdal.GA_ReadOnly)
+    if colordataset.RasterCount not in (3, 4):
+        raise ValueError(f"{color_path} has {colordataset.RasterCount} bands, 3 or 4 are required")
+    width, height, band_count = colordataset.RasterXSize, colordataset.RasterYSize, colordataset.RasterCount
+    hillband = hilldataset.GetRasterBand(1)
+    if (hillband.XSize, hillband.YSize) != (width, height):
+        raise ValueError("Color and hillshade must be the same size in pixels")
+    nodata = hillband.GetNoDataValue()
+
+    outdataset = gdal.GetDriverByName(driver).Create(out_path, width, height, band_count, gdal.GDT_Byte,
+                                                     options=list(creation_options))
+    outdataset.SetProjection(hilldataset.GetProjection())
+    outdataset.SetGeoTransform(hilldataset.GetGeoTransform())
+    out_bands = [outdataset.GetRasterBand(i + 1) for i in range(band_count)]
+
+    native_width, native_height = colordataset.GetRasterBand(1).GetBlockSize()
+    window_width, window_height = aligned_size(native_width, block_size), aligned_size(native_height, block_size)
+    all_windows = windows(width, height, window_width, window_height)
+    io_lock = threading.Lock()
+    buffers = threading.local()
+    done = 0
+
+    def merge_window(window):
+        nonlocal done
+        x, y, w, h = window
+        if not hasattr(buffers, "color"):
+            # Flat buffers, every window uses a contiguous prefix of them
+            buffers.color = numpy.empty(band_count * window_width * window_height, dtype=numpy.uint8)
+            buffers.hill = numpy.empty(window_width * window_height, dtype=numpy.float32)
+            buffers.out = numpy.empty(3 * window_width * window_height, dtype=numpy.uint8)
+            buffers.work = numpy.empty(4 * window_width * window_height, dtype=numpy.float32)
+        color = buffers.color[:band_count * w * h].reshape(band_count, h, w)
+        hill = buffers.hill[:w * h].reshape(h, w)
+        out = buffers.out[:3 * w * h].reshape(3, h, w)
+        work = buffers.work[:4 * w * h].reshape(4, h, w)
+
+        with io_lock:
+            colordataset.ReadAsArray(x, y, w, h, buf_obj=color)
+            hillband.ReadAsArray(x, y, w, h, buf_obj=hill)
+        merge_intensity(color[:3], hill, nodata, out=out, work=work)
+        with io_lock:
+            for i in range(3):
+                out_bands[i].WriteArray(out[i], x, y)
+            if band_count == 4:
+                out_bands[3].WriteArray(color[3], x, y)
+            done += 1
+            if progress is not None:
+                progress(done / len(all_windows))
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(merge_window, all_windows))  # list() re-raises the exceptions
+    else:
+        for window in all_windows:
+            merge_window(window)
+    outdataset.FlushCache()
 
-# =============================================================================
-# Usage()
 
 def Usage():
-    print("""Usage: hsv_merge.py [-q] [-of format] src_color src_greyscale dst_color
+    print("""Usage: hsv_merge.py [-q] [-of format] [-threads n] src_color src_greyscale dst_color
 where src_color is a RGB or RGBA dataset,
       src_greyscale is a greyscale dataset (e.g. the result of gdaldem hillshade)
       dst_color will be a RGB or RGBA dataset using the greyscale as the
@@ -115,119 +181,38 @@ where src_color is a RGB or RGBA dataset,
 """)
     sys.exit(1)
 
-# =============================================================================
-# 	Mainline
-# =============================================================================
-
-argv = gdal.GeneralCmdLineProcessor( sys.argv )
-if argv is None:
-    sys.exit( 0 )
-
-format = 'GTiff'
-src_color_filename = None
-src_greyscale_filename = None
-dst_color_filename = None
-quiet = False
-
-# Parse command line arguments.
-i = 1
-while i < len(argv):
-    arg = argv[i]
 
-    if arg == '-of':
+def main(argv):
+    from osgeo import gdal
+
+    argv = gdal.GeneralCmdLineProcessor(argv)
+    if argv is None:
+        sys.exit(0)
+
+    out_format = "GTiff"
+    threads = 1
+    filenames = []
+    quiet = False
+    i = 1
+    while i < len(argv):
+        if argv[i] == "-of":
+            i = i + 1
+            out_format = argv[i]
+        elif argv[i] == "-threads":
+            i = i + 1
+            threads = int(argv[i])
+        elif argv[i] in ("-q", "-quiet"):
+            quiet = True
+        else:
+            filenames.append(argv[i])
         i = i + 1
-        format = argv[i]
-
-    elif arg == '-q' or arg == '-quiet':
-        quiet = True
-
-    elif src_color_filename is None:
-        src_color_filename = argv[i]
-
-    elif src_greyscale_filename is None:
-        src_greyscale_filename = argv[i]
-
-    elif dst_color_filename is None:
-        dst_color_filename = argv[i]
-    else:
+    if len(filenames) != 3:
         Usage()
 
-    i = i + 1
-
-if dst_color_filename is None:
-    Usage()
-
-datatype = gdal.GDT_Byte
-
-hilldataset = gdal.Open( src_greyscale_filename, gdal.GA_ReadOnly )
-colordataset = gdal.Open( src_color_filename, gdal.GA_ReadOnly )
+    hsv_merge(*filenames, threads=threads, driver=out_format,
+              creation_options=("TILED=YES",) if out_format == "GTiff" else (),
+              progress=None if quiet else gdal.TermProgress_nocb)
 
-#check for 3 or 4 bands in the color file
-if (colordataset.RasterCount != 3 and colordataset.RasterCount != 4):
-    print('Source image does not appear to have three or four bands as required.')
-    sys.exit(1)
-
-#define output format, name, size, type and set projection
-out_driver = gdal.GetDriverByName(format)
-outdataset = out_driver.Create(dst_color_filename, colordataset.RasterXSize, \
-                   colordataset.RasterYSize, colordataset.RasterCount, datatype)
-outdataset.SetProjection(hilldataset.GetProjection())
-outdataset.SetGeoTransform(hilldataset.GetGeoTransform())
-
-#assign RGB and hillshade bands
-rBand = colordataset.GetRasterBand(1)
-gBand = colordataset.GetRasterBand(2)
-bBand = colordataset.GetRasterBand(3)
-if colordataset.RasterCount == 4:
-    aBand = colordataset.GetRasterBand(4)
-else:
-    aBand = None
-
-hillband = hilldataset.GetRasterBand(1)
-hillbandnodatavalue = hillband.GetNoDataValue()
-
-#check for same file size
-if ((rBand.YSize != hillband.YSize) or (rBand.XSize != hillband.XSize)):
-    print('Color and hillshade must be the same size in pixels.')
-    sys.exit(1)
 
-#loop over lines to apply hillshade
-for i in range(hillband.YSize):
-    #load RGB and Hillshade arrays
-    rScanline = rBand.ReadAsArray(0, i, hillband.XSize, 1, hillband.XSize, 1)
-    gScanline = gBand.ReadAsArray(0, i, hillband.XSize, 1, hillband.XSize, 1)
-    bScanline = bBand.ReadAsArray(0, i, hillband.XSize, 1, hillband.XSize, 1)
-    hillScanline = hillband.ReadAsArray(0, i, hillband.XSize, 1, hillband.XSize, 1)
-
-    #convert to HSV
-    hsv = rgb_to_hsv( rScanline, gScanline, bScanline )
-
-    # if there's nodata on the hillband, use the v value from the color
-    # dataset instead of the hillshade value.
-    if hillbandnodatavalue is not None:
-        equal_to_nodata = numpy.equal(hillScanline, hillbandnodatavalue)
-        v = numpy.choose(equal_to_nodata,(hillScanline,hsv[2]))
-    else:
-        v = hillScanline
-
-    #replace v with hillshade
-    hsv_adjusted = numpy.asarray( [hsv[0], hsv[1], v] )
-
-    #convert back to RGB
-    dst_color = hsv_to_rgb( hsv_adjusted )
-
-    #write out new RGB bands to output one band at a time
-    outband = outdataset.GetRasterBand(1)
-    outband.WriteArray(dst_color[0], 0, i)
-    outband = outdataset.GetRasterBand(2)
-    outband.WriteArray(dst_color[1], 0, i)
-    outband = outdataset.GetRasterBand(3)
-    outband.WriteArray(dst_color[2], 0, i)
-    if aBand is not None:
-        aScanline = aBand.ReadAsArray(0, i, hillband.XSize, 1, hillband.XSize, 1)
-        outband = outdataset.GetRasterBand(4)
-        outband.WriteArray(aScanline, 0, i)
-
-    #update progress line
-    if not quiet:
-        gdal.TermProgress_nocb( (float(i+1) / hillband.YSize) )
\ No newline at end of file
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,40 @@
+"""
+Draws point markers on images, with numpy
+
+There is no global state (unlike matplotlib.pyplot), so it is safe to use from several threads or worker processes.
+"""
+import numpy
+from PIL import Image
+
+
+def draw_markers(image, xs, ys, radius=4, color=(255, 0, 0, 255)):
+    """
+    Draws filled circles on an image, all of them at once
+
+    Args:
+        image: Array of shape (height, width, channels), modified in place
+        xs: Array with the column of every marker center
+        ys: Array with the row of every marker center
+        radius: Marker radius, in pixels
+        color: Marker color, one value per channel (extra values are ignored)
+
+    Returns: The image
+    """
+    height, width, channels = image.shape
+    offset_y, offset_x = numpy.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = offset_x ** 2 + offset_y ** 2 <= radius ** 2
+    # Every pixel of every marker: one row per marker, one column per pixel of the disk
+    pixels_y = (numpy.asarray(ys, dtype=int)[:, numpy.newaxis] + offset_y[disk]).ravel()
+    pixels_x = (numpy.asarray(xs, dtype=int)[:, numpy.newaxis] + offset_x[disk]).ravel()
+    inside = (pixels_y >= 0) & (pixels_y < height) & (pixels_x >= 0) & (pixels_x < width)
+    image[pixels_y[inside], pixels_x[inside]] = color[:channels]
+    return image
+
+
+def annotate_image(image_path, xs, ys, out_path, radius=4, color=(255, 0, 0, 255)):
+    """
+    Writes a copy of an image with markers (see draw_markers). The output has the size of the input image
+    """
+    with Image.open(image_path) as image:
+        pixels = numpy.array(image.convert("RGBA"))
+    Image.fromarray(draw_markers(pixels, xs, ys, radius, color)).save(out_path, "PNG")
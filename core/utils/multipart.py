@@ -0,0 +1,114 @@
+"""
+Streaming multipart/form-data bodies and uploads, so that big uploads are forwarded without loading them into memory
+"""
+import os
+import uuid
+
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+
+
+class MultipartEncoder:
+    """
+    A multipart/form-data body made of files, which is generated while it is sent. Use it as the data of a requests
+    call, with content_type as the Content-Type header. Its length is known in advance, so requests sends it with a
+    Content-Length header instead of chunked
+
+    Args:
+        field: The name of the form field of every file
+        files: Django Files (e.g. the UploadedFiles of request.FILES), read chunk by chunk when the body is sent
+        chunk_size: Size of the chunks read from the files, in bytes
+    """
+
+    def __init__(self, field, files, chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+        self._parts = [(self._part_header(field, f), f) for f in files]
+        self._footer = f"--{self.boundary}--\r\n".encode()
+
+    def _part_header(self, field, f):
+        # Same escaping as browsers (and requests)
+        filename = os.path.basename(f.name).replace("\\", "\\\\").replace('"', "%22")
+        content_type = getattr(f, "content_type", None) or "application/octet-stream"
+        return (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n').encode()
+
+    def __len__(self):
+        return sum(len(header) + f.size + len(b"\r\n") for header, f in self._parts) + len(self._footer)
+
+    def __iter__(self):
+        for header, f in self._parts:
+            yield header
+            yield from f.chunks(self.chunk_size)
+            yield b"\r\n"
+        yield self._footer
+
+
+class BatchUploadHandler(TemporaryFileUploadHandler):
+    """
+    A Django upload handler that forwards the files of a field in batches while the request is still being received,
+    so only the files of the current batch are stored (on temporary files) at any time. Forwarded files are not added
+    to request.FILES
+
+    Install it before request.POST or request.FILES are used (request.upload_handlers = [handler]), read request.FILES
+    and then call finish() to forward the last batch. If a batch can't be sent, or there are more than max_files files,
+    the rest of the request is ignored
+
+    Args:
+        request: The request
+        field: The name of the form field of the files to forward. Files of other fields are kept as usual
+        batch_size: Maximum number of files per batch
+        send: Callable that receives a list of UploadedFiles (see MultipartEncoder) and returns whether they were sent
+        max_files: Maximum number of files of the field
+    """
+
+    def __init__(self, request, field, batch_size, send, max_files=None):
+        super().__init__(request)
+        self.forwarded_field = field
+        self.batch_size = batch_size
+        self.send = send
+        self.max_files = max_files
+        self.batch = []
+        self.received = 0
+        self.sent = 0
+        self.failed = False
+        self.too_many_files = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        if field_name == self.forwarded_field and self.max_files is not None and self.received >= self.max_files:
+            self.too_many_files = True
+            raise StopUpload(connection_reset=False)
+        super().new_file(field_name, *args, **kwargs)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if self.field_name != self.forwarded_field:
+            return file
+        self.received += 1
+        self.batch.append(file)
+        if len(self.batch) >= self.batch_size and not self._send_batch():
+            raise StopUpload(connection_reset=False)
+        return None
+
+    def _send_batch(self):
+        batch, self.batch = self.batch, []
+        try:
+            self.failed = not self.send(batch)
+        finally:
+            for f in batch:
+                f.close()  # Deletes the temporary file
+        if not self.failed:
+            self.sent += len(batch)
+        return not self.failed
+
+    def finish(self):
+        """
+        Forwards the files that are still pending. A request without files is forwarded too, as an empty batch
+
+        Returns: Whether all the files were forwarded
+        """
+        if self.failed or self.too_many_files:
+            return False
+        if self.batch or not self.received:
+            return self._send_batch()
+        return True
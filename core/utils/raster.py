@@ -0,0 +1,293 @@
+"""
+In-process raster operations, built on the GDAL Python bindings
+
+Every function takes and returns file paths, like the gdal_translate, gdaldem and gdalinfo commands they replace, but
+they run on the current process: there is no interpreter or GDAL startup per call, and all operations share the GDAL
+block cache (sized by the GDAL_CACHEMAX environment variable).
+
+GDAL datasets can't be shared between threads, so every call opens its own datasets and closes them before returning
+(opening is cheap, the block cache is what makes repeated reads fast). Files are never kept open, so deleted or
+replaced files are not read stale and their space is released.
+"""
+import contextlib
+import os
+import threading
+from collections import namedtuple
+
+from osgeo import gdal, osr
+
+gdal.UseExceptions()
+
+RasterInfo = namedtuple("RasterInfo", ["width", "height", "band_count", "geotransform", "projection", "proj4"])
+RasterInfo.__doc__ = """
+Metadata of a raster
+
+Attributes:
+    width, height: Size in pixels
+    band_count: Number of bands
+    geotransform: GDAL geotransform (origin_x, pixel_width, row_rotation, origin_y, column_rotation, pixel_height)
+    projection: Spatial reference, as WKT
+    proj4: Spatial reference, as a PROJ.4 string ("" if the raster isn't georeferenced)
+"""
+
+
+def open_dataset(path: str) -> gdal.Dataset:
+    """
+    Opens a raster in read-only mode. The dataset is closed when the last reference to it is dropped
+    """
+    return gdal.Open(path, gdal.GA_ReadOnly)
+
+
+def _written(dataset: gdal.Dataset, path: str):
+    # Flushes a dataset returned by a GDAL utility (e.g. gdal.Translate). It is closed when the caller drops it
+    dataset.FlushCache()
+    return path
+
+
+def info(path: str) -> RasterInfo:
+    ds = open_dataset(path)
+    srs = osr.SpatialReference(wkt=ds.GetProjection()) if ds.GetProjection() else None
+    return RasterInfo(width=ds.RasterXSize, height=ds.RasterYSize, band_count=ds.RasterCount,
+                      geotransform=ds.GetGeoTransform(), projection=ds.GetProjection(),
+                      proj4=srs.ExportToProj4() if srs else "")
+
+
+def min_max(path: str, band: int = 1):
+    """
+    Computes the exact minimum and maximum values of a band, ignoring nodata (like gdalinfo -mm)
+
+    Returns: A tuple (min, max)
+    """
+    return tuple(open_dataset(path).GetRasterBand(band).ComputeRasterMinMax(False))
+
+
+def translate(src, dst: str, **options):
+    """
+    Equivalent to gdal_translate
+
+    Args:
+        src: Input raster, a path or an open dataset
+        dst: Output raster
+        **options: Keyword arguments of gdal.TranslateOptions (e.g. format="PNG", height=512)
+    """
+    return _written(gdal.Translate(dst, src, **options), dst)
+
+
+def cog_options(compression="DEFLATE", quality=None):
+    """
+    Creation options of a Cloud-Optimized GeoTIFF: 512x512 tiles and internal overviews, so zoomed-out reads
+    (e.g. GeoServer WMS requests) don't resample the full-resolution data
+
+    Args:
+        compression: DEFLATE, ZSTD, LZW, JPEG (only for 8-bit RGB), ...
+        quality: JPEG quality, 1-100
+    """
+    options = [f"COMPRESS={compression}", "BLOCKSIZE=512", "OVERVIEWS=AUTO"]
+    if compression in ("DEFLATE", "ZSTD", "LZW"):
+        options.append("PREDICTOR=YES")
+    if compression == "JPEG" and quality is not None:
+        options.append(f"QUALITY={quality}")
+    return options
+
+
+def to_cog(src: str, dst: str, compression="DEFLATE", quality=None):
+    """
+    Writes a copy of a raster as a Cloud-Optimized GeoTIFF, see cog_options()
+    """
+    return _translate_cog(src, dst, compression, quality)
+
+
+def _translate_cog(src: str, dst: str, compression="DEFLATE", quality=None, **options):
+    # Like translate(src, dst, format="COG", ...). The COG driver was added on GDAL 3.1, older versions (e.g. 3.0 on
+    # Ubuntu 20.04) get the same layout from a tiled GeoTIFF whose overviews are copied before the data
+    if gdal.GetDriverByName("COG") is not None:
+        return translate(src, dst, format="COG", creationOptions=cog_options(compression, quality), **options)
+    tiles = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512"]
+    temporary = _temporary_path(dst, ".tiles.tif")
+    previous_internal_mask = gdal.GetConfigOption("GDAL_TIFF_INTERNAL_MASK")
+    gdal.SetConfigOption("GDAL_TIFF_INTERNAL_MASK", "YES")  # Masks must be copied along with the bands
+    try:
+        # Lossless, so JPEG outputs are only compressed once
+        translate(src, temporary, format="GTiff", creationOptions=tiles + ["COMPRESS=DEFLATE"], **options)
+        dataset = gdal.Open(temporary, gdal.GA_Update)
+        levels = _overview_levels(dataset.RasterXSize, dataset.RasterYSize)
+        if levels:
+            dataset.BuildOverviews("AVERAGE", levels)
+        compression_options = _gtiff_compression_options(dataset, compression, quality)
+        dataset = None  # Flushes the overviews
+        translate(temporary, dst, format="GTiff",
+                  creationOptions=tiles + compression_options + ["COPY_SRC_OVERVIEWS=YES"])
+    finally:
+        gdal.SetConfigOption("GDAL_TIFF_INTERNAL_MASK", previous_internal_mask)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return dst
+
+
+def _overview_levels(width, height, block_size=512):
+    # Halves the size until the whole raster fits in a single block, like OVERVIEWS=AUTO of the COG driver
+    levels, level = [], 2
+    while max(width, height) / (level // 2) > block_size:
+        levels.append(level)
+        level *= 2
+    return levels
+
+
+def _gtiff_compression_options(dataset: gdal.Dataset, compression="DEFLATE", quality=None):
+    # The GTiff equivalent of cog_options(), where the predictor and color space depend on the data
+    options = [f"COMPRESS={compression}"]
+    if compression in ("DEFLATE", "ZSTD", "LZW"):
+        floating_point = dataset.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+        options.append("PREDICTOR=3" if floating_point else "PREDICTOR=2")
+    if compression == "JPEG":
+        if dataset.RasterCount == 3:
+            options.append("PHOTOMETRIC=YCBCR")
+        if quality is not None:
+            options.append(f"JPEG_QUALITY={quality}")
+    return options
+
+
+def convert_to_cog(path: str, compression="DEFLATE", quality=None):
+    """
+    Replaces a raster with a Cloud-Optimized GeoTIFF version of it, see cog_options()
+    """
+    root, extension = os.path.splitext(path)
+    temporary = f"{root}.cog{extension}"
+    to_cog(path, temporary, compression, quality)
+    os.replace(temporary, path)
+    return path
+
+
+def extract_bands(src: str, dst: str, bands, max_value, compression=None, quality=None):
+    """
+    Writes some bands of a raster (plus its mask) to an 8-bit GeoTIFF
+
+    Args:
+        src: Input raster
+        dst: Output GeoTIFF
+        bands: The input band numbers, in output order
+        max_value: Input value that is mapped to 255
+        compression: If given, dst is written as a Cloud-Optimized GeoTIFF with this compression, and the mask as an
+            internal mask (so that JPEG can be used). Otherwise, dst is a tiled GeoTIFF and the mask is an extra band
+        quality: JPEG quality, for COGs
+    """
+    if compression is None:
+        return translate(src, dst, bandList=list(bands) + ["mask"], scaleParams=[[0, max_value]],
+                         outputType=gdal.GDT_Byte, creationOptions=["TILED=YES"])
+    return _translate_cog(src, dst, compression, quality, bandList=list(bands), maskBand="mask,1",
+                          scaleParams=[[0, max_value]], outputType=gdal.GDT_Byte)
+
+
+def _alpha_options(dataset: gdal.Dataset):
+    # Formats like PNG don't store masks. An RGB raster with a mask (see extract_bands) gets it as an alpha band
+    if dataset.RasterCount == 3 and dataset.GetRasterBand(1).GetMaskFlags() & gdal.GMF_PER_DATASET:
+        return {"bandList": [1, 2, 3, "mask"]}
+    return {}
+
+
+def to_png(src: str, dst: str):
+    """
+    Writes a raster as PNG. The image is written to a temporary file and renamed, like render()
+    """
+    dataset = open_dataset(src)
+    with _replacing(dst) as temporary:
+        translate(dataset, temporary, format="PNG", **_alpha_options(dataset))
+    return dst
+
+
+def resize(src: str, dst: str, height: int):
+    """
+    Writes a downscaled copy of a raster, keeping its aspect ratio. The format is guessed from the dst extension
+    """
+    dataset = open_dataset(src)
+    return translate(dataset, dst, width=0, height=height, **_alpha_options(dataset))
+
+
+def _nearest_overview(src: str, height: int) -> gdal.Dataset:
+    # The smallest overview that is still at least height pixels high, or the full resolution raster
+    dataset = open_dataset(src)
+    band = dataset.GetRasterBand(1)
+    levels = [i for i in range(band.GetOverviewCount()) if band.GetOverview(i).YSize >= height]
+    if not levels:
+        return dataset
+    level = min(levels, key=lambda i: band.GetOverview(i).YSize)
+    return gdal.OpenEx(src, gdal.OF_RASTER | gdal.OF_READONLY, open_options=[f"OVERVIEW_LEVEL={level}"])
+
+
+def create_previews(src: str, previews: dict):
+    """
+    Writes downscaled copies of a raster, each one read from its nearest overview level instead of from the full
+    resolution data. With a COG (see to_cog) every preview costs about as much as reading its own pixels
+
+    Args:
+        src: Input raster
+        previews: {height: [output paths]}. The first path of every height is resized from the overview, the others
+            are translated from the first one (e.g. a GeoTIFF and a PNG of the same size)
+    """
+    for height, paths in sorted(previews.items(), reverse=True):
+        overview = _nearest_overview(src, height)
+        translate(overview, paths[0], width=0, height=height, **_alpha_options(overview))
+        for path in paths[1:]:
+            first = open_dataset(paths[0])
+            translate(first, path, **_alpha_options(first))
+
+
+def render(src: str, dst: str, max_size: int, driver="JPEG", quality=85):
+    """
+    Writes a downscaled image of a raster, read from its nearest overview level, that fits in max_size x max_size
+
+    The image is written to a temporary file and renamed, so concurrent calls for the same dst are safe, and readers
+    never see a partial image.
+    Args:
+        src: Input raster
+        dst: Output image
+        max_size: Maximum width and height, in pixels. Rasters are never upscaled
+        driver: JPEG (no transparency) or WEBP
+        quality: Compression quality, 1-100
+    """
+    dataset = open_dataset(src)
+    scale = min(1.0, max_size / max(dataset.RasterXSize, dataset.RasterYSize))
+    width, height = max(1, round(dataset.RasterXSize * scale)), max(1, round(dataset.RasterYSize * scale))
+    overview = _nearest_overview(src, height)
+    options = _alpha_options(overview) if driver == "WEBP" else {"bandList": [1, 2, 3]}
+    creation_options = [f"QUALITY={quality}"] + (["INTERNAL_MASK=NO"] if driver == "JPEG" else [])
+    with _replacing(dst) as temporary:
+        translate(overview, temporary, format=driver, width=width, height=height, creationOptions=creation_options,
+                  **options)
+    return dst
+
+
+def _temporary_path(dst: str, suffix: str):
+    # Unique for every process and thread that may be writing dst at the same time
+    return f"{dst}.{os.getpid()}.{threading.get_ident()}{suffix}"
+
+
+@contextlib.contextmanager
+def _replacing(dst: str):
+    # Yields a temporary path, which replaces dst if the block succeeds. Readers never see a partial dst, and nothing is
+    # left behind if the block fails. Image formats (JPEG, WEBP, PNG) keep the georeferencing on a .aux.xml sidecar,
+    # which is useless for a download or a preview, so it's removed too
+    temporary = _temporary_path(dst, ".part")
+    try:
+        yield temporary
+        os.replace(temporary, dst)
+    finally:
+        for leftover in (temporary, temporary + ".aux.xml"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def color_relief(src: str, dst: str, color_file: str):
+    """
+    Equivalent to gdaldem color-relief src color_file dst -alpha -co ALPHA=YES
+    """
+    return _written(gdal.DEMProcessing(dst, src, "color-relief", colorFilename=color_file, addAlpha=True,
+                                       creationOptions=["ALPHA=YES"]), dst)
+
+
+def hillshade(src: str, dst: str, z=1.0, scale=1.0, azimuth=315.0, altitude=45.0):
+    """
+    Equivalent to gdaldem hillshade src dst -z z -s scale -az azimuth -alt altitude
+    """
+    return _written(gdal.DEMProcessing(dst, src, "hillshade", zFactor=z, scale=scale, azimuth=azimuth,
+                                       altitude=altitude), dst)
@@ -0,0 +1,182 @@
+"""
+Evaluates index formulas (see core.parser.FormulaParser) on multispectral orthophotos, block by block
+
+Formulas are compiled to a short list of numpy ufunc calls that write to preallocated registers, so evaluating a block
+allocates nothing. Compiled formulas are plain data, so they can be sent to worker processes.
+"""
+import numpy
+
+from core.utils.hsv_merge import aligned_size, windows
+
+try:
+    import numexpr
+except ImportError:  # Optional, evaluates the whole formula in a single pass (and on several threads)
+    numexpr = None
+
+# Band of odm_orthophoto.tif for every name of the formula grammar (Micasense RedEdge order)
+BANDS = {"blue": 1, "green": 2, "red": 3, "nir": 4, "rdedge": 5}
+
+_UFUNCS = {"+": "add", "-": "subtract", "*": "multiply", "/": "divide", "**": "power", "neg": "negative"}
+_NUMEXPR_FORMATS = {"neg": "(-{})", "+": "({}+{})", "-": "({}-{})", "*": "({}*{})", "/": "({}/{})",
+                    "**": "({}**{})"}
+
+
+class CompiledFormula:
+    """
+    A formula compiled to a sequence of numpy operations
+
+    Args:
+        expression: Expression tree, made of ("band", name), ("number", value) and (operator, operand...) tuples, where
+            operator is one of + - * / ** neg (see core.parser.FormulaCompiler)
+    """
+
+    def __init__(self, expression):
+        self.bands = sorted(self._bands(expression), key=BANDS.get)
+        self.instructions = []  # (ufunc name, destination register, operands) tuples
+        self.register_count = 0
+        self.result = self._compile(expression)
+        self.source = self._source(expression)
+
+    def _bands(self, node):
+        if node[0] == "band":
+            return {node[1]}
+        if node[0] == "number":
+            return set()
+        return set().union(*(self._bands(child) for child in node[1:]))
+
+    def _compile(self, node):
+        if node[0] in ("band", "number"):
+            return node
+        operands = [self._compile(child) for child in node[1:]]
+        # Registers hold intermediate results that are used only once, so the result can overwrite an operand
+        destination = next((operand[1] for operand in operands if operand[0] == "register"), None)
+        if destination is None:
+            destination = self.register_count
+            self.register_count += 1
+        self.instructions.append((_UFUNCS[node[0]], destination, operands))
+        return "register", destination
+
+    def _source(self, node):
+        if node[0] == "band":
+            return node[1]
+        if node[0] == "number":
+            return repr(float(node[1]))
+        return _NUMEXPR_FORMATS[node[0]].format(*(self._source(child) for child in node[1:]))
+
+    def allocate(self, shape):
+        """
+        Returns: The registers needed by evaluate for blocks of the given shape
+        """
+        return [numpy.empty(shape, dtype=numpy.float32) for _ in range(max(self.register_count, 1))]
+
+    def evaluate(self, bands, registers, use_numexpr=True):
+        """
+        Evaluates the formula. Divisions by zero produce infinities or NaNs, without warnings
+
+        Args:
+            bands: Dict from band name to float32 array, with an entry for every band in self.bands
+            registers: Arrays of the same shape as the bands, see allocate
+            use_numexpr: Use numexpr, if it is installed
+
+        Returns: A float32 array, which may be one of the registers
+        """
+        if use_numexpr and numexpr is not None and self.bands:
+            return numexpr.evaluate(self.source, local_dict=bands, out=registers[0], casting="unsafe")
+
+        def value(operand):
+            if operand[0] == "band":
+                return bands[operand[1]]
+            if operand[0] == "number":
+                return numpy.float32(operand[1])
+            return registers[operand[1]]
+
+        with numpy.errstate(all="ignore"):
+            for ufunc, destination, operands in self.instructions:
+                getattr(numpy, ufunc)(*(value(operand) for operand in operands), out=registers[destination])
+        if self.result[0] == "register":
+            return registers[self.result[1]]
+        registers[0][...] = value(self.result)  # The formula is a single band or number
+        return registers[0]
+
+
+def to_byte(values, out):
+    """
+    Rounds and clips float values to 0-255, in place. NaNs become 0
+
+    Returns: out, an uint8 array of the same shape
+    """
+    numpy.nan_to_num(values, copy=False, nan=0, posinf=255, neginf=0)
+    numpy.clip(values, 0, 255, out=values)
+    numpy.rint(values, out=values)
+    out[...] = values
+    return out
+
+
+def calculate(src, dst, formula: CompiledFormula, block_size=512, use_numexpr=True):
+    """
+    Evaluates a formula on a multispectral raster and writes the result as a tiled Byte GeoTIFF, with nodata 0
+
+    Only the bands referenced by the formula are read. Pixels that are masked on src (e.g. outside of the orthophoto)
+    or where the formula is not finite become nodata.
+
+    Args:
+        src: The multispectral raster, with the bands in the order of BANDS
+        dst: The output raster
+        formula: The compiled formula, see core.parser.FormulaParser.compile
+        block_size: Approximate window size, in pixels. Windows are aligned to the blocks of src
+        use_numexpr: Use numexpr to evaluate the formula, if it is installed
+    """
+    calculate_many(src, {dst: formula}, block_size, use_numexpr)
+
+
+def calculate_many(src, outputs, block_size=512, use_numexpr=True):
+    """
+    Like calculate, for several formulas at once. Every window of src is read only once, for all the formulas
+
+    Args:
+        src: The multispectral raster, with the bands in the order of BANDS
+        outputs: Dict from output raster to compiled formula
+        block_size: Approximate window size, in pixels. Windows are aligned to the blocks of src
+        use_numexpr: Use numexpr to evaluate the formulas, if it is installed
+    """
+    from osgeo import gdal
+
+    dataset = gdal.Open(src, gdal.GA_ReadOnly)
+    width, height = dataset.RasterXSize, dataset.RasterYSize
+    used_bands = set().union(*(formula.bands for formula in outputs.values()))
+    bands = {name: dataset.GetRasterBand(BANDS[name]) for name in sorted(used_bands, key=BANDS.get)}
+    mask_band = dataset.GetRasterBand(1).GetMaskBand()
+
+    out_bands = {}
+    for dst in outputs:
+        outdataset = gdal.GetDriverByName("GTiff").Create(dst, width, height, 1, gdal.GDT_Byte,
+                                                          options=["TILED=YES", "COMPRESS=DEFLATE"])
+        outdataset.SetProjection(dataset.GetProjection())
+        outdataset.SetGeoTransform(dataset.GetGeoTransform())
+        outdataset.GetRasterBand(1).SetNoDataValue(0)
+        out_bands[dst] = (outdataset, outdataset.GetRasterBand(1))
+
+    native_width, native_height = dataset.GetRasterBand(1).GetBlockSize()
+    window_width, window_height = aligned_size(native_width, block_size), aligned_size(native_height, block_size)
+    # Flat buffers, every window uses a contiguous prefix of them. Formulas are evaluated one after the other, so they
+    # can share the registers
+    size = window_width * window_height
+    band_buffers = {name: numpy.empty(size, dtype=numpy.float32) for name in bands}
+    registers = [numpy.empty(size, dtype=numpy.float32)
+                 for _ in range(max(formula.register_count for formula in outputs.values()) or 1)]
+    mask = numpy.empty(size, dtype=numpy.uint8)
+    out = numpy.empty(size, dtype=numpy.uint8)
+
+    for x, y, w, h in windows(width, height, window_width, window_height):
+        values = {name: band_buffers[name][:w * h].reshape(h, w) for name in bands}
+        for name, band in bands.items():
+            band.ReadAsArray(x, y, w, h, buf_obj=values[name])
+        window_mask = mask_band.ReadAsArray(x, y, w, h, buf_obj=mask[:w * h].reshape(h, w)) == 0
+        window_registers = [register[:w * h].reshape(h, w) for register in registers]
+        for dst, formula in outputs.items():
+            result = formula.evaluate(values, window_registers, use_numexpr)
+            window_out = to_byte(result, out[:w * h].reshape(h, w))
+            window_out[window_mask] = 0
+            out_bands[dst][1].WriteArray(window_out, x, y)
+    for outdataset, _ in out_bands.values():
+        outdataset.FlushCache()
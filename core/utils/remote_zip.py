@@ -0,0 +1,218 @@
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+from zipfile import ZipFile
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class RemoteFileMissing(Exception):
+    """
+    The remote file no longer exists (e.g. the NodeODM task was removed)
+    """
+    pass
+
+
+def _raise_if_missing(response):
+    # NodeODM answers requests for removed tasks with a JSON error (and a 200 status), never with a ZIP file
+    if response.status_code in (404, 410) or response.headers.get("Content-Type", "").startswith("application/json"):
+        raise RemoteFileMissing(response.url)
+    response.raise_for_status()
+
+
+def check_remote_file(url):
+    """
+    Raises RemoteFileMissing if a remote file doesn't exist, downloading at most one byte of it
+    """
+    with requests.get(url, headers={"Range": "bytes=0-0"}, stream=True) as r:
+        _raise_if_missing(r)
+
+
+class TransferStats:
+    """
+    Counts the bytes received from the network, to report the transfer speed
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    @property
+    def seconds(self):
+        return time.monotonic() - self.start
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / max(self.seconds, 1e-6)
+
+    def __str__(self):
+        return f"{self.bytes / 1024 ** 2:.1f} MB in {self.seconds:.1f} s ({self.bytes_per_second / 1024 ** 2:.2f} MB/s)"
+
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file backed by a remote file, which is fetched on demand with HTTP range requests
+
+    Wrap it in an io.BufferedReader, otherwise every small read becomes a request.
+    """
+
+    def __init__(self, url, retries=3, stats=None):
+        super().__init__()
+        self.url = url
+        self.retries = retries
+        self.stats = stats or TransferStats()
+        self.pos = 0
+        with requests.get(url, headers={"Range": "bytes=0-0"}, stream=True) as r:
+            _raise_if_missing(r)
+            if r.status_code != 206 or "Content-Range" not in r.headers:
+                raise RangeNotSupported(url)
+            # Content-Range: bytes 0-0/<total size>
+            self.size = int(r.headers["Content-Range"].split("/")[-1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        end = min(self.pos + len(b), self.size)
+        received = 0
+        view = memoryview(b)
+        for attempt in range(self.retries + 1):
+            try:
+                # After a dropped connection, ask only for the bytes that haven't arrived yet
+                with requests.get(self.url, headers={"Range": f"bytes={self.pos + received}-{end - 1}"},
+                                  stream=True) as r:
+                    _raise_if_missing(r)
+                    if r.status_code != 206:
+                        raise RangeNotSupported(self.url)
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        view[received:received + len(chunk)] = chunk
+                        received += len(chunk)
+                        self.stats.bytes += len(chunk)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if attempt == self.retries:
+                    raise
+        self.pos += received
+        return received
+
+
+def _target_path(root, name):
+    # Same protection as ZipFile.extract: entries can't be written outside of root
+    target = os.path.realpath(os.path.join(root, name))
+    if not target.startswith(os.path.realpath(root) + os.sep):
+        raise ValueError(f"Refusing to extract {name} outside of {root}")
+    return target
+
+
+def _is_included(name, include):
+    return include is None or any(name == prefix or name.startswith(prefix.rstrip("/") + "/")
+                                  for prefix in include)
+
+
+def extract_zip(zip_file: ZipFile, path, include=None):
+    """
+    Extracts the entries of a ZIP file, skipping those that were already extracted
+
+    Every entry is written to a .part file and renamed when complete, so an existing file with the right size is
+    a finished entry from an interrupted run.
+    Args:
+        zip_file: An open ZipFile
+        path: The destination folder
+        include: Optional iterable of names (files or folders) to extract. By default, everything is extracted
+
+    Returns: The list of extracted entry names
+    """
+    extracted = []
+    for info in zip_file.infolist():
+        if not _is_included(info.filename, include):
+            continue
+        target = _target_path(path, info.filename)
+        if info.is_dir():
+            os.makedirs(target, exist_ok=True)
+            continue
+        if os.path.isfile(target) and os.path.getsize(target) == info.file_size:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Unique name, another process may be extracting the same entry right now
+        fd, part = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".part")
+        try:
+            with zip_file.open(info) as src, os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1024 * 1024)
+            os.chmod(part, 0o644)  # mkstemp creates private files, but GeoServer must be able to read them
+            os.replace(part, target)
+        except BaseException:
+            # A failed download must not leave its .part file behind, a retry creates a new one
+            os.remove(part)
+            raise
+        extracted.append(info.filename)
+    return extracted
+
+
+def extract_remote_zip(url, path, include=None, fallback_path=None, buffer_size=4 * 1024 * 1024):
+    """
+    Extracts (some of) the contents of a remote ZIP file, without storing the ZIP file on disk
+
+    Only the central directory and the selected entries are downloaded, with HTTP range requests. Interrupted
+    requests are resumed, and entries extracted by a previous (interrupted) call are not downloaded again.
+    If the server doesn't support range requests, the whole ZIP file is downloaded to fallback_path and deleted
+    after the extraction. RemoteFileMissing is raised if the file doesn't exist (anymore).
+    Args:
+        url: The ZIP file URL
+        path: The destination folder
+        include: Optional iterable of names (files or folders) to extract. By default, everything is extracted
+        fallback_path: Temporary file for servers without range requests
+        buffer_size: Size of each range request, in bytes
+
+    Returns: A TransferStats with the number of bytes that were downloaded
+    """
+    stats = TransferStats()
+    try:
+        remote = io.BufferedReader(HttpRangeFile(url, stats=stats), buffer_size=buffer_size)
+    except RangeNotSupported:
+        if fallback_path is None:
+            raise
+        logger.warning("%s doesn't support range requests, downloading the whole file", url)
+        try:
+            with requests.get(url, stream=True) as r:
+                _raise_if_missing(r)
+                with open(fallback_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        stats.bytes += len(chunk)
+            with ZipFile(fallback_path) as zip_file:
+                extract_zip(zip_file, path, include)
+        finally:
+            # Also when the download failed, so no partial ZIP file is left behind
+            if os.path.exists(fallback_path):
+                os.remove(fallback_path)
+    else:
+        with remote, ZipFile(remote) as zip_file:
+            extract_zip(zip_file, path, include)
+    logger.info("Extracted %s: %s", url, stats)
+    return stats
@@ -0,0 +1,109 @@
+"""
+Renders a DEM as a colour relief shaded by its hillshade, in a single pass
+
+Produces the same image as gdaldem color-relief, gdaldem hillshade and hsv_merge.py chained through two intermediate
+GeoTIFFs, but reads the DEM once, window by window, and only writes the final raster.
+"""
+import math
+
+import numpy
+
+from core.utils import color_ramp
+from core.utils.hsv_merge import aligned_size, merge_intensity, windows
+
+
+def hillshade(dem, ewres: float, nsres: float, z=1.0, scale=1.0, azimuth=315.0, altitude=45.0):
+    """
+    Computes the hillshade of a DEM with Horn's formula, like gdaldem hillshade
+
+    Args:
+        dem: Float array of shape (height + 2, width + 2): the DEM plus a 1-pixel halo. NaN is nodata
+        ewres: Pixel width, in DEM units (geotransform[1])
+        nsres: Pixel height, in DEM units (geotransform[5], usually negative)
+        z: Vertical exaggeration
+        scale: Ratio of vertical units to horizontal units
+        azimuth: Azimuth of the light, in degrees
+        altitude: Altitude of the light, in degrees
+
+    Returns: Float array of shape (height, width) with values in [1, 255]. NaN where any neighbour is nodata
+    """
+    a, b, c = dem[:-2, :-2], dem[:-2, 1:-1], dem[:-2, 2:]
+    d, f = dem[1:-1, :-2], dem[1:-1, 2:]
+    g, h, i = dem[2:, :-2], dem[2:, 1:-1], dem[2:, 2:]
+    x = ((a + 2 * d + g) - (c + 2 * f + i)) / ewres
+    y = ((g + 2 * h + i) - (a + 2 * b + c)) / nsres
+
+    z_factor = z / (8 * scale)
+    az, alt = math.radians(azimuth), math.radians(altitude)
+    # sqrt(x² + y²) * sin(atan2(y, x) - az) == y * cos(az) - x * sin(az)
+    shade = (math.sin(alt) - math.cos(alt) * z_factor * (y * math.cos(az) - x * math.sin(az))) / \
+        numpy.sqrt(1 + z_factor ** 2 * (x * x + y * y))
+    return numpy.where(shade <= 0, 1.0, 1.0 + 254.0 * shade)
+
+
+def render_shaded_relief(dem_path, out_path, color_file, z=1.0, scale=1.0, azimuth=315.0, altitude=45.0,
+                         block_size=512, color_path=None, hillshade_path=None):
+    """
+    Writes the colour relief of a DEM, using its hillshade as intensity
+
+    Args:
+        dem_path: The DEM (e.g. odm_dem/dsm.tif)
+        out_path: The output RGBA GeoTIFF
+        color_file: A gdaldem color-relief colour file
+        z, scale, azimuth, altitude: Hillshade parameters, see hillshade()
+        block_size: Approximate window size, in pixels. Windows are aligned to the blocks of the DEM
+        color_path: If given, the colour relief is also written there (like gdaldem color-relief -alpha)
+        hillshade_path: If given, the hillshade is also written there (like gdaldem hillshade)
+    """
+    from osgeo import gdal
+
+    dem = gdal.Open(dem_path, gdal.GA_ReadOnly)
+    band = dem.GetRasterBand(1)
+    width, height = dem.RasterXSize, dem.RasterYSize
+    nodata = band.GetNoDataValue()
+    geotransform = dem.GetGeoTransform()
+    min_value, max_value = band.ComputeRasterMinMax(False)
+    ramp = color_ramp.load(color_file)
+    lut = color_ramp.lookup_table(ramp, min_value, max_value)
+
+    def create(path, band_count, options):
+        dataset = gdal.GetDriverByName("GTiff").Create(path, width, height, band_count, gdal.GDT_Byte,
+                                                       options=options)
+        dataset.SetProjection(dem.GetProjection())
+        dataset.SetGeoTransform(geotransform)
+        return dataset
+
+    out = create(out_path, 4, ["TILED=YES", "ALPHA=YES"])
+    color_out = create(color_path, 4, ["TILED=YES", "ALPHA=YES"]) if color_path else None
+    hillshade_out = create(hillshade_path, 1, ["TILED=YES"]) if hillshade_path else None
+    if hillshade_out:
+        hillshade_out.GetRasterBand(1).SetNoDataValue(0)
+
+    native_width, native_height = band.GetBlockSize()
+    window_width, window_height = aligned_size(native_width, block_size), aligned_size(native_height, block_size)
+    for x, y, w, h in windows(width, height, window_width, window_height):
+        # The window plus a 1-pixel halo. Outside of the raster there is no data, so the border pixels have no
+        # hillshade, like gdaldem without -compute_edges
+        x0, y0, x1, y1 = max(x - 1, 0), max(y - 1, 0), min(x + w + 1, width), min(y + h + 1, height)
+        padded = numpy.full((h + 2, w + 2), numpy.nan, dtype=numpy.float32)
+        padded[y0 - y + 1:y1 - y + 1, x0 - x + 1:x1 - x + 1] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        if nodata is not None:
+            padded[padded == nodata] = numpy.nan
+
+        shade = hillshade(padded, geotransform[1], geotransform[5], z, scale, azimuth, altitude)
+        shade = numpy.rint(numpy.nan_to_num(shade, nan=0)).astype(numpy.uint8)  # 0 is nodata
+        color = color_ramp.colorize(padded[1:-1, 1:-1], lut, min_value, max_value, ramp.nodata_color)
+        merged = merge_intensity(color[:3], shade, nodata=0)
+
+        for i in range(3):
+            out.GetRasterBand(i + 1).WriteArray(merged[i], x, y)
+        out.GetRasterBand(4).WriteArray(color[3], x, y)
+        if color_out:
+            for i in range(4):
+                color_out.GetRasterBand(i + 1).WriteArray(color[i], x, y)
+        if hillshade_out:
+            hillshade_out.GetRasterBand(1).WriteArray(shade, x, y)
+
+    for dataset in (out, color_out, hillshade_out):
+        if dataset:
+            dataset.FlushCache()
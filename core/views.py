@@ -5,8 +5,6 @@ import re
 import sys
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
 from django.http import JsonResponse, HttpResponse, Http404
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.clickjacking import xframe_options_exempt
@@ -20,10 +18,14 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 
+from core.jobs import enqueue_flight_postprocessing, enqueue_project_indices
 from core.models import *
-from core.parser import FormulaParser
+from core.parser import FormulaParser, BUILTIN_FORMULAS
 from core.permissions import OnlySelfUnlessAdminPermission
 from core.serializers import *
+from core.utils.multipart import BatchUploadHandler, MultipartEncoder
+from core.utils.remote_zip import RemoteFileMissing
+from core.utils.working_dir import cd
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -255,35 +257,44 @@ def upload_images(request, uuid):
     if flight.user.used_space >= flight.user.maximum_space:
         return HttpResponse("Subida fallida. Su almacenamiento está lleno.",
                             status=402)  # HTTP 402 Payment Required
-    if len(request.FILES.getlist("images")) > flight.user.remaining_images:
+
+    def send_batch(images):
+        body = MultipartEncoder("images", images)
+        r = requests.post(
+            f"{settings.NODEODM_SERVER_URL}/task/new/upload/{str(flight.uuid)}?token={settings.NODEODM_SERVER_TOKEN}",
+            data=body, headers={"Content-Type": body.content_type})
+        return r.status_code == 200
+
+    # upload files to NodeODM server while they are received, a batch at a time, so memory use, temporary files and
+    # open files don't grow with the number of images
+    upload = BatchUploadHandler(request, "images", settings.NODEODM_UPLOAD_BATCH_SIZE, send_batch,
+                                max_files=flight.user.remaining_images)
+    request.upload_handlers = [upload]
+    request.FILES  # Parses the request, which sends every full batch
+
+    def discard_sent_images():
+        # Starts over with an empty task, so that a retry doesn't send the images twice
+        if upload.sent:
+            delete_nodeodm_task(Flight, flight)
+            create_nodeodm_task(Flight, flight, created=True)
+
+    if upload.too_many_files:
+        discard_sent_images()
         return HttpResponse(f"Subida fallida. Tiene un límite de {flight.user.remaining_images} imágenes.",
                             status=402)
-    # Deduct the images ON THE FLIGHT OWNER! (not on the poor admin that is impersonating the User)
-    flight.user.remaining_images -= len(request.FILES.getlist("images"))
-    flight.user.save()
-
-    files = []
-    filenames = []
-    # save temp files to disk before uploading
-    for f in request.FILES.getlist("images"):
-        path = default_storage.save('tmp/' + f.name, ContentFile(f.read()))
-        tmp_file = os.path.join(settings.MEDIA_ROOT, path)
-        filenames.append(tmp_file)
-        files.append(('images', open(tmp_file, "rb")))
-    # upload files to NodeODM server
-    r = requests.post(
-        f"{settings.NODEODM_SERVER_URL}/task/new/upload/{str(flight.uuid)}?token={settings.NODEODM_SERVER_TOKEN}",
-        files=files)
-    if r.status_code != 200:
+    if not upload.finish():  # An upload without images is still sent, NodeODM answers with the error
+        discard_sent_images()
         return HttpResponse(status=500)
-    for f in filenames:  # delete temp files from disk
-        os.remove(f)
 
     # start processing Flight on NodeODM
     r = requests.post(
         f"{settings.NODEODM_SERVER_URL}/task/new/commit/{str(flight.uuid)}?token={settings.NODEODM_SERVER_TOKEN}")
     if r.status_code != 200:
+        discard_sent_images()
         return HttpResponse(status=500)
+    # Deduct the images ON THE FLIGHT OWNER! (not on the poor admin that is impersonating the User)
+    flight.user.remaining_images -= upload.received
+    flight.user.save()
 
     flight.state = FlightState.PROCESSING.name
     flight.save()  # change Flight state to PROCESSING
@@ -317,53 +328,63 @@ def webhook_processing_complete(request):
     flight.user.save()
 
     if flight.state == FlightState.COMPLETE.name:
-        flight.download_and_decompress_results()
-        flight.create_rgb_tiff()
-        flight.try_create_png_ortho()
-        flight.try_create_thumbnail()
-        flight.create_colored_dsm()
-        flight.try_create_png_dsm()
-        flight.try_create_dsm_colorbar()
-        flight.try_create_annotated_png_ortho()
-        # _try_create_thumbnail must have been invoked here!
-        flight.create_geoserver_workspace_and_upload_geotiff()
-
-        flight.update_disk_space()
-        flight.user.update_disk_space()
+        # Post-processing takes several minutes on big Flights, so it runs on the background workers
+        enqueue_flight_postprocessing(flight)
+        return HttpResponse(status=202)
     return HttpResponse()
 
 
 def download_artifact(request, uuid, artifact):
     flight = get_object_or_404(Flight, uuid=uuid)
 
+    try:
+        filepath = _artifact_path(request, flight, artifact)
+    except OutputPending as pending:
+        # Being created by a background Job (see Flight.fetch_output). The client polls its status, and asks again
+        # when it's COMPLETE
+        status_url = reverse("job_status", kwargs={"pk": pending.job.pk})
+        response = JsonResponse({"job": pending.job.pk, "status": status_url}, status=202)
+        response["Location"] = status_url
+        response["Retry-After"] = "5"
+        return response
+    except RemoteFileMissing:
+        return HttpResponse("The NodeODM results of this flight are no longer available", status=410)
+    if request.method == "HEAD" and os.path.isfile(filepath):
+        return HttpResponse()  # The UI checks that the artifact is ready before downloading it
+    return serve(request, os.path.basename(filepath), os.path.dirname(filepath))
+
+
+def _artifact_path(request, flight, artifact):
     filepath = flight.get_disk_path()
     if artifact == "orthomosaic.png":
-        filepath += "/odm_orthophoto/odm_orthophoto.png"
+        filepath = flight.fetch_png_ortho()
     elif artifact == "orthomosaic.annotated.png":
         filepath += "/odm_orthophoto/odm_orthophoto_annotated.png"
+    elif artifact == "camera_positions.json":
+        filepath = flight.get_camera_positions_path()
     elif artifact == "orthomosaic.tiff":
-        filepath += "/odm_orthophoto/odm_orthophoto.tif"
+        filepath = flight.fetch_output("odm_orthophoto/odm_orthophoto.tif")
     elif artifact == "dsm.png":
         filepath += "/odm_dem/dsm_colored_hillshade.png"
     elif artifact == "dsm_colorbar.png":
         filepath += "/odm_dem/colorbar.png"
     elif artifact == "3dmodel":
-        filepath += "/odm_meshing/odm_mesh.ply"
+        filepath = flight.fetch_output("odm_meshing/odm_mesh.ply")
     elif artifact == "3dmodel_texture":
-        filepath += "/odm_texturing/odm_textured_model.obj"
+        filepath = flight.fetch_output("odm_texturing/odm_textured_model.obj")
     elif artifact == "thumbnail":
-        filepath = "./tmp/" + str(uuid) + "_thumbnail.png"
+        filepath = "./tmp/" + str(flight.uuid) + "_thumbnail.png"
     elif artifact == "pointcloud.ply":
-        filepath += "/odm_filterpoints/point_cloud.ply"
+        filepath = flight.fetch_output("odm_filterpoints/point_cloud.ply")
     elif artifact == "dsm.tif":
-        filepath += "/odm_dem/dsm.tif"
+        filepath = flight.fetch_output("odm_dem/dsm.tif")
     elif artifact == "dtm.tif":
-        filepath += "/odm_dem/dtm.tif"
+        filepath = flight.fetch_output("odm_dem/dtm.tif")
     elif artifact == "report.pdf":
         filepath = flight.create_report(request.GET)
     else:
         raise Http404
-    return serve(request, os.path.basename(filepath), os.path.dirname(filepath))
+    return filepath
 
 
 def download_artifact_movil(request, uuid, options, artifact):
@@ -512,37 +533,81 @@ def preview_flight_url(request, uuid):
     return JsonResponse({"url": base, "bbox": bbox, "srs": ans["coverage"]["srs"]})
 
 
+def render_flight_preview(request, uuid, size, extension):
+    flight = get_object_or_404(Flight, uuid=uuid)
+    if extension not in ("jpg", "webp") or flight.state != FlightState.COMPLETE.name:
+        raise Http404
+    # rgb.tif is created by the post-processing Job, some time after NodeODM completes
+    if flight.jobs.filter(type=JobType.FLIGHT_POSTPROCESSING.name,
+                          state__in=[JobState.QUEUED.name, JobState.RUNNING.name]).exists():
+        return HttpResponse("The flight is still being processed", status=409)
+    if not os.path.exists(flight.get_disk_path() + "/odm_orthophoto/rgb.tif"):
+        raise Http404
+    filepath = flight.render_ortho(size, extension)
+    return serve(request, os.path.basename(filepath), os.path.dirname(filepath))
+
+
 @csrf_exempt
 def check_formula(request):
     return HttpResponse(status=200 if FormulaParser().is_valid(request.POST["formula"]) else 400)
 
 
-@csrf_exempt
-def create_raster_index(request, uuid):
-    project = UserProject.objects.get(uuid=uuid)
+def _clean_index_name(index):
+    return re.sub(r"[^a-z0-9_-]", "", index)
+
+
+def _create_raster_indices(project, indices):
+    # Everything that would make the Job fail on all its attempts is rejected here
+    parser = FormulaParser()
+    if not indices or any(not index or (index not in BUILTIN_FORMULAS and not parser.is_valid(formula))
+                          for index, formula in indices.items()):
+        return HttpResponse("Invalid indices", status=400)
+    if project.artifacts.filter(type=ArtifactType.INDEX.name, name__in=indices).exists():
+        return HttpResponse("Index already exists", status=409)
     if project.user.used_space >= project.user.maximum_space:
         return HttpResponse(status=402)
 
     if not project.all_flights_multispectral():
         return HttpResponse("Not all flights are multispectral!", status=400)
 
+    # Processing every Flight takes a while, so it's done in the background. The client polls the Job (see job_status)
+    job = enqueue_project_indices(project, indices)
+    return JsonResponse({"job": job.pk}, status=202)
+
+
+@csrf_exempt
+def create_raster_index(request, uuid):
+    project = UserProject.objects.get(uuid=uuid)
     data = json.loads(request.body.decode('utf-8'))
-    print(data)
 
     index = data.get("index", "custom")
-    clean_index = re.sub(r"[^a-z0-9_-]", "", index)
     formula = data.get("formula", "")
+    return _create_raster_indices(project, {_clean_index_name(index): formula})
 
-    print("FORMULA->" + formula)
-    for flight in project.flights.all():
-        flight.create_index_raster(clean_index, formula)
-        flight.update_disk_space()
-    project._create_index_datastore(clean_index)
-    project.update_disk_space()
-    project.user.update_disk_space()
-    project.artifacts.create(
-        name=clean_index, type=ArtifactType.INDEX.name, title=clean_index.upper())
-    return HttpResponse(status=200)
+
+@csrf_exempt
+def create_raster_indices(request, uuid):
+    """
+    Creates several indices at once, from a JSON body like {"indices": {"ndvi": "", "myindex": "nir/red"}}. Every
+    orthophoto is read only once for all of them
+    """
+    project = UserProject.objects.get(uuid=uuid)
+    data = json.loads(request.body.decode('utf-8'))
+
+    indices = {_clean_index_name(index): formula for index, formula in data.get("indices", {}).items()}
+    return _create_raster_indices(project, indices)
+
+
+def job_status(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    token = Token.objects.filter(key=request.headers.get("Authorization", "")[6:]).first()
+    if token is None:
+        return HttpResponse(status=401)
+    owner = job.project.user if job.project else job.flight.user if job.flight else None
+    if not token.user.type == UserType.ADMIN.name and not owner == token.user:
+        return HttpResponse(status=403)
+    return JsonResponse({"type": job.type, "state": job.state, "progress": job.progress(),
+                         "stages": [{"name": stage.name, "state": stage.state} for stage in job.stages.all()]})
 
 
 @xframe_options_exempt
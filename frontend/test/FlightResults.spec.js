@@ -17,6 +17,8 @@ import {
 } from 'bootstrap-vue'
 import ReactiveStorage from "vue-reactive-localstorage";
 
+jest.useFakeTimers();
+
 const localVue = createLocalVue();
 localVue.use(ButtonPlugin);
 localVue.use(CardPlugin);
@@ -43,6 +45,7 @@ import MockAdapter from 'axios-mock-adapter';
 describe("Flight results component", () => {
     let wrapper, mock;
     window.URL.createObjectURL = jest.fn();
+    const clickLink = jest.spyOn(HTMLAnchorElement.prototype, "click").mockImplementation(() => {});
 
     const mountComponent = () => {
         wrapper = mount(FlightResults, {
@@ -80,6 +83,7 @@ describe("Flight results component", () => {
         mock.restore();
         wrapper.vm.storage.otherUserPk = 0;
         window.URL.createObjectURL.mockReset();
+        clickLink.mockClear();
     });
 
     it("calls API and fills flight info", async () => {
@@ -113,5 +117,77 @@ describe("Flight results component", () => {
 
         expect(wrapper.vm.error).toBeTruthy();
         expect(wrapper.find(".alert").exists()).toBe(true);
-    })
-})
\ No newline at end of file
+    });
+
+    it("downloads a ready artifact", async () => {
+        mockSuccessful();
+        mock.onHead(/api\/downloads\/flightuuid\/orthomosaic.tiff/).reply(200);
+        mountComponent();
+        await flushPromises();
+
+        await wrapper.findAll("button").at(1).trigger("click");
+        await flushPromises();
+
+        expect(clickLink).toHaveBeenCalledTimes(1);
+        expect(wrapper.find(".alert").exists()).toBe(false);
+    });
+
+    it("waits for the job that prepares an artifact before downloading it", async () => {
+        mockSuccessful();
+        mock.onHead(/api\/downloads\/flightuuid\/3dmodel/)
+            .replyOnce(202, "", { location: "/api/jobs/7" })
+            .onHead(/api\/downloads\/flightuuid\/3dmodel/)
+            .replyOnce(200);
+        mock.onGet("/api/jobs/7")
+            .replyOnce(200, { state: "RUNNING" })
+            .onGet("/api/jobs/7")
+            .replyOnce(200, { state: "COMPLETE" });
+        mountComponent();
+        await flushPromises();
+
+        await wrapper.findAll("button").at(2).trigger("click");
+        await flushPromises();
+        expect(wrapper.text()).toContain("preparando la descarga");
+        expect(clickLink).not.toHaveBeenCalled();
+
+        jest.advanceTimersByTime(2000);
+        await flushPromises();
+        expect(clickLink).not.toHaveBeenCalled();
+
+        jest.advanceTimersByTime(2000);
+        await flushPromises();
+        expect(mock.history.get.filter(request => request.url === "/api/jobs/7")).toHaveLength(2);
+        expect(mock.history.get[2].headers).toHaveProperty("Authorization");
+        expect(clickLink).toHaveBeenCalledTimes(1);
+        expect(wrapper.text()).not.toContain("preparando la descarga");
+    });
+
+    it("shows alert if the job that prepares an artifact fails", async () => {
+        mockSuccessful();
+        mock.onHead(/api\/downloads\/flightuuid\/3dmodel/).reply(202, "", { location: "/api/jobs/7" });
+        mock.onGet("/api/jobs/7").reply(200, { state: "ERROR" });
+        mountComponent();
+        await flushPromises();
+
+        await wrapper.findAll("button").at(2).trigger("click");
+        await flushPromises();
+        jest.advanceTimersByTime(2000);
+        await flushPromises();
+
+        expect(clickLink).not.toHaveBeenCalled();
+        expect(wrapper.find(".alert").exists()).toBe(true);
+    });
+
+    it("shows alert if the artifact is no longer available", async () => {
+        mockSuccessful();
+        mock.onHead(/api\/downloads\/flightuuid\/3dmodel/).reply(410);
+        mountComponent();
+        await flushPromises();
+
+        await wrapper.findAll("button").at(2).trigger("click");
+        await flushPromises();
+
+        expect(clickLink).not.toHaveBeenCalled();
+        expect(wrapper.find(".alert").exists()).toBe(true);
+    });
+})